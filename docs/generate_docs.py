@@ -14,6 +14,11 @@ import raw_data_rooter
 import utilities
 import yaml_reader
 import caen_reader
+import event_builder
+import event_index
+import raw_h5
+import waveform_codec
+import batch_waveform
 
 import event_display
 import ratdb_reader
@@ -21,7 +26,7 @@ import ratdb_reader
 from lazydocs import generate_docs
 
 # The parameters of this function correspond to the CLI options
-generate_docs(["raw_data_rooter", "run_drop", "waveform", "pulse_finder", "rq_writer", "yaml_reader", "utilities", "caen_reader"], output_path="./src_docs")
+generate_docs(["raw_data_rooter", "run_drop", "waveform", "pulse_finder", "rq_writer", "yaml_reader", "utilities", "caen_reader", "event_builder", "event_index", "raw_h5", "waveform_codec", "batch_waveform"], output_path="./src_docs")
 
 # The parameters of this function correspond to the CLI options
 generate_docs(["event_display", "ratdb_reader"], output_path="./tools_docs")
@@ -0,0 +1,363 @@
+'''
+Whole-batch waveform processing.
+
+BatchWaveform runs the steps of Waveform (saturation, flat and rolling baseline, SPE
+normalization, daisy chain correction, channel sums, integration, ROI and
+auxiliary channel variables) on one (event, channel, sample) array for a block
+of events, instead of per-channel dicts event by event.
+
+Arrays:
+    adc        (event, ch, sample) uint16, channels ordered as ch_names
+    (float arrays are of cfg.float_dtype, float64 or float32)
+    amp_mV     (event, ch, sample), all channels
+    amp_pe     (event, sig_ch, sample), signal channels (sig_names), after
+               daisy chain correction
+    amp_sum_pe (event, group, sample), summed channels (group_names)
+    *_int      accumulated integral of the above
+
+to_waveform(i, wfm) fills a Waveform with event i (dicts of views into the
+arrays), for PulseFinder and RQWriter; compare_waveform checks it against the
+per-event Waveform path.
+'''
+
+import os
+import sys
+import numpy as np
+import awkward as ak
+from numpy import cumsum
+from yaml_reader import YamlReader, SAMPLE_TO_NS, MY_QUANTILES
+from utilities import digitial_butter_highpass_filter
+from waveform import Waveform, get_numba_kernels, get_roi_bounds, calc_roi_stats, get_baseline_window
+sys.path.append(os.environ['LIB_DIR'])
+import utilities_numba as util_nb
+
+BLOCK_EVENTS = 100 # events processed at once. Memory: ~BLOCK_EVENTS*n_ch*n_samples*8 bytes per array
+
+
+class BatchWaveform():
+    """
+    Waveforms of a block of events, as (event, channel, sample) arrays.
+    """
+    def __init__(self, cfg: YamlReader):
+        """Constructor.
+
+        Args:
+            cfg (YamlReader): the config objection from YamlReader class.
+
+        Notes:
+            Set ch_names, ch_name_to_id_dict and spe_mean as for Waveform.
+        """
+        self.cfg = cfg
+        self.dtype = cfg.float_dtype # float64, or float32 (yaml key precision)
+        self.nb = get_numba_kernels(cfg.precision)
+        self.ch_names = None
+        self.ch_id = None
+        self.ch_name_to_id_dict = None
+        self.n_boards = None
+        self.spe_mean = None
+        self.sig_rows = None # set by setup() on first use
+        return None
+
+    def setup(self):
+        """
+        Channel rows and constants, computed once: signal and auxiliary rows,
+        spe_mean per signal row, daisy chain shift per signal row, and the
+        membership matrix of the summed channels.
+        """
+        if self.ch_names is None:
+            sys.exit('ERROR: BatchWaveform::ch_names is not specified.')
+        row = {ch: i for i, ch in enumerate(self.ch_names)}
+        self.sig_names = [ch for ch in self.ch_names if ch not in self.cfg.non_signal_channels]
+        self.sig_rows = np.array([row[ch] for ch in self.sig_names], dtype=int)
+        self.aux_rows = np.array([row[ch] for ch in self.cfg.non_signal_channels], dtype=int)
+        self.spe = np.array([self.spe_mean[ch] for ch in self.sig_names], dtype=float)
+        # see Waveform.correct_daisy_chain_trg_delay
+        self.dT_ns = 48
+        dS = self.dT_ns//int(SAMPLE_TO_NS)
+        self.dS = dS
+        shift = []
+        for ch in self.sig_names:
+            if "_b1" in ch:
+                shift.append(dS*2)
+            elif "_b2" in ch:
+                shift.append(dS)
+            elif ("_b3" in ch) or ("_b4" in ch):
+                shift.append(0)
+            else:
+                sys.exit("ERROR in correct_trg_delay: invalid boardId %s" % ch)
+        self.sig_shift = np.array(shift, dtype=int)
+        # summed channels: (group, signal channel) membership matrix
+        self.group_names, self.group_matrix = self.cfg.get_group_matrix(self.sig_names)
+        self.group_matrix = self.group_matrix.astype(self.dtype)
+        return None
+
+    def set_raw_data(self, batch, adc=None):
+        """
+        Set raw data of a block of events, from either raw tree layout.
+
+        Args:
+            batch: awkward array of events from the raw daq tree
+            adc: optional (event, channel, sample) traces, already unpacked
+                (adc_packed branch, see waveform_codec.py). Rows ordered as
+                ch_names.
+        """
+        if self.sig_rows is None:
+            self.setup()
+        if adc is None and 'adc' in batch.fields:
+            adc = ak.to_numpy(batch['adc'])
+        if adc is None:
+            adc = np.stack([ak.to_numpy(batch[ch]) for ch in self.ch_names], axis=1)
+        self.adc = np.asarray(adc)
+        self.n_events = len(self.adc)
+        self.event_id = ak.to_numpy(batch['event_id'])
+        self.event_ttt = ak.to_numpy(batch['event_ttt'])
+        self.event_sanity = ak.to_numpy(batch['event_sanity'])
+        return None
+
+    def find_saturation(self):
+        """
+        A channel is saturated if it crosses below ch_saturated_threshold adc.
+        An event is saturated if any of its signal channels is.
+        """
+        self.ch_saturated = self.adc.min(axis=2) <= self.cfg.ch_saturated_threshold
+        self.event_saturated = np.any(self.ch_saturated[:, self.sig_rows], axis=1)
+        return None
+
+    def subtract_flat_baseline(self):
+        """
+        Subtract a flat baseline (median) from all channels, flip polarity and
+        convert to mV. Same as Waveform.subtract_flat_baseline.
+        """
+        adc_to_mV = self.cfg.dgtz_dynamic_range_mV/(2**14-1)
+        # counting quantiles of the integer adc, same result as np.quantile
+        adc = self.adc
+        if self.cfg.baseline_method=='pretrigger':
+            start, end = get_baseline_window(self.cfg, adc.shape[2])
+            adc = adc[:, :, start:end]
+        adc = np.ascontiguousarray(adc, dtype=np.uint16)
+        qx = util_nb.quantile_hist_batch_u2(adc, MY_QUANTILES)
+        self.flat_base_mV = qx[:, :, 1]
+        self.flat_base_std_mV = abs(qx[:, :, 2]-qx[:, :, 0])/2
+        amp = -(self.adc-self.flat_base_mV.astype(self.dtype)[:, :, None])
+        if self.cfg.apply_high_pass_filter:
+            amp = digitial_butter_highpass_filter(amp, self.cfg.high_pass_cutoff_Hz, self.cfg.high_pass_threads)
+            amp = amp.astype(self.dtype, copy=False)
+        self.amp_mV = amp*adc_to_mV
+        return None
+
+    def subtract_rolling_baseline(self):
+        """
+        Rolling baseline on top of the flat one, all (event, channel) traces
+        in one kernel call. Same as Waveform.subtract_rolling_baseline.
+        """
+        adc_to_mV = self.cfg.dgtz_dynamic_range_mV/(2**14-1)
+        shape = self.amp_mV.shape
+        amp = np.ascontiguousarray(self.amp_mV).reshape(-1, shape[2])
+        base = np.empty_like(amp)
+        std = self.nb.rolling_baseline(amp, base, self.cfg.moving_avg_length,
+            self.cfg.sigma_above_baseline, self.cfg.pre_pulse, self.cfg.post_pulse, adc_to_mV)
+        self.amp_mV = (amp-base).reshape(shape)
+        self.ma_base_mV = base.reshape(shape)
+        self.ma_base_std_mV = std.reshape(shape[:2])
+        return None
+
+    def do_spe_normalization(self):
+        """
+        SPE normalization of the signal channels
+        """
+        spe = self.spe[None, :]
+        self.amp_pe = self.amp_mV[:, self.sig_rows]/50/spe.astype(self.dtype)[:, :, None]
+        self.flat_base_pe = self.flat_base_mV[:, self.sig_rows]/50/spe
+        self.flat_base_std_pe = self.flat_base_std_mV[:, self.sig_rows]/50/spe
+        if self.cfg.baseline_method=='rolling':
+            self.ma_base_pe = self.ma_base_mV[:, self.sig_rows]/50/spe.astype(self.dtype)[:, :, None]
+            self.ma_base_std_pe = self.ma_base_std_mV[:, self.sig_rows]/50/spe
+        return None
+
+    def define_trigger_position(self):
+        """
+        Trigger position from DAQ length and post_trigger fraction, as in
+        Waveform.define_trigger_position.
+        """
+        if self.cfg.daisy_chain:
+            n_samp = self.amp_mV.shape[2]
+            pre_trg_frac = 1.0-self.cfg.post_trigger
+            self.trg_pos = int(n_samp*pre_trg_frac)
+            self.trg_time_ns = self.trg_pos*(SAMPLE_TO_NS)
+        else:
+            print('Sorry pal. Fan-out not yet implemented.')
+        return None
+
+    def correct_daisy_chain_trg_delay(self):
+        """
+        Shift the signal channels by board, as in
+        Waveform.correct_daisy_chain_trg_delay. The sample axis gets 2*dS
+        shorter.
+        """
+        n_samp = self.amp_pe.shape[2] - self.dS*2
+        out = np.empty(self.amp_pe.shape[:2] + (n_samp,), dtype=self.amp_pe.dtype)
+        for s in np.unique(self.sig_shift):
+            rows = np.flatnonzero(self.sig_shift==s)
+            out[:, rows] = self.amp_pe[:, rows, s:s+n_samp]
+        self.amp_pe = out
+        self.trg_pos -= self.dS*2
+        self.trg_time_ns -= self.dT_ns*2
+        return None
+
+    def sum_channels(self):
+        """
+        Summed channels (see YamlReader.get_group_matrix), and the flat
+        baseline of 'sum', or of all sums with baseline_method: pretrigger
+        (as in Waveform.sum_channels). flat_base_sum_pe is (event, base_group).
+        """
+        self.amp_sum_pe = np.matmul(self.group_matrix, self.amp_pe)
+        if self.cfg.baseline_method=='pretrigger':
+            self.base_groups = list(range(len(self.group_names)))
+            start, end = get_baseline_window(self.cfg, self.amp_pe.shape[2])
+            mat = self.group_matrix.astype(np.float64)
+            ped = self.amp_pe[:, :, start:end].mean(axis=2, dtype=np.float64)
+            self.flat_base_sum_pe = ped @ mat.T
+            self.flat_base_std_sum_pe = np.sqrt(np.square(self.flat_base_std_pe) @ mat.T)
+            return None
+        self.base_groups = [self.group_names.index('sum')]
+        qx = np.array([self.nb.quantile_f8(a, MY_QUANTILES) for a in self.amp_sum_pe[:, self.base_groups[0]]])
+        self.flat_base_sum_pe = qx[:, 1:2]
+        self.flat_base_std_sum_pe = abs(qx[:, 2:3]-qx[:, 0:1])/2
+        return None
+
+    def define_time_axis(self):
+        n_samp = self.amp_pe.shape[2]
+        self.time_axis_ns = np.linspace(0, (n_samp-1)*SAMPLE_TO_NS, n_samp, dtype=self.dtype)
+        self.n_samp = n_samp
+        return None
+
+    def integrate_waveform(self):
+        """
+        Accumulated integral (adc*ns) of the signal and summed channels
+        """
+        self.amp_pe_int = cumsum(self.amp_pe, axis=2)*(SAMPLE_TO_NS)
+        self.amp_sum_pe_int = cumsum(self.amp_sum_pe, axis=2)*(SAMPLE_TO_NS)
+        return None
+
+    def calc_roi_info(self):
+        """
+        ROI variables of the signal channels, as in Waveform.calc_roi_info.
+        Each is an (event, sig_ch, roi) array.
+        """
+        start, end = get_roi_bounds(self.cfg, self.trg_pos, self.n_samp)
+        self.roi_height_pe, self.roi_low_pe, self.roi_std_pe, self.roi_area_pe = \
+            calc_roi_stats(self.amp_pe, self.amp_pe_int, start, end)
+        self.roi_std_mV = self.roi_std_pe*50*self.spe[None, :, None]
+        return None
+
+    def calc_aux_ch_info(self):
+        """
+        Area around the peak of the auxiliary channels, as in
+        Waveform.calc_aux_ch_info. (event, aux_ch) array.
+        """
+        a = self.amp_mV[:, self.aux_rows]
+        pp = np.argmax(a, axis=2)[:, :, None]
+        idx = np.arange(a.shape[2])
+        in_win = (idx>=np.maximum(pp-50, 0)) & (idx<np.minimum(pp+50, a.shape[2]-1))
+        self.aux_ch_area_mV = np.where(in_win, a, 0).sum(axis=2)*SAMPLE_TO_NS
+        return None
+
+    def process(self, batch, adc=None):
+        """
+        All steps, in the order of RunDROP.process_batch
+        """
+        self.set_raw_data(batch, adc)
+        self.find_saturation()
+        self.subtract_flat_baseline()
+        if self.cfg.baseline_method=='rolling':
+            self.subtract_rolling_baseline()
+        self.do_spe_normalization()
+        self.define_trigger_position()
+        self.correct_daisy_chain_trg_delay()
+        self.sum_channels()
+        self.define_time_axis()
+        self.integrate_waveform()
+        self.calc_roi_info()
+        self.calc_aux_ch_info()
+        return None
+
+    def to_waveform(self, i, wfm: Waveform):
+        """
+        Fill a Waveform with event i, as if it went through the per-event
+        steps. Arrays are views into the batch arrays.
+
+        Args:
+            i (int): event index in the block
+            wfm (Waveform): with ch_names, ch_id, ch_name_to_id_dict, spe_mean set
+        """
+        wfm.reset()
+        wfm.raw_data = dict(zip(self.ch_names, self.adc[i]))
+        wfm.event_id = self.event_id[i]
+        wfm.event_ttt = self.event_ttt[i]
+        wfm.event_sanity = self.event_sanity[i]
+        wfm.ch_saturated = dict(zip(self.ch_names, self.ch_saturated[i].tolist()))
+        wfm.event_saturated = bool(self.event_saturated[i])
+        wfm.amp_mV = dict(zip(self.ch_names, self.amp_mV[i]))
+        wfm.flat_base_mV = dict(zip(self.ch_names, self.flat_base_mV[i].tolist()))
+        wfm.flat_base_std_mV = dict(zip(self.ch_names, self.flat_base_std_mV[i].tolist()))
+        wfm.amp_pe = dict(zip(self.sig_names, self.amp_pe[i]))
+        wfm.amp_pe.update(zip(self.group_names, self.amp_sum_pe[i]))
+        wfm.amp_pe_int = dict(zip(self.sig_names, self.amp_pe_int[i]))
+        wfm.amp_pe_int.update(zip(self.group_names, self.amp_sum_pe_int[i]))
+        wfm.flat_base_pe = dict(zip(self.sig_names, self.flat_base_pe[i].tolist()))
+        wfm.flat_base_std_pe = dict(zip(self.sig_names, self.flat_base_std_pe[i].tolist()))
+        base_names = [self.group_names[g] for g in self.base_groups]
+        wfm.flat_base_pe.update(zip(base_names, self.flat_base_sum_pe[i].tolist()))
+        wfm.flat_base_std_pe.update(zip(base_names, self.flat_base_std_sum_pe[i].tolist()))
+        if self.cfg.baseline_method=='rolling':
+            wfm.ma_base_mV = dict(zip(self.ch_names, self.ma_base_mV[i]))
+            wfm.ma_base_std_mV = dict(zip(self.ch_names, self.ma_base_std_mV[i].tolist()))
+            wfm.ma_base_pe = dict(zip(self.sig_names, self.ma_base_pe[i]))
+            wfm.ma_base_std_pe = dict(zip(self.sig_names, self.ma_base_std_pe[i].tolist()))
+        wfm.trg_pos = self.trg_pos
+        wfm.trg_time_ns = self.trg_time_ns
+        wfm.time_axis_ns = self.time_axis_ns
+        wfm.n_samp = self.n_samp
+        wfm.roi_ch_names = self.sig_names
+        wfm.roi_height_pe = self.roi_height_pe[i]
+        wfm.roi_area_pe = self.roi_area_pe[i]
+        wfm.roi_low_pe = self.roi_low_pe[i]
+        wfm.roi_std_pe = self.roi_std_pe[i]
+        wfm.roi_std_mV = self.roi_std_mV[i]
+        wfm.aux_ch_area_mV = dict(zip(self.cfg.non_signal_channels, self.aux_ch_area_mV[i].tolist()))
+        return wfm
+
+
+def compare_waveform(wfm, ref, rtol=1e-9, atol=1e-9):
+    """
+    Compare a Waveform filled by BatchWaveform.to_waveform with one from the
+    per-event path.
+
+    Args:
+        wfm, ref (Waveform): the two waveforms of the same event
+
+    Returns:
+        list of str: names of the variables that differ (empty if equivalent)
+    """
+    bad = []
+    for name in ['event_id', 'event_saturated', 'trg_pos', 'trg_time_ns', 'n_samp']:
+        if getattr(wfm, name) != getattr(ref, name):
+            bad.append(name)
+    for name in ['ch_saturated', 'flat_base_mV', 'flat_base_std_mV', 'amp_mV', 'amp_pe',
+        'amp_pe_int', 'flat_base_pe', 'flat_base_std_pe', 'aux_ch_area_mV',
+        'ma_base_mV', 'ma_base_std_mV', 'ma_base_pe', 'ma_base_std_pe']:
+        a, b = getattr(wfm, name), getattr(ref, name)
+        if list(a)!=list(b):
+            bad.append(name)
+            continue
+        for ch in b:
+            if np.shape(a[ch])!=np.shape(b[ch]) or not np.allclose(a[ch], b[ch], rtol=rtol, atol=atol):
+                bad.append('%s[%s]' % (name, ch))
+    if list(wfm.roi_ch_names)!=list(ref.roi_ch_names):
+        bad.append('roi_ch_names')
+        return bad
+    for name in ['roi_height_pe', 'roi_area_pe', 'roi_low_pe', 'roi_std_pe', 'roi_std_mV']:
+        a, b = getattr(wfm, name), getattr(ref, name)
+        if np.shape(a)!=np.shape(b) or not np.allclose(a, b, rtol=rtol, atol=atol):
+            bad.append(name)
+    return bad
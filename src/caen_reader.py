@@ -1,14 +1,211 @@
 from numpy import nan, zeros, fromfile, dtype, uint32, uint64
 import numpy as np
+import os
+import sys
 from os import path
 import matplotlib.pylab as plt
 
+# One row per trigger, filled by the header-only scan (RawDataFile.build_index)
+TRIGGER_INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'), # byte offset of the trigger header in the file
+    ('boardId', 'u1'),
+    ('eventCounter', '<u4'),
+    ('ttt', '<u8'), # trigger time tag as in header (not corrected for rollover)
+    ('channelMask', '<u2'), # channel mask (V1730) or group mask (V1740)
+    ('zle', 'u1'), # zero-length encoding flag
+    ('size', '<u4'), # trigger size in bytes, header included
+])
+
+def find_next_header(buf, event_counter, max_delta=5, max_board_id=5, big_endian=False):
+    """
+    Vectorized search for the next plausible trigger header in a block of bytes.
+
+    A candidate is a 32-bit word, at any byte alignment, whose top nibble is
+    0xA. Candidates are then validated: the event counter (3rd word) must be
+    within max_delta of event_counter, the eventSize must cover at least the
+    4-word header, and the boardId must not exceed max_board_id (if given).
+
+    Args:
+        buf: 1d array of uint8
+        event_counter: int, event counter of the last good trigger
+        max_delta: int, tolerance on the event counter
+        max_board_id: int, largest valid boardId, or None for no check
+        big_endian: bool, True for LabVIEW files
+
+    Returns:
+        int, byte offset of the first good header in buf, or -1 if none
+    """
+    b = np.asarray(buf, dtype=np.uint8)
+    n = len(b) - 15 # a header needs 16 bytes
+    if n <= 0:
+        return -1
+    # byte holding the top nibble of the word starting at each byte offset
+    top = b[0:n] if big_endian else b[3:n+3]
+    cand = np.flatnonzero((top & 0xF0) == 0xa0)
+    if cand.size == 0:
+        return -1
+
+    def word_at(k):
+        b0, b1, b2, b3 = [b[k+j].astype(np.int64) for j in range(4)]
+        if big_endian:
+            return (b0 << 24) | (b1 << 16) | (b2 << 8) | b3
+        return (b3 << 24) | (b2 << 16) | (b1 << 8) | b0
+
+    i0 = word_at(cand)
+    i1 = word_at(cand+4)
+    i2 = word_at(cand+8)
+    event_count = i2 & 0x00ffffff
+    good = np.abs(event_count - event_counter) < max_delta
+    good &= (i0 & 0x0FFFFFFF) >= 4
+    if max_board_id is not None:
+        good &= ((i1 & 0xf8000000) >> 27) <= max_board_id
+    if not np.any(good):
+        return -1
+    return int(cand[np.argmax(good)])
+
+_util_nb = None
+
+def get_numba_lib():
+    """
+    The numba library (utilities_numba in LIB_DIR, see build.sh), imported on
+    first use. Only zero-length-encoded data need it.
+    """
+    global _util_nb
+    if _util_nb is None:
+        sys.path.append(os.environ['LIB_DIR'])
+        import utilities_numba
+        _util_nb = utilities_numba
+    return _util_nb
+
+def resync_file(raw_file, start_pos, max_skip=64016, max_delta=5, max_board_id=5):
+    """
+    Find the next good header after a header failed the sanity check, for
+    the RawDataFile of any reader (caen_reader, caen_reader_30t, ...).
+    A block of up to max_skip bytes is read at once and searched with
+    find_next_header, instead of one byte at a time. On success, the file
+    position is right after the new header.
+
+    The skipped bytes are reported and accumulated in raw_file.n_bytes_skipped;
+    raw_file.resync_log keeps (byte offset of the bad header, n bytes skipped).
+
+    Args:
+        raw_file: RawDataFile, with file, event_counter and DAQ_Software
+        start_pos: int, file position right after the bad header
+        max_skip: int, give up if no good header is found within max_skip bytes
+        max_delta, max_board_id: see find_next_header
+
+    Returns:
+        (i0, i1, i2, i3) of the new header, or None
+    """
+    begin = max(start_pos-3, 0)
+    raw_file.file.seek(begin)
+    buf = fromfile(raw_file.file, dtype='<u1', count=max_skip+19)
+    j = find_next_header(buf, raw_file.event_counter, max_delta=max_delta, max_board_id=max_board_id,
+        big_endian=(raw_file.DAQ_Software=='LabVIEW'))
+    if j < 0:
+        if len(buf) == max_skip+19:
+            print("Taking too long to find next event")
+            print(start_pos)
+        return None
+    header_pos = begin + j
+    raw_file.file.seek(header_pos + 16)
+
+    bad_pos = start_pos - 16
+    n_skipped = header_pos - bad_pos
+    raw_file.n_bytes_skipped += n_skipped
+    raw_file.resync_log.append((bad_pos, n_skipped))
+    if raw_file.verbosity>=1:
+        print("Info: resync skipped %d bytes, from byte %d to %d" % (n_skipped, bad_pos, header_pos))
+
+    if raw_file.DAQ_Software=='LabVIEW':
+        order_type='>u4'
+    else:
+        order_type='<u4'
+    i0, i1, i2, i3 = buf[j:j+16].view(order_type).tolist()
+    return i0, i1, i2, i3
+
+def decode_zle_channel(words, n_samples, sparse=False, out=None):
+    """
+    Vectorized zero-length-encoding (ZLE) decoder for one V1730 channel.
+
+    The payload is a sequence of control words. Bit 31 tells whether the
+    control word is followed by data (good) or marks samples to skip; bits 0-20
+    is the length in words (2 samples per word). The control words are walked
+    by the compiled zle_segments kernel (make_numba_lib.py); the data words are
+    gathered and expanded with index arithmetic.
+
+    Args:
+        words: 1d array of uint32, the channel payload after the size word
+        n_samples: int, length of the dense trace (recordLen)
+        sparse: bool. If True, skip the dense expansion and return the kept
+            segments instead (default: False)
+        out: optional preallocated float array of length n_samples
+
+    Returns:
+        dense: ndarray of float, NaN where samples are suppressed, or
+        sparse: (offsets, counts, samples). Segment i starts at sample
+            offsets[i] and holds counts[i] samples; samples is the uint16
+            concatenation of all segments.
+    """
+    words = np.ascontiguousarray(words, dtype=uint32)
+    data_start = np.empty(len(words), dtype=np.int64) # word position of the data of good segments
+    offsets = np.empty(len(words), dtype=np.int64) # sample offset of good segments
+    counts = np.empty(len(words), dtype=np.int64) # n words of good segments
+    n_seg = get_numba_lib().zle_segments(words, data_start, offsets, counts)
+    data_start = data_start[:n_seg]
+    offsets = offsets[:n_seg]
+    counts = counts[:n_seg]
+
+    # word index of every data word: repeat each segment start, add position within segment
+    n_words = int(counts.sum())
+    seg_first = np.cumsum(counts) - counts
+    idx = np.repeat(data_start - seg_first, counts) + np.arange(n_words)
+    samples = words[idx[idx < len(words)]].view('<u2')
+    if sparse:
+        return offsets, 2*counts, samples
+
+    if out is None:
+        out = zeros(n_samples)
+    out[:] = nan
+    pos = np.repeat(offsets - 2*seg_first, 2*counts) + np.arange(2*n_words)
+    pos = pos[:len(samples)]
+    keep = pos < n_samples
+    out[pos[keep]] = samples[keep]
+    return out
+
+def decode_V1740_group(words):
+    """
+    Vectorized V1740 unpacker for a whole group payload.
+
+    Every 3 words pack 8 samples of 12 bits, and every 9 words hold 3 samples
+    of each of the 8 channels in the group (ch0s0, ch0s1, ch0s2, ch1s0, etc).
+    See RawDataFile.decode_V1740_data for the word-by-word version.
+
+    Args:
+        words: 1d array of uint32. Length must be a multiple of 9.
+
+    Returns:
+        ndarray of uint16, shape (8, n_samples)
+    """
+    w = np.asarray(words, dtype=uint32).reshape(-1, 3)
+    samps = np.empty((len(w), 8), dtype=np.uint16)
+    samps[:, 0] = w[:, 0] & 0x00000FFF
+    samps[:, 1] = (w[:, 0] & 0x00FFF000) >> (3*4)
+    samps[:, 2] = ((w[:, 1] & 0x0000000F) << (2*4)) + ((w[:, 0] & 0xFF000000) >> (6*4))
+    samps[:, 3] = (w[:, 1] & 0x0000FFF0) >> (1*4)
+    samps[:, 4] = (w[:, 1] & 0x0FFF0000) >> (4*4)
+    samps[:, 5] = ((w[:, 2] & 0x000000FF) << (1*4)) + ((w[:, 1] & 0xF0000000) >> (7*4))
+    samps[:, 6] = (w[:, 2] & 0x000FFF00) >> (2*4)
+    samps[:, 7] = (w[:, 2] & 0xFFF00000) >> (5*4)
+    # (n_blocks, 8 channels, 3 samples) -> (8 channels, n_samples)
+    return samps.reshape(-1, 8, 3).transpose(1, 0, 2).reshape(8, -1)
+
 # =============================================
 # ============= Data File Class ===============
 # =============================================
 
 class RawDataFile:
-    def __init__(self, fileName, n_boards, ETTT_flag=False, DAQ_Software='ToolDAQ'):
+    def __init__(self, fileName, n_boards, ETTT_flag=False, DAQ_Software='ToolDAQ', zero_copy=False, zle_sparse=False):
         """
         Initializes the dataFile instance to include the fileName, access time,
         and the number of boards in the file. Also opens the file for reading.
@@ -18,6 +215,10 @@ class RawDataFile:
             n_boards: int, number of boards
             ETTT_flag: bool (default: False)
             DAQ_Software: str. (options: LabVIEW, ToolDAQ, default to ToolDAQ)
+            zero_copy: bool. If True, V1730 traces are read-only views into the
+                memory-mapped file instead of copies (default: False)
+            zle_sparse: bool. If True, ZLE traces are (offsets, counts, samples)
+                instead of dense NaN-filled arrays (default: False)
         """
         self.fileName = path.abspath(fileName)
         self.file = open(self.fileName, 'rb')
@@ -32,6 +233,13 @@ class RawDataFile:
         self.trigger_counter=0
         self.event_counter=0
         self.verbosity=1
+        self.n_bytes_skipped = 0 # total bytes skipped by resync()
+        self.resync_log = [] # (byte offset of bad header, n bytes skipped)
+        self.zero_copy = zero_copy
+        self.zle_sparse = zle_sparse
+        self.mmap = None # lazily created by get_mmap()
+        self.index = None # trigger index, see build_index() and load_index()
+        self.index_path = self.fileName + '.idx.npy'
         
     '''
     def get_next_n_words(self, n_words=4, skip_word=0xffffffff):
@@ -88,6 +296,144 @@ class RawDataFile:
         except ValueError:
             return None
 
+    def get_mmap(self):
+        """
+        Memory-map the whole binary file (read only). Created once and reused.
+
+        Returns:
+            np.memmap of uint8
+        """
+        if self.mmap is None:
+            self.mmap = np.memmap(self.fileName, dtype=np.uint8, mode='r')
+        return self.mmap
+
+    def scan_headers(self, start=0, max_n_triggers=None):
+        """
+        Header-only scan of the binary file. Only the 4-word header of each
+        trigger is read from the memory-mapped file; the payload is jumped over
+        using the eventSize in the header. No trace is decoded. A header is bad
+        if it fails the checks of getNextTrigger (0xA key, event counter within
+        5 of the last one) or its eventSize does not fit. After a bad header,
+        the scan continues from the next good header (see resync).
+
+        Args:
+            start: int, byte offset to start the scan. Must point to a header.
+            max_n_triggers: int, stop after this many triggers (default: None,
+                scan to the end of file)
+
+        Returns:
+            structured ndarray of TRIGGER_INDEX_DTYPE, one row per trigger
+        """
+        if self.DAQ_Software=='LabVIEW':
+            order_type='>u4'
+        else:
+            order_type='<u4'
+        raw = np.frombuffer(self.get_mmap(), dtype=np.uint8)
+        n_bytes = len(raw)
+
+        rows = []
+        pos = start # in bytes
+        event_counter = self.event_counter if self.event_counter>0 else None
+        while pos+16 <= n_bytes:
+            if max_n_triggers is not None and len(rows)>=max_n_triggers:
+                break
+            i0, i1, i2, i3 = raw[pos:pos+16].view(order_type).tolist()
+            eventSize = i0 & 0x0FFFFFFF
+            bad_counter = event_counter is not None and abs((i2 & 0x00ffffff) - event_counter) >= 5
+            if (i0 & 0xF0000000 != 0xa0000000) or bad_counter or eventSize<4 or pos+eventSize*4>n_bytes:
+                if self.verbosity>=1:
+                    print('Info: bad header at byte offset', pos)
+                    print(hex(i0), hex(i1), hex(i2), hex(i3))
+                if event_counter is None:
+                    break
+                # same search as resync(), directly on the mapped file
+                begin = pos+13
+                j = find_next_header(raw[begin:begin+64016+19], event_counter,
+                    big_endian=(self.DAQ_Software=='LabVIEW'))
+                if j<0:
+                    print('Info: header scan stopped at byte offset', pos)
+                    break
+                self.n_bytes_skipped += begin+j-pos
+                self.resync_log.append((pos, begin+j-pos))
+                if self.verbosity>=1:
+                    print("Info: resync skipped %d bytes, from byte %d to %d" % (begin+j-pos, pos, begin+j))
+                pos = begin+j
+                continue
+            boardId = (i1 & 0xf8000000) >> 27
+            if boardId == 5:
+                channelMask = i1 & 0x000000ff
+            else:
+                channelMask = (i1 & 0x000000ff) + ((i2 & 0xff000000) >> 16)
+            zle = 1 if i1 & 0x01000000 != 0 else 0
+            if self.ETTT_flag:
+                ttt = ((i1 >> 8) & 0xffff) * 2**32 + i3
+            else:
+                ttt = i3 & 0x7FFFFFFF
+            event_counter = i2 & 0x00ffffff
+            rows.append((pos, boardId, event_counter, ttt, channelMask, zle, eventSize*4))
+            pos += eventSize*4
+        return np.array(rows, dtype=TRIGGER_INDEX_DTYPE)
+
+    def build_index(self, save=True):
+        """
+        Scan the whole file and build the trigger index. The index is saved as
+        a sidecar .npy file next to the binary file, so that later passes can
+        load it instead of scanning again. Resyncs are not counted in
+        n_bytes_skipped here, only when the triggers are read; the bytes
+        skipped show as gaps between consecutive triggers of the index.
+
+        Args:
+            save: bool. Save the index to self.index_path (default: True)
+
+        Returns:
+            structured ndarray of TRIGGER_INDEX_DTYPE
+        """
+        n_bytes_skipped, resync_log = self.n_bytes_skipped, list(self.resync_log)
+        self.index = self.scan_headers()
+        self.n_bytes_skipped, self.resync_log = n_bytes_skipped, resync_log
+        if save:
+            try:
+                np.save(self.index_path, self.index)
+            except OSError:
+                print('Info: unable to save trigger index to', self.index_path)
+        return self.index
+
+    def load_index(self, rebuild=False):
+        """
+        Load the sidecar trigger index if it exists and is not older than the
+        binary file. Otherwise build (and save) it.
+
+        Returns:
+            structured ndarray of TRIGGER_INDEX_DTYPE
+        """
+        if (not rebuild) and path.exists(self.index_path) and \
+            path.getmtime(self.index_path)>=path.getmtime(self.fileName):
+            self.index = np.load(self.index_path)
+        else:
+            self.build_index()
+        return self.index
+
+    def seek_trigger(self, i):
+        """
+        Move the file position to the i-th trigger in the index, so that the
+        next getNextTrigger call returns that trigger.
+
+        Args:
+            i: int, row number in self.index
+        """
+        if self.index is None:
+            self.load_index()
+        self.file.seek(int(self.index['offset'][i]))
+        self.event_counter = int(self.index['eventCounter'][i])
+        return None
+
+    def resync(self, start_pos, max_skip=64016):
+        """
+        Find the next good header after a header failed the sanity check.
+        See resync_file.
+        """
+        return resync_file(self, start_pos, max_skip, max_delta=5, max_board_id=5)
+
     def decode_V1740_data(self, words):
         """
         The V1740 outputs data 12 bits at a time, but the data can't be read out in 12-bit words.
@@ -150,32 +496,12 @@ class RawDataFile:
                 print('Info: Read did not pass sanity check')
                 print('Info: Last read headers:')
                 print(hex(i0), hex(i1), hex(i2), hex(i3))
-                print("Start skipping...1 byte at a time...until the next good header...")
-            while (True):
-                #print("skipping a byte")
-                b = self.get_next_byte()
-                current_pos = self.file.tell()
-                if current_pos - start_pos > 64016:
-                    print("Taking too long to find next event")
-                    print(start_pos)
-                    return None
-                #print(self.file.tell())
-                if b is None:
-                    return None
-                #print(hex(b))
-                if (b & 0xF0 == 0xa0):
-                    #print("Stop")
-                    #break
-                    #print(self.file.tell())
-                    i0, i1, i2, i3 = self.get_next_n_words(n_words=4, byte_offset=-4)
-                    #print(self.file.tell())
-                    eventCounterMask = 0x00ffffff
-                    event_count = i2 & eventCounterMask
-                    #print(event_count)
-                    if (abs(event_count - self.event_counter) < 5):
-                        #print(self.file.tell())
-                        #print(event_count)
-                        break
+                print("Start searching for the next good header...")
+            header = self.resync(start_pos)
+            if header is None:
+                return None
+            i0, i1, i2, i3 = header
+            trigger.filePos = self.file.tell() - 16
 
         # extract the event size from the first header long-word
         eventSize = i0 - 0xa0000000
@@ -264,6 +590,32 @@ class RawDataFile:
         if trigger.brdtype == "V1730":
             self.recordLen = size//(2*numChannels) # Xin: save the length of traces
 
+            if self.zero_copy and not zLE:
+                # one (n_channels, n_samples) view into the mapped file, no copy
+                if self.DAQ_Software=='LabVIEW':
+                    dt = dtype('>H')
+                else:
+                    dt = dtype('<H')
+                mm = self.get_mmap()
+                pos = self.file.tell()
+                n_bytes = 2*numChannels*self.recordLen
+                if pos + n_bytes > len(mm):
+                    return None
+                block = np.frombuffer(mm, dtype=dt, count=n_bytes//2, offset=pos)
+                block = block.reshape(numChannels, self.recordLen)
+                self.file.seek(n_bytes, 1)
+
+                # sanity check once for the whole block (the left two bits should be empty)
+                if np.any(np.right_shift(block, 14)):
+                    trigger.sanity = 1
+
+                trigger.block = block
+                for row, ind in enumerate(np.flatnonzero(whichChan)):
+                    traceName = "b" + str(boardId) + "_ch" + str(ind)
+                    trigger.traces[traceName] = block[row]
+                self.trigger_counter += 1
+                return trigger
+
             # looping over the entries in the whichChan list, only reading data if the entry is 1
             for ind, k in enumerate(whichChan):
                 if k == 1:
@@ -287,42 +639,12 @@ class RawDataFile:
                             trigger.sanity = 1
 
                     else:
-                        # initialize an array of length self.recordLen, then set all values to nan
-                        trace = zeros(self.recordLen)
-                        trace[:] = nan
-
                         # The ZLE encoding uses a keyword to indicate if data to follow, otherwise number of samples to skip
                         (trSize,) = fromfile(self.file, dtype='I', count=1)
 
-                        # create two counting indices, m and trInd, for keeping track of our position in the trace and
-                        m = 1
-                        trInd = 0
-
-                        # create a data-type for reading the binary data
-                        dt = dtype('<H')
-
-                        # loop while the m counter is less than the total size of the trace
-                        while m < trSize:
-                            # extract the control word from the data
-                            (controlWord,) = fromfile(self.file, dtype='I', count=1)
-
-                            # determine the number of bytes to read, and convert into samples (x2)
-                            length = (controlWord & 0x001FFFFF) * 2
-
-                            # determine whether that which follows are data or number of samples to skip
-                            good = controlWord & 0x80000000
-
-                            # If they are data...
-                            if good:
-
-                                # Read and convert the data (length is
-                                tmp = fromfile(self.file, dtype=dt, count=length)
-                                # insert the read data into the empty trace otherwise full of NaNs
-                                trace[trInd:trInd + length] = tmp
-
-                            # Increment both the trInd and m indexes by their appropriate amounts
-                            trInd += length
-                            m += 1 + (length/2 if good else 0)
+                        # read the whole channel payload at once, then expand it into the trace
+                        payload = fromfile(self.file, dtype='<u4', count=trSize-1)
+                        trace = decode_zle_channel(payload, self.recordLen, sparse=self.zle_sparse)
 
                     # create a dictionary entry for the trace using traceName as the key
                     trigger.traces[traceName] = trace
@@ -345,21 +667,16 @@ class RawDataFile:
 
                     # If not zero length encoded
                     if not zLE:
-                        # Create a 32-bit datatype with correct endianness
-                        dt = dtype('<u4')
+                        # Read the whole group payload at once: 9 words per 3 samples of 8 channels
+                        words = self.get_next_n_words(n_words=(self.recordLen//3)*9)
 
-                        # Loop over all samples in group
-                        for j in range(self.recordLen//3):
-                            # Read 9 words
-                            words = self.get_next_n_words(n_words=9)
+                        # Decode all samples of the group, shape (8, n_samples)
+                        samps = decode_V1740_group(words)
 
-                            # Decode 24 samples
-                            samps = self.decode_V1740_data(words)
-
-                            # Add samples to trace
-                            for k in range(len(samps)//3):
-                                name = "b" + str(boardId) + "_ch" + str(ind*8 + k)
-                                trigger.traces[name] += samps[3*k:3*k+3]
+                        # Add samples to trace
+                        for k in range(8):
+                            name = "b" + str(boardId) + "_ch" + str(ind*8 + k)
+                            trigger.traces[name] = samps[k]
 
                     else:
                         print("Error! Zero-Length Encoding not implemented for V1740")
@@ -367,11 +684,175 @@ class RawDataFile:
             self.trigger_counter += 1
             return trigger
 
+    def correct_ttt_rollover(self, boardId, ttt):
+        """
+        Vectorized version of the trigger time tag rollover correction done in
+        getNextTrigger. Updates self.oldTimeTag and self.timeTagRollover, so the
+        two can be mixed.
+
+        Args:
+            boardId: int
+            ttt: 1d array of uint64, time tags of one board in file order (as in
+                header, see TRIGGER_INDEX_DTYPE)
+
+        Returns:
+            1d array of uint64, time tags corrected for rollover
+        """
+        ttt = np.asarray(ttt, dtype=uint64)
+        if len(ttt)==0:
+            return ttt
+        prev = np.concatenate(([uint64(self.oldTimeTag[boardId])], ttt[:-1]))
+        n_rollover = self.timeTagRollover[boardId] + np.cumsum(ttt < prev)
+        self.oldTimeTag[boardId] = uint64(ttt[-1])
+        self.timeTagRollover[boardId] = int(n_rollover[-1])
+        if self.ETTT_flag:
+            period = 2**48
+        else:
+            period = 2**31
+        return ttt + n_rollover.astype(uint64)*uint64(period)
+
+    def read_triggers(self, n, rollover=True):
+        """
+        Decode the next n triggers at once into a TriggerBatch: header fields
+        as 1-D arrays and traces as one preallocated 3-D block per board.
+
+        Headers are found with scan_headers. Plain V1730 triggers (no ZLE, same
+        channel mask and size) are copied straight from the memory-mapped file
+        into the block; other boards fall back to getNextTrigger.
+
+        Args:
+            n: int, max number of triggers to read
+            rollover: bool. If False, triggerTimeTag is left as in header, for
+                callers that correct the rollover themselves (default: True)
+
+        Returns:
+            TriggerBatch, or None if no trigger is left
+        """
+        hdr = self.scan_headers(start=self.file.tell(), max_n_triggers=n)
+        if len(hdr)==0:
+            return None
+        if self.DAQ_Software=='LabVIEW':
+            dt = dtype('>H')
+        else:
+            dt = dtype('<H')
+        mm = self.get_mmap()
+
+        batch = TriggerBatch(len(hdr))
+        batch.filePos[:] = hdr['offset']
+        batch.boardId[:] = hdr['boardId']
+        batch.eventCounter[:] = hdr['eventCounter']
+        batch.ttt[:] = hdr['ttt']
+        for boardId in np.unique(hdr['boardId']):
+            boardId = int(boardId)
+            sel = np.flatnonzero(hdr['boardId']==boardId)
+            h = hdr[sel]
+            batch.row[sel] = np.arange(len(sel))
+            fast = (boardId != 5) and (not np.any(h['zle'])) and \
+                np.all(h['channelMask']==h['channelMask'][0]) and np.all(h['size']==h['size'][0])
+            if fast:
+                whichChan = [k for k in range(16) if int(h['channelMask'][0]) & 1 << k]
+                numChannels = len(whichChan)
+                if numChannels<=0:
+                    raise IOError("Board %d has no active channel at byte %d" % (boardId, int(h['offset'][0])))
+                self.recordLen = (int(h['size'][0])-16)//(2*numChannels)
+                count = numChannels*self.recordLen
+                block = np.empty((len(sel), numChannels, self.recordLen), dtype=np.uint16)
+                for k, offset in enumerate(h['offset'].tolist()):
+                    block[k] = np.frombuffer(mm, dtype=dt, count=count, offset=offset+16).reshape(numChannels, self.recordLen)
+                # sanity check (the left two bits should be empty)
+                batch.sanity[sel] = np.any(np.right_shift(block, 14), axis=(1, 2))
+                batch.triggerTimeTag[sel] = self.correct_ttt_rollover(boardId, h['ttt'])
+                self.trigger_counter += len(sel)
+            else:
+                block = None
+                zle_sparse, self.zle_sparse = self.zle_sparse, False # blocks are always dense
+                try:
+                    for k, offset in enumerate(h['offset'].tolist()):
+                        self.file.seek(offset)
+                        # triggers are decoded board by board, not in file order:
+                        # getNextTrigger checks the counter against the previous trigger
+                        self.event_counter = int(h['eventCounter'][k])
+                        trg = self.getNextTrigger()
+                        if trg is None or len(trg.traces)==0 or trg.boardId!=boardId:
+                            # the header passed scan_headers, so the record itself is bad or short
+                            raise IOError("Unable to decode the trigger of board %d at byte %d" % (boardId, offset))
+                        chans = [int(name.split('_ch')[1]) for name in trg.traces]
+                        if block is None:
+                            whichChan = chans
+                            trace = np.asarray(trg.traces[next(iter(trg.traces))])
+                            block = np.empty((len(sel), len(whichChan), len(trace)), dtype=trace.dtype)
+                        if chans != whichChan:
+                            raise ValueError("Board %d changed its active channels at byte %d" % (boardId, offset))
+                        for c, trace in enumerate(trg.traces.values()):
+                            block[k, c] = trace
+                        batch.sanity[sel[k]] = trg.sanity
+                        batch.triggerTimeTag[sel[k]] = trg.triggerTimeTag
+                finally:
+                    self.zle_sparse = zle_sparse
+            if not rollover:
+                batch.triggerTimeTag[sel] = h['ttt']
+            batch.traces[boardId] = block
+            batch.channels[boardId] = whichChan
+
+        self.file.seek(int(hdr['offset'][-1]) + int(hdr['size'][-1]))
+        self.event_counter = int(hdr['eventCounter'][-1])
+        return batch
+
     def close(self):
         """
         Close the open data file. Helpful when doing on-the-fly testing
         """
         self.file.close()
+        self.mmap = None
+
+
+# =============================================
+# =========== Trigger Batch Class =============
+# =============================================
+
+
+class TriggerBatch:
+    def __init__(self, n):
+        """
+        Columnar container for n triggers, filled by RawDataFile.read_triggers.
+        Header fields are 1-D arrays, one entry per trigger in file order. The
+        traces of each board are one 3-D block, shape (n triggers of this board,
+        n_channels, n_samples); row[i] is the position of trigger i in the block
+        of its board, and channels[boardId] lists the channel of each block row.
+        """
+        self.n = n
+        self.filePos = zeros(n, dtype=uint64)
+        self.boardId = zeros(n, dtype=np.uint8)
+        self.eventCounter = zeros(n, dtype=uint32)
+        self.triggerTimeTag = zeros(n, dtype=uint64)
+        self.ttt = zeros(n, dtype=uint64) # as in header, not corrected for rollover
+        self.sanity = zeros(n, dtype=np.uint8)
+        self.row = zeros(n, dtype=np.int64)
+        self.traces = {} # boardId -> ndarray (n_triggers, n_channels, n_samples)
+        self.channels = {} # boardId -> list of channel numbers
+        self.reader_state = None # reader position after this batch, set by the rooter for checkpoints
+
+    def __len__(self):
+        return self.n
+
+    def get_trigger(self, i):
+        """
+        The i-th trigger as a RawTrigger, whose traces are views into the block.
+        """
+        trigger = RawTrigger()
+        boardId = int(self.boardId[i])
+        trigger.filePos = int(self.filePos[i])
+        trigger.boardId = boardId
+        trigger.eventCounter = int(self.eventCounter[i])
+        trigger.triggerTimeTag = self.triggerTimeTag[i]
+        trigger.triggerTime = trigger.triggerTimeTag * 8e-3
+        trigger.sanity = int(self.sanity[i])
+        if boardId == 5:
+            trigger.brdtype = "V1740"
+        trigger.block = self.traces[boardId][self.row[i]]
+        for c, ch in enumerate(self.channels[boardId]):
+            trigger.traces["b" + str(boardId) + "_ch" + str(ch)] = trigger.block[c]
+        return trigger
 
 
 # =============================================
@@ -397,6 +878,7 @@ class RawTrigger:
         #Xin added
         self.boardId = 0
         self.size = 0
+        self.block = None # (n_channels, n_samples) traces, zero_copy mode only
 
     def display(self, trName=None):
 
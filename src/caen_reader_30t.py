@@ -2,6 +2,7 @@ from numpy import nan, zeros, fromfile, dtype, uint32, uint64
 import numpy as np
 from os import path
 import matplotlib.pylab as plt
+from caen_reader import decode_V1740_group, decode_zle_channel, resync_file
 
 # =============================================
 # ============= Data File Class ===============
@@ -32,6 +33,8 @@ class RawDataFile:
         self.trigger_counter=0
         self.event_counter=0
         self.verbosity=1
+        self.n_bytes_skipped = 0 # total bytes skipped by resync()
+        self.resync_log = [] # (byte offset of bad header, n bytes skipped)
         
     '''
     def get_next_n_words(self, n_words=4, skip_word=0xffffffff):
@@ -88,6 +91,13 @@ class RawDataFile:
         except ValueError:
             return None
 
+    def resync(self, start_pos, max_skip=64016):
+        """
+        Find the next good header after a header failed the sanity check.
+        See caen_reader.resync_file.
+        """
+        return resync_file(self, start_pos, max_skip, max_delta=10, max_board_id=None)
+
     def decode_V1740_data(self, words):
         """
         The V1740 outputs data 12 bits at a time, but the data can't be read out in 12-bit words.
@@ -150,33 +160,12 @@ class RawDataFile:
                 print('Info: Read did not pass sanity check')
                 print('Info: Last read headers:')
                 print(hex(i0), hex(i1), hex(i2), hex(i3))
-                print("Start skipping...1 byte at a time...until the next good header...")
-            while (True):
-                #print("skipping a byte")
-                b = self.get_next_byte()
-                current_pos = self.file.tell()
-                if current_pos - start_pos > 64016:
-                    print("Taking too long to find next event")
-                    print(start_pos)
-                    return None
-                #print(self.file.tell())
-                if b is None:
-                    return None
-                #print(hex(b))
-                if (b & 0xF0 == 0xa0):
-                    #print("Stop")
-                    #break
-                    #print(self.file.tell())
-                    i0, i1, i2, i3 = self.get_next_n_words(n_words=4, byte_offset=-4)
-                    #print(self.file.tell())
-                    eventCounterMask = 0x00ffffff
-                    event_count = i2 & eventCounterMask
-                    #print(event_count)
-                    if (abs(event_count - self.event_counter) < 10):
-                        #print(self.file.tell())
-                        #print(event_count)
-                        break
-                    self.file.seek(-12, 1)
+                print("Start searching for the next good header...")
+            header = self.resync(start_pos)
+            if header is None:
+                return None
+            i0, i1, i2, i3 = header
+            trigger.filePos = self.file.tell() - 16
 
         # extract the event size from the first header long-word
         eventSize = i0 - 0xa0000000
@@ -288,42 +277,12 @@ class RawDataFile:
                             trigger.sanity = 1
 
                     else:
-                        # initialize an array of length self.recordLen, then set all values to nan
-                        trace = zeros(self.recordLen)
-                        trace[:] = nan
-
                         # The ZLE encoding uses a keyword to indicate if data to follow, otherwise number of samples to skip
                         (trSize,) = fromfile(self.file, dtype='I', count=1)
 
-                        # create two counting indices, m and trInd, for keeping track of our position in the trace and
-                        m = 1
-                        trInd = 0
-
-                        # create a data-type for reading the binary data
-                        dt = dtype('<H')
-
-                        # loop while the m counter is less than the total size of the trace
-                        while m < trSize:
-                            # extract the control word from the data
-                            (controlWord,) = fromfile(self.file, dtype='I', count=1)
-
-                            # determine the number of bytes to read, and convert into samples (x2)
-                            length = (controlWord & 0x001FFFFF) * 2
-
-                            # determine whether that which follows are data or number of samples to skip
-                            good = controlWord & 0x80000000
-
-                            # If they are data...
-                            if good:
-
-                                # Read and convert the data (length is
-                                tmp = fromfile(self.file, dtype=dt, count=length)
-                                # insert the read data into the empty trace otherwise full of NaNs
-                                trace[trInd:trInd + length] = tmp
-
-                            # Increment both the trInd and m indexes by their appropriate amounts
-                            trInd += length
-                            m += 1 + (length/2 if good else 0)
+                        # read the whole channel payload at once, then expand it into the trace
+                        payload = fromfile(self.file, dtype='<u4', count=trSize-1)
+                        trace = decode_zle_channel(payload, self.recordLen)
 
                     # create a dictionary entry for the trace using traceName as the key
                     trigger.traces[traceName] = trace
@@ -346,21 +305,16 @@ class RawDataFile:
 
                     # If not zero length encoded
                     if not zLE:
-                        # Create a 32-bit datatype with correct endianness
-                        dt = dtype('<u4')
-
-                        # Loop over all samples in group
-                        for j in range(self.recordLen//3):
-                            # Read 9 words
-                            words = self.get_next_n_words(n_words=9)
+                        # Read the whole group payload at once: 9 words per 3 samples of 8 channels
+                        words = self.get_next_n_words(n_words=(self.recordLen//3)*9)
 
-                            # Decode 24 samples
-                            samps = self.decode_V1740_data(words)
+                        # Decode all samples of the group, shape (8, n_samples)
+                        samps = decode_V1740_group(words)
 
-                            # Add samples to trace
-                            for k in range(len(samps)//3):
-                                name = "b" + str(boardId) + "_ch" + str(ind*8 + k)
-                                trigger.traces[name] += samps[3*k:3*k+3]
+                        # Add samples to trace
+                        for k in range(8):
+                            name = "b" + str(boardId) + "_ch" + str(ind*8 + k)
+                            trigger.traces[name] = samps[k]
 
                     else:
                         print("Error! Zero-Length Encoding not implemented for V1740")
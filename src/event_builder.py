@@ -0,0 +1,378 @@
+'''
+Build events from digitizer triggers.
+
+A trigger is one board's data; an event is made of one trigger per board with
+the same event counter. Events are built in a fixed-capacity ring buffer of
+(slot, channel, sample) uint16, where the slot of an event is
+event_id % capacity. Each slot carries a bitmask of the boards filled so far,
+so an event is known to be complete as soon as its last trigger arrives.
+'''
+
+import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+import numpy as np
+from numpy import zeros, full, uint16, uint64, int64
+
+
+def ch_name_to_id(ch):
+    """
+    Channel name to channel id: boardId*100 + chID. For example, b2_ch11 -> 211
+    """
+    ch_str = re.findall(r'\d+', ch)
+    return int(ch_str[0])*100+int(ch_str[1])
+
+
+class EventBuilder():
+    """
+    Array-backed event queue. Triggers go in one at a time, complete events
+    come out as contiguous arrays.
+    """
+    def __init__(self, ch_names, board_ids, n_samples, capacity=10000):
+        """Constructor
+
+        Args:
+            ch_names: list of str, active channels (ex. b1_ch0). Sorted by
+                channel id, this is the channel axis of the buffer.
+            board_ids: list of int, active boards. An event is complete when
+                all of them are filled.
+            n_samples: int, number of samples per channel
+            capacity: int, max number of events in the queue
+        """
+        self.ch_names = sorted(ch_names, key=ch_name_to_id)
+        self.ch_index = {ch: i for i, ch in enumerate(self.ch_names)}
+        self.board_ids = sorted(board_ids)
+        self.board_bit = {b: 1 << i for i, b in enumerate(self.board_ids)}
+        self.full_mask = (1 << len(self.board_ids)) - 1
+        self.ttt_board = self.board_ids[0] # use the first board as event ttt
+        self.capacity = capacity
+        self.n_samples = n_samples
+
+        self.adc = zeros([capacity, len(self.ch_names), n_samples], dtype=uint16)
+        self.event_id = full(capacity, -1, dtype=int64) # -1 means empty slot
+        self.ttt = zeros(capacity, dtype=uint64)
+        self.sanity = zeros(capacity, dtype=uint16)
+        self.mask = zeros(capacity, dtype=int64)
+        self.ready = deque() # (slot, event_id) of complete events, in completion order
+        self.board_rows = {} # boardId -> channel rows of its triggers
+        self.n_queued = 0 # number of events in the queue
+        self.n_evicted = 0 # incomplete events pushed out of the queue
+        return None
+
+    def _get_board_rows(self, trg):
+        """
+        Channel rows (in the buffer) of a trigger's traces, cached per board.
+        """
+        rows = self.board_rows.get(trg.boardId)
+        if rows is None or len(rows) != len(trg.traces):
+            rows = np.array([self.ch_index[ch] for ch in trg.traces])
+            self.board_rows[trg.boardId] = rows
+        return rows
+
+    def _free(self, slot):
+        self.event_id[slot] = -1
+        self.mask[slot] = 0
+        self.n_queued -= 1
+
+    def add_trigger(self, trg):
+        """
+        Add one trigger to its event. event_sanity = 10^(boardId-1) * trigger
+        sanity, summed over boards.
+
+        Args:
+            trg (RawTrigger): RawTrigger class object from caen_reader module
+
+        Returns:
+            bool: False if this board is already filled (trigger not added)
+        """
+        ID = int(trg.eventCounter)
+        slot = ID % self.capacity
+        if self.event_id[slot] != ID:
+            if self.event_id[slot] >= 0:
+                # an older event still holds the slot: the queue is full
+                print("WARNING: event queue is full, drop event_id", self.event_id[slot])
+                self.n_evicted += 1
+                self._free(slot)
+            self.event_id[slot] = ID
+            self.mask[slot] = 0
+            self.sanity[slot] = 0
+            self.ttt[slot] = 0
+            self.n_queued += 1
+
+        bit = self.board_bit[trg.boardId]
+        if self.mask[slot] & bit:
+            # duplicated, send warning
+            print("WARNING: duplicated trigger ???")
+            return False
+
+        rows = self._get_board_rows(trg)
+        if trg.block is not None:
+            self.adc[slot, rows] = trg.block
+        else:
+            for row, val in zip(rows, trg.traces.values()):
+                self.adc[slot, row] = val
+        self.sanity[slot] += 10**(trg.boardId-1) * trg.sanity
+        if trg.boardId == self.ttt_board:
+            self.ttt[slot] = trg.triggerTimeTag
+        self.mask[slot] |= bit
+        if self.mask[slot] == self.full_mask:
+            self.ready.append((slot, ID))
+        return True
+
+    def add_block(self, board_id, event_ids, block, ttt, sanity, channels=None):
+        """
+        Add the triggers of one board at once: same as add_trigger on each of
+        them, in event_id order, but the traces go into their slots with one
+        fancy-index assignment.
+
+        Args:
+            board_id: int
+            event_ids: 1d int array, event counter of each trigger
+            block: (trigger, channel, sample) traces
+            ttt: 1d uint64 array, trigger time tag of each trigger
+            sanity: 1d int array, sanity of each trigger
+            channels: channel number of each block row (default: the active
+                channels of the board, in order)
+
+        Returns:
+            1d bool array, False for the triggers not added (duplicated)
+        """
+        ids = np.asarray(event_ids, dtype=int64)
+        added = np.zeros(len(ids), dtype=bool)
+        if len(ids) == 0:
+            return added
+        prefix = 'b%d_ch' % board_id
+        if channels is None:
+            rows = np.array([i for i, ch in enumerate(self.ch_names) if ch.startswith(prefix)])
+        else:
+            rows = np.array([self.ch_index[prefix + str(ch)] for ch in channels])
+        bit = self.board_bit[board_id]
+        weight = 10**(board_id-1)
+        # first trigger of each event id, in event_id order
+        uids, first = np.unique(ids, return_index=True)
+        # slots are unique as long as the ids span less than the capacity
+        lo = 0
+        while lo < len(uids):
+            hi = int(np.searchsorted(uids, uids[lo] + self.capacity))
+            ID = uids[lo:hi]
+            idx = first[lo:hi]
+            slots = ID % self.capacity
+            new = self.event_id[slots] != ID
+            for slot in slots[new & (self.event_id[slots] >= 0)].tolist():
+                # an older event still holds the slot: the queue is full
+                print("WARNING: event queue is full, drop event_id", self.event_id[slot])
+                self.n_evicted += 1
+                self._free(slot)
+            self.event_id[slots[new]] = ID[new]
+            self.mask[slots[new]] = 0
+            self.sanity[slots[new]] = 0
+            self.ttt[slots[new]] = 0
+            self.n_queued += int(np.sum(new))
+
+            ok = (self.mask[slots] & bit) == 0
+            slots = slots[ok]
+            idx = idx[ok]
+            self.adc[slots[:, None], rows] = block[idx]
+            self.sanity[slots] += weight * np.asarray(sanity, dtype=uint16)[idx]
+            if board_id == self.ttt_board:
+                self.ttt[slots] = np.asarray(ttt)[idx]
+            self.mask[slots] |= bit
+            complete = slots[self.mask[slots] == self.full_mask]
+            self.ready.extend(zip(complete.tolist(), self.event_id[complete].tolist()))
+            added[idx] = True
+            lo = hi
+        if not np.all(added):
+            # duplicated, send warning
+            print("WARNING: %d duplicated triggers ???" % int(np.sum(~added)))
+        return added
+
+    def n_ready(self):
+        return len(self.ready)
+
+    def pop_ready(self, out=None):
+        """
+        Take all complete events out of the queue, in event_id order.
+
+        Args:
+            out: optional dict of preallocated arrays (adc, event_id, event_ttt,
+                event_sanity) with at least n_ready() rows. Events are written
+                into their leading rows, so buffers can be reused between dumps.
+                Any dtype/byte order/strides are accepted.
+
+        Returns:
+            dict of arrays: adc (n_evts, n_ch, n_samples), event_id, event_ttt,
+            event_sanity. None if no event is complete.
+        """
+        ready = []
+        while self.ready:
+            slot, ID = self.ready.popleft()
+            if self.event_id[slot] == ID and self.mask[slot] == self.full_mask:
+                ready.append((ID, slot))
+        if not ready:
+            return None
+        n_evts = len(ready)
+        slots = np.array([slot for ID, slot in sorted(ready)])
+        # contiguous slots (the usual case) are sliced, not gathered
+        if np.all(np.diff(slots) == 1):
+            slots = slice(slots[0], slots[-1]+1)
+        if out is None:
+            events = {
+                'adc': self.adc[slots].copy(),
+                'event_id': self.event_id[slots].astype(np.uint32),
+                'event_ttt': self.ttt[slots].copy(),
+                'event_sanity': self.sanity[slots].copy(),
+            }
+        else:
+            events = {key: out[key][:n_evts] for key in ['adc', 'event_id', 'event_ttt', 'event_sanity']}
+            events['adc'][...] = self.adc[slots]
+            events['event_id'][...] = self.event_id[slots]
+            events['event_ttt'][...] = self.ttt[slots]
+            events['event_sanity'][...] = self.sanity[slots]
+        self.event_id[slots] = -1
+        self.mask[slots] = 0
+        self.n_queued -= n_evts
+        return events
+
+    def queued_event_id(self):
+        """
+        event_id of the (incomplete) events still in the queue
+        """
+        return np.sort(self.event_id[self.event_id >= 0])
+
+    def get_state(self):
+        """
+        Content of the queue as arrays, for checkpoints (see set_state).
+
+        Returns:
+            dict of arrays: event_id, ttt, sanity, mask, adc of the occupied
+            slots, and n_evicted
+        """
+        slots = np.flatnonzero(self.event_id >= 0)
+        slots = slots[np.argsort(self.event_id[slots], kind='stable')]
+        return {
+            'event_id': self.event_id[slots],
+            'ttt': self.ttt[slots],
+            'sanity': self.sanity[slots],
+            'mask': self.mask[slots],
+            'adc': self.adc[slots],
+            'n_evicted': np.array(self.n_evicted),
+        }
+
+    def set_state(self, state):
+        """
+        Refill the queue from get_state. Complete events that were not popped
+        yet are ready again.
+        """
+        self.event_id[:] = -1
+        self.mask[:] = 0
+        self.ready.clear()
+        ids = np.asarray(state['event_id'], dtype=int64)
+        slots = ids % self.capacity
+        self.event_id[slots] = ids
+        self.ttt[slots] = state['ttt']
+        self.sanity[slots] = state['sanity']
+        self.mask[slots] = state['mask']
+        self.adc[slots] = state['adc']
+        self.n_queued = len(ids)
+        self.n_evicted = int(state['n_evicted'])
+        for slot, ID in zip(slots.tolist(), ids.tolist()):
+            if self.mask[slot] == self.full_mask:
+                self.ready.append((slot, ID))
+        return None
+
+
+class IntervalIdSet():
+    """
+    Set of integer ids stored as sorted, disjoint [start, stop) intervals.
+    event_id are nearly consecutive, so memory stays at a few intervals no
+    matter how many ids are added. Membership is a binary search; len() is
+    kept as a counter.
+    """
+    def __init__(self):
+        self.starts = []
+        self.stops = []
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, ID):
+        i = bisect_right(self.starts, ID) - 1
+        return i >= 0 and ID < self.stops[i]
+
+    def isin(self, ids):
+        """
+        Vectorized membership test.
+
+        Returns:
+            1d bool array, True for the ids in the set
+        """
+        ids = np.asarray(ids, dtype=int64)
+        i = np.searchsorted(np.array(self.starts, dtype=int64), ids, side='right') - 1
+        stops = np.array(self.stops + [0], dtype=int64) # i=-1 maps to the extra 0
+        return (i >= 0) & (ids < stops[i])
+
+    def n_intervals(self):
+        return len(self.starts)
+
+    def get_state(self):
+        """
+        Returns:
+            (2, n_intervals) int64 array of starts and stops, for checkpoints
+        """
+        return np.array([self.starts, self.stops], dtype=int64).reshape(2, -1)
+
+    def set_state(self, state):
+        """
+        Replace the content with a get_state array.
+        """
+        self.starts = [int(a) for a in state[0]]
+        self.stops = [int(b) for b in state[1]]
+        self.n = sum(b - a for a, b in zip(self.starts, self.stops))
+        return None
+
+    def add(self, ID):
+        ID = int(ID)
+        # fast path: extend the last interval
+        if self.stops and self.stops[-1] == ID:
+            self.stops[-1] += 1
+            self.n += 1
+            return None
+        self.add_range(ID, ID+1)
+        return None
+
+    def add_range(self, start, stop):
+        """
+        Add all ids in [start, stop), merging with touching intervals.
+        """
+        start, stop = int(start), int(stop)
+        if stop <= start:
+            return None
+        lo = bisect_left(self.stops, start) # first interval touching from the left
+        hi = bisect_right(self.starts, stop) # past the last interval touching from the right
+        if lo == hi:
+            self.starts.insert(lo, start)
+            self.stops.insert(lo, stop)
+            self.n += stop - start
+            return None
+        new_start = min(start, self.starts[lo])
+        new_stop = max(stop, self.stops[hi-1])
+        removed = sum(b - a for a, b in zip(self.starts[lo:hi], self.stops[lo:hi]))
+        self.starts[lo:hi] = [new_start]
+        self.stops[lo:hi] = [new_stop]
+        self.n += (new_stop - new_start) - removed
+        return None
+
+    def update(self, ids):
+        """
+        Add an array of ids. Consecutive runs are added as one interval.
+        """
+        ids = np.unique(np.asarray(ids, dtype=int64))
+        if len(ids) == 0:
+            return None
+        breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+        run_starts = ids[np.r_[0, breaks]]
+        run_stops = ids[np.r_[breaks - 1, len(ids) - 1]] + 1
+        for a, b in zip(run_starts.tolist(), run_stops.tolist()):
+            self.add_range(a, b)
+        return None
@@ -0,0 +1,107 @@
+'''
+Random access to events of a raw root file by event_id.
+
+The rooter writes an `event_index` tree next to `daq`: one entry per event,
+with event_id, its entry number in `daq`, and event_ttt. The functions here
+turn event_id lists or ranges into (entry_start, entry_stop) reads, so only
+the baskets holding the wanted events are read and decompressed.
+
+Usage example:
+    f = uproot.open('run.root')
+    index = load_event_index(f)
+    for start, stop in event_id_to_entry_ranges(index, [1000, 1001, 3000]):
+        batch = f['daq'].arrays(entry_start=start, entry_stop=stop)
+'''
+
+import numpy as np
+import uproot
+
+
+def load_event_index(f):
+    """
+    Load the event index of a raw root file, sorted by event_id. For files
+    written before the event_index tree existed, the index is built from the
+    event_id branch of daq (only this branch is read).
+
+    Args:
+        f: path to the raw root file, or the uproot file object
+
+    Returns:
+        dict of arrays: event_id, entry, event_ttt (event_ttt only if the
+        event_index tree exists)
+    """
+    if isinstance(f, str):
+        f = uproot.open(f)
+    if 'event_index' in f:
+        index = f['event_index'].arrays(['event_id', 'entry', 'event_ttt'], library='np')
+    else:
+        event_id = f['daq']['event_id'].array(library='np')
+        index = {'event_id': event_id, 'entry': np.arange(len(event_id), dtype=np.uint64)}
+    order = np.argsort(index['event_id'], kind='stable')
+    return {key: val[order] for key, val in index.items()}
+
+
+def event_id_to_entry(index, event_id):
+    """
+    Entry numbers in daq of a list of event_id. Missing event_id are dropped.
+
+    Args:
+        index: return of load_event_index
+        event_id: int or list of int
+
+    Returns:
+        array of entry numbers, in the order of the given event_id
+    """
+    event_id = np.atleast_1d(np.asarray(event_id, dtype=np.int64))
+    ids = index['event_id']
+    pos = np.searchsorted(ids, event_id)
+    pos[pos>=len(ids)] = max(len(ids)-1, 0)
+    found = (len(ids)>0) & (ids[pos]==event_id)
+    return index['entry'][pos[found]].astype(np.int64)
+
+
+def entry_to_ranges(entry, max_gap=0):
+    """
+    Merge entry numbers into (entry_start, entry_stop) ranges.
+
+    Args:
+        entry: array of entry numbers
+        max_gap: entries closer than this are read in the same range
+            (reading a few unwanted entries is cheaper than another read)
+
+    Returns:
+        list of (entry_start, entry_stop)
+    """
+    entry = np.unique(entry)
+    if len(entry)==0:
+        return []
+    breaks = np.flatnonzero(np.diff(entry) > max_gap+1) + 1
+    starts = entry[np.r_[0, breaks]]
+    stops = entry[np.r_[breaks-1, len(entry)-1]] + 1
+    return [(int(a), int(b)) for a, b in zip(starts, stops)]
+
+
+def event_id_to_entry_ranges(index, event_id, max_gap=0):
+    """
+    (entry_start, entry_stop) ranges covering a list of event_id.
+    """
+    return entry_to_ranges(event_id_to_entry(index, event_id), max_gap)
+
+
+def event_id_range_to_entries(index, start_id, end_id):
+    """
+    One (entry_start, entry_stop) range covering all events with
+    start_id <= event_id < end_id. Events are written roughly in event_id
+    order, so a few events outside [start_id, end_id) may be included; filter
+    by event_id after reading.
+
+    Returns:
+        (entry_start, entry_stop). (0, 0) if no event is in range.
+    """
+    ids = index['event_id']
+    lo = np.searchsorted(ids, start_id, side='left')
+    hi = np.searchsorted(ids, end_id, side='left')
+    if hi<=lo:
+        return (0, 0)
+    entry = index['entry'][lo:hi]
+    return (int(entry.min()), int(entry.max())+1)
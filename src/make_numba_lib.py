@@ -3,11 +3,15 @@ A set of numba compatiable functions goes here
 Create a library of pre-compile numba function for the accelerated performance
 Must compile before using the functions.
 
+Kernels on waveform arrays are also exported with f4 signatures (name_f4)
+for the float32 mode (yaml key precision).
+
 Reference:
 https://numba.readthedocs.io/en/stable/user/pycc.html
 """
 
 from numba.pycc import CC
+from numba import njit
 import numpy as np
 import os
 LIB_DIR = os.environ['LIB_DIR']
@@ -18,6 +22,7 @@ cc.output_dir=LIB_DIR
 #cc.verbose = True
 
 @cc.export('quantile_f8', 'f8[:](f8[:], f8[:])')
+@cc.export('quantile_f4', 'f8[:](f4[:], f8[:])')
 @cc.export('quantile_u2', 'f8[:](u2[:], f8[:])')
 def quantile(a, q):
     """
@@ -30,7 +35,84 @@ def quantile(a, q):
     qx = np.quantile(a, q)
     return qx
 
+@njit
+def _hist_quantile(a, q, counts, out):
+    """
+    Quantiles of an integer trace by counting instead of sorting. Same as
+    np.quantile (linear method), including its interpolation rounding.
+    The count window spans [min(a), max(a)] only, so a quiet baseline
+    costs O(n) plus a few tens of bins.
+
+    Args:
+        a: 1d integer array
+        q: 1d sorted array of quantiles in [0, 1]
+        counts: 1d int64 work array, at least max(a)-min(a)+1 long
+        out: 1d float64 array of q.size, filled here
+    """
+    n = a.size
+    lo = a[0]; hi = a[0]
+    for i in range(1, n):
+        if a[i] < lo:
+            lo = a[i]
+        elif a[i] > hi:
+            hi = a[i]
+    n_bins = np.int64(hi) - np.int64(lo) + 1
+    counts[:n_bins] = 0
+    for i in range(n):
+        counts[np.int64(a[i]) - np.int64(lo)] += 1
+    # walk the cumulative count once; rank r has value lo+b once cum > r
+    b = 0
+    cum = counts[0]
+    for k in range(q.size):
+        h = (n-1)*q[k]
+        r0 = np.int64(np.floor(h))
+        r1 = r0 + 1 if r0 < n-1 else r0
+        t = h - r0
+        while cum <= r0:
+            b += 1
+            cum += counts[b]
+        b1 = b; cum1 = cum
+        while cum1 <= r1:
+            b1 += 1
+            cum1 += counts[b1]
+        x0 = np.float64(np.int64(lo) + b)
+        x1 = np.float64(np.int64(lo) + b1)
+        d = x1 - x0
+        if t >= 0.5:
+            out[k] = x1 - d*(1-t)
+        else:
+            out[k] = x0 + d*t
+    return out
+
+@cc.export('quantile_hist_u2', 'f8[:](u2[:], f8[:])')
+def quantile_hist_u2(a, q):
+    """
+    Counting-based np.quantile for one uint16 (14-bit ADC) trace. q must be
+    sorted.
+    """
+    counts = np.empty(np.int64(a.max()) - np.int64(a.min()) + 1, dtype=np.int64)
+    out = np.empty(q.size, dtype=np.float64)
+    return _hist_quantile(a, q, counts, out)
+
+@cc.export('quantile_hist_batch_u2', 'f8[:,:,:](u2[:,:,:], f8[:])')
+def quantile_hist_batch_u2(adc, q):
+    """
+    Counting-based np.quantile of (event, channel, sample) uint16 traces along
+    the sample axis. q must be sorted.
+
+    Returns:
+        (event, channel, quantile) array of float64
+    """
+    n_evts, n_ch, n_samples = adc.shape
+    out = np.empty((n_evts, n_ch, q.size), dtype=np.float64)
+    counts = np.empty(1 << 16, dtype=np.int64)
+    for e in range(n_evts):
+        for c in range(n_ch):
+            _hist_quantile(adc[e, c], q, counts, out[e, c])
+    return out
+
 @cc.export('std', 'f8(f8[:])')
+@cc.export('std_f4', 'f8(f4[:])')
 def std(a):
     """
     Accelerated np.std function
@@ -38,14 +120,17 @@ def std(a):
     return np.std(a)
 
 @cc.export('max', 'f8(f8[:])')
+@cc.export('max_f4', 'f8(f4[:])')
 def max(a):
     return np.max(a)
 
 @cc.export('min', 'f8(f8[:])')
+@cc.export('min_f4', 'f8(f4[:])')
 def min(a):
     return np.min(a)
 
 @cc.export('linear_interpolation', 'f8(f8[:], f8[:], f8, b1)')
+@cc.export('linear_interpolation_f4', 'f8(f4[:], f4[:], f8, b1)')
 def linear_interpolation(x_arr, y_arr, y, rising_edge=True):
     """
     Linear interpolation
@@ -66,6 +151,7 @@ def linear_interpolation(x_arr, y_arr, y, rising_edge=True):
     return x_l[i]+(x_h[i]-x_l[i])/(y_h[i]-y_l[i])*(y-y_l[i])
 
 @cc.export('aft', 'f8(f8[:], f8[:], f8)')
+@cc.export('aft_f4', 'f8(f4[:], f4[:], f8)')
 def aft(t, a_int, y):
     """
     Get Area Fraction Time (AFT) at y*100 pct.
@@ -85,6 +171,7 @@ def aft(t, a_int, y):
         return x_l[i]+(x_h[i]-x_l[i])/(y_h[i]-y_l[i])*(y-y_l[i])
 
 @cc.export('rise_time', 'f8(f8[:], f8[:], f8)')
+@cc.export('rise_time_f4', 'f8(f4[:], f4[:], f8)')
 def rise_time(x_arr, y_arr, spe_thresh=0.125):
     """
     Get rise time (10% to 90% height).
@@ -116,6 +203,7 @@ def rise_time(x_arr, y_arr, spe_thresh=0.125):
     return t90-t10
 
 @cc.export('fall_time', 'f8(f8[:], f8[:], f8)')
+@cc.export('fall_time_f4', 'f8(f4[:], f4[:], f8)')
 def fall_time(x_arr, y_arr, spe_thresh=0.125):
     """
     Get fall time (90% to 10% height).
@@ -146,5 +234,253 @@ def fall_time(x_arr, y_arr, spe_thresh=0.125):
     i = msk10[0]; t10 = x_l[i]+(x_h[i]-x_l[i])/(y_h[i]-y_l[i])*(y10-y_l[i])
     return t10-t90
 
+@njit
+def _rolling_baseline(x, base, n, sigma, pre, post, min_std, mask):
+    """
+    Rolling baseline of one trace, in one pass. The baseline is the mean of
+    the last n accepted samples. A sample more than sigma*std above the
+    baseline starts a pulse: samples from pre before to post after it are
+    masked and not accepted. Samples enter the window pre samples late, once
+    their mask is final, so the baseline holds flat across pulses.
+
+    Args:
+        x: 1d array, baseline subtracted with positive pulses (ex. amp_mV)
+        base: 1d array of x.size, filled here
+        n: window length in samples
+        sigma: threshold in units of the window std
+        pre, post: samples masked before and after a threshold crossing
+        min_std: lower bound of the window std (ex. one adc count)
+        mask: 1d bool work array of x.size
+
+    Returns:
+        std of x-base over the samples outside pulses
+    """
+    n_samp = x.size
+    # max and min are shadowed by the exports above
+    if n > n_samp:
+        n = n_samp
+    if n < 1:
+        n = 1
+    buf = np.empty(n, dtype=np.float64)
+    s = 0.0; s2 = 0.0
+    # seed the window with the first n samples
+    for i in range(n):
+        buf[i] = x[i]
+        s += buf[i]; s2 += buf[i]*buf[i]
+    head = 0
+    mask[:] = False
+    mask_end = 0 # samples before mask_end are already masked: each sample is set once
+    for i in range(n_samp):
+        mean = s/n
+        var = s2/n - mean*mean
+        std = np.sqrt(var) if var > min_std*min_std else min_std
+        base[i] = mean
+        if i>=n and x[i] > mean + sigma*std:
+            lo = i-pre if i>pre else 0
+            hi = i+post+1 if i+post+1<n_samp else n_samp
+            if lo < mask_end:
+                lo = mask_end
+            if hi > lo:
+                mask[lo:hi] = True
+                mask_end = hi
+        j = i - pre # mask of sample j is final now
+        if j>=n and not mask[j]:
+            s += x[j] - buf[head]
+            s2 += x[j]*x[j] - buf[head]*buf[head]
+            buf[head] = x[j]
+            head = (head+1) % n
+    # residual noise outside pulses
+    m = 0; r = 0.0; r2 = 0.0
+    for i in range(n_samp):
+        if not mask[i]:
+            d = x[i] - base[i]
+            r += d; r2 += d*d; m += 1
+    if m==0:
+        return 0.0
+    r /= m
+    var = r2/m - r*r
+    return np.sqrt(var) if var > 0 else 0.0
+
+@cc.export('rolling_baseline', 'f8[:](f8[:,:], f8[:,:], i8, f8, i8, i8, f8)')
+@cc.export('rolling_baseline_f4', 'f8[:](f4[:,:], f4[:,:], i8, f8, i8, i8, f8)')
+def rolling_baseline(a, base, n, sigma, pre, post, min_std):
+    """
+    Rolling baseline with pulse masking of (trace, sample) arrays, ex. the
+    channels of an event or the (event*channel) traces of a batch. Linear in
+    the number of samples. See _rolling_baseline.
+
+    Args:
+        a: (trace, sample) array
+        base: (trace, sample) array, filled with the baseline
+        n, sigma, pre, post: yaml keys moving_avg_length, sigma_above_baseline,
+            pre_pulse, post_pulse
+        min_std: lower bound of the window std, in units of a
+
+    Returns:
+        std of a-base outside pulses, per trace
+    """
+    n_tr, n_samp = a.shape
+    out = np.empty(n_tr, dtype=np.float64)
+    mask = np.empty(n_samp, dtype=np.bool_)
+    for k in range(n_tr):
+        out[k] = _rolling_baseline(a[k], base[k], n, sigma, pre, post, min_std, mask)
+    return out
+
+@cc.export('zle_segments', 'i8(u4[:], i8[:], i8[:], i8[:])')
+def zle_segments(words, data_start, offsets, counts):
+    """
+    Walk the control words of one zero-length-encoded (ZLE) V1730 channel
+    payload. Bit 31 of a control word tells whether data follow (good) or
+    samples are skipped; bits 0-20 are the length in words (2 samples per
+    word). See decode_zle_channel in caen_reader.py.
+
+    Args:
+        words: 1d uint32 array, the channel payload after the size word
+        data_start, offsets, counts: 1d int64 arrays, at least words.size
+            long, filled with the word position of the data, the sample offset
+            and the number of data words of each good segment
+
+    Returns:
+        number of good segments
+    """
+    n_seg = 0
+    m = 0
+    tr_ind = 0
+    while m < words.size:
+        length = np.int64(words[m] & 0x001FFFFF)
+        if words[m] & 0x80000000:
+            data_start[n_seg] = m+1
+            offsets[n_seg] = tr_ind
+            counts[n_seg] = length
+            n_seg += 1
+            m += 1 + length
+        else:
+            m += 1
+        tr_ind += 2*length
+    return n_seg
+
+# ---------------------------------------------------------------------------
+# Lossless waveform codec: delta + zigzag + bit-packing, for uint16 (14-bit)
+# ADC traces. See waveform_codec.py for the byte layout.
+# ---------------------------------------------------------------------------
+CODEC_BLOCK = 64 # samples per bit-packed block
+
+@njit
+def _pack_trace(x, out, pos):
+    """
+    Pack one trace into out, starting at pos. Returns the new pos.
+    First sample as 2 bytes, then per block: 1 byte bit width w, and the
+    zigzag-encoded deltas, w bits each, little-endian bit order.
+    """
+    n = x.size
+    out[pos] = x[0] & 0xFF
+    out[pos+1] = x[0] >> 8
+    pos += 2
+    for b0 in range(1, n, CODEC_BLOCK):
+        b1 = b0 + CODEC_BLOCK
+        if b1 > n: # (min is shadowed in this module)
+            b1 = n
+        m = 0
+        for i in range(b0, b1):
+            d = np.int64(x[i]) - np.int64(x[i-1])
+            z = (d << 1) ^ (d >> 63)
+            if z > m:
+                m = z
+        w = 0
+        while (m >> w) > 0:
+            w += 1
+        out[pos] = w
+        pos += 1
+        acc = np.int64(0)
+        n_bits = 0
+        for i in range(b0, b1):
+            d = np.int64(x[i]) - np.int64(x[i-1])
+            z = (d << 1) ^ (d >> 63)
+            acc |= z << n_bits
+            n_bits += w
+            while n_bits >= 8:
+                out[pos] = acc & 0xFF
+                pos += 1
+                acc >>= 8
+                n_bits -= 8
+        if n_bits > 0:
+            out[pos] = acc & 0xFF
+            pos += 1
+    return pos
+
+@njit
+def _unpack_trace(buf, pos, x):
+    """
+    Inverse of _pack_trace. Fills x, returns the new pos.
+    """
+    n = x.size
+    prev = np.int64(buf[pos]) | (np.int64(buf[pos+1]) << 8)
+    x[0] = prev
+    pos += 2
+    for b0 in range(1, n, CODEC_BLOCK):
+        b1 = b0 + CODEC_BLOCK
+        if b1 > n: # (min is shadowed in this module)
+            b1 = n
+        w = np.int64(buf[pos])
+        pos += 1
+        mask = (np.int64(1) << w) - 1
+        acc = np.int64(0)
+        n_bits = 0
+        for i in range(b0, b1):
+            while n_bits < w:
+                acc |= np.int64(buf[pos]) << n_bits
+                pos += 1
+                n_bits += 8
+            z = acc & mask
+            acc >>= w
+            n_bits -= w
+            prev += (z >> 1) ^ -(z & 1)
+            x[i] = prev
+    return pos
+
+@cc.export('pack_events_u2', 'i8(u2[:,:,:], u1[:], i8[:])')
+def pack_events_u2(adc, out, offsets):
+    """
+    Pack (event, channel, sample) traces. Event i is out[offsets[i]:offsets[i+1]],
+    starting with n_ch and n_samples (2 bytes each).
+
+    Args:
+        adc: 3d array of uint16
+        out: 1d uint8 buffer, large enough (see waveform_codec.max_packed_size)
+        offsets: 1d int64 array of size n_events+1, filled here
+
+    Returns:
+        total number of bytes used in out
+    """
+    n_evts, n_ch, n_samples = adc.shape
+    pos = 0
+    offsets[0] = 0
+    for e in range(n_evts):
+        out[pos] = n_ch & 0xFF
+        out[pos+1] = n_ch >> 8
+        out[pos+2] = n_samples & 0xFF
+        out[pos+3] = n_samples >> 8
+        pos += 4
+        for c in range(n_ch):
+            pos = _pack_trace(adc[e, c], out, pos)
+        offsets[e+1] = pos
+    return pos
+
+@cc.export('unpack_events_u2', 'i8(u1[:], i8[:], u2[:,:,:])')
+def unpack_events_u2(buf, offsets, adc):
+    """
+    Inverse of pack_events_u2. adc must have the (event, channel, sample)
+    shape given in the event headers.
+
+    Returns:
+        number of events unpacked
+    """
+    n_evts, n_ch, n_samples = adc.shape
+    for e in range(n_evts):
+        pos = offsets[e] + 4
+        for c in range(n_ch):
+            pos = _unpack_trace(buf, pos, adc[e, c])
+    return n_evts
+
 if __name__ == "__main__":
     cc.compile()
@@ -4,7 +4,7 @@ import matplotlib.pyplot as plt
 from scipy.signal import find_peaks
 import os
 import sys
-from waveform import Waveform
+from waveform import Waveform, get_numba_kernels
 from yaml_reader import YamlReader, SAMPLE_TO_NS, MY_QUANTILES
 sys.path.append(os.environ['LIB_DIR'])
 from utilities import generate_colormap, digitial_butter_highpass_filter
@@ -28,6 +28,7 @@ class PulseFinder():
             wfm (Waveform): waveform by Waveform class
         """
         self.cfg = cfg
+        self.nb = get_numba_kernels(cfg.precision) # kernels of the configured float precision
         self.reset()
 
     def reset(self):
@@ -134,10 +135,15 @@ class PulseFinder():
                 continue
             if 'sum_row' in ch:
                 continue
+            if ch in self.cfg.channel_groups: # user-defined sums, not used for pulses
+                continue
             a = self.wfm.amp_pe[ch]
-            qx = util_nb.quantile_f8(a[0:150], MY_QUANTILES)
-            std = abs(qx[2]-qx[0])
-            med = qx[1]
+            if self.cfg.baseline_method=='pretrigger':
+                med = self.wfm.flat_base_pe[ch] # pre-trigger window, see Waveform.sum_channels
+            else:
+                qx = self.nb.quantile_f8(a[0:150], MY_QUANTILES)
+                std = abs(qx[2]-qx[0])
+                med = qx[1]
             self.base_med_pe[ch] = med
             peaks, prop = find_peaks(a,
                 distance=pars.distance,
@@ -211,7 +217,7 @@ class PulseFinder():
                 a_int = self.wfm.amp_pe_int[ch]
                 area_pe[ch] = a_int[end]-a_int[start]
                 # height_pe[ch] = np.max(a[start:end])
-                height_pe[ch] = util_nb.max(a[start:end])
+                height_pe[ch] = self.nb.max(a[start:end])
             self.height_ch_pe.append(height_pe)
             self.area_ch_pe.append(area_pe)
 
@@ -298,37 +304,37 @@ class PulseFinder():
             self.area_col8_pe.append(a_col8_int[end]-a_col8_int[start])
             
             self.area_user_pe.append(a_user_int[end]-a_user_int[start])
-            self.aft10_sum_ns.append(util_nb.aft(t_ax[start:end], a_sum_int[start:end], 0.1))
-            self.aft10_bot_ns.append(util_nb.aft(t_ax[start:end], a_bot_int[start:end], 0.1))
-            self.aft10_side_ns.append(util_nb.aft(t_ax[start:end], a_side_int[start:end], 0.1))
+            self.aft10_sum_ns.append(self.nb.aft(t_ax[start:end], a_sum_int[start:end], 0.1))
+            self.aft10_bot_ns.append(self.nb.aft(t_ax[start:end], a_bot_int[start:end], 0.1))
+            self.aft10_side_ns.append(self.nb.aft(t_ax[start:end], a_side_int[start:end], 0.1))
             
-            self.aft10_row1_ns.append(util_nb.aft(t_ax[start:end], a_row1_int[start:end], 0.1))
-            self.aft10_row2_ns.append(util_nb.aft(t_ax[start:end], a_row2_int[start:end], 0.1))
-            self.aft10_row3_ns.append(util_nb.aft(t_ax[start:end], a_row3_int[start:end], 0.1))
-            self.aft10_row4_ns.append(util_nb.aft(t_ax[start:end], a_row4_int[start:end], 0.1))
-            self.aft10_row5_ns.append(util_nb.aft(t_ax[start:end], a_row5_int[start:end], 0.1))
-            self.aft10_row6_ns.append(util_nb.aft(t_ax[start:end], a_row6_int[start:end], 0.1))
-            self.aft10_row7_ns.append(util_nb.aft(t_ax[start:end], a_row7_int[start:end], 0.1))
+            self.aft10_row1_ns.append(self.nb.aft(t_ax[start:end], a_row1_int[start:end], 0.1))
+            self.aft10_row2_ns.append(self.nb.aft(t_ax[start:end], a_row2_int[start:end], 0.1))
+            self.aft10_row3_ns.append(self.nb.aft(t_ax[start:end], a_row3_int[start:end], 0.1))
+            self.aft10_row4_ns.append(self.nb.aft(t_ax[start:end], a_row4_int[start:end], 0.1))
+            self.aft10_row5_ns.append(self.nb.aft(t_ax[start:end], a_row5_int[start:end], 0.1))
+            self.aft10_row6_ns.append(self.nb.aft(t_ax[start:end], a_row6_int[start:end], 0.1))
+            self.aft10_row7_ns.append(self.nb.aft(t_ax[start:end], a_row7_int[start:end], 0.1))
             
-            self.aft90_sum_ns.append(util_nb.aft(t_ax[start:end], a_sum_int[start:end], 0.9))
-            self.aft90_bot_ns.append(util_nb.aft(t_ax[start:end], a_bot_int[start:end], 0.9))
-            self.aft90_side_ns.append(util_nb.aft(t_ax[start:end], a_side_int[start:end], 0.9))
+            self.aft90_sum_ns.append(self.nb.aft(t_ax[start:end], a_sum_int[start:end], 0.9))
+            self.aft90_bot_ns.append(self.nb.aft(t_ax[start:end], a_bot_int[start:end], 0.9))
+            self.aft90_side_ns.append(self.nb.aft(t_ax[start:end], a_side_int[start:end], 0.9))
             
-            self.aft90_row1_ns.append(util_nb.aft(t_ax[start:end], a_row1_int[start:end], 0.9))
-            self.aft90_row2_ns.append(util_nb.aft(t_ax[start:end], a_row2_int[start:end], 0.9))
-            self.aft90_row3_ns.append(util_nb.aft(t_ax[start:end], a_row3_int[start:end], 0.9))
-            self.aft90_row4_ns.append(util_nb.aft(t_ax[start:end], a_row4_int[start:end], 0.9))
-            self.aft90_row5_ns.append(util_nb.aft(t_ax[start:end], a_row5_int[start:end], 0.9))
-            self.aft90_row6_ns.append(util_nb.aft(t_ax[start:end], a_row6_int[start:end], 0.9))
-            self.aft90_row7_ns.append(util_nb.aft(t_ax[start:end], a_row7_int[start:end], 0.9))
+            self.aft90_row1_ns.append(self.nb.aft(t_ax[start:end], a_row1_int[start:end], 0.9))
+            self.aft90_row2_ns.append(self.nb.aft(t_ax[start:end], a_row2_int[start:end], 0.9))
+            self.aft90_row3_ns.append(self.nb.aft(t_ax[start:end], a_row3_int[start:end], 0.9))
+            self.aft90_row4_ns.append(self.nb.aft(t_ax[start:end], a_row4_int[start:end], 0.9))
+            self.aft90_row5_ns.append(self.nb.aft(t_ax[start:end], a_row5_int[start:end], 0.9))
+            self.aft90_row6_ns.append(self.nb.aft(t_ax[start:end], a_row6_int[start:end], 0.9))
+            self.aft90_row7_ns.append(self.nb.aft(t_ax[start:end], a_row7_int[start:end], 0.9))
             
             # print('debug: ', t_ax[start:end], a_sum[start:end], a_bot[start:end], a_side[start:end])
-            self.rise_sum_ns.append(util_nb.rise_time(t_ax[start:end], a_sum[start:end], spe_thr))
-            self.rise_bot_ns.append(util_nb.rise_time(t_ax[start:end], a_bot[start:end], spe_thr))
-            self.rise_side_ns.append(util_nb.rise_time(t_ax[start:end], a_side[start:end], spe_thr))
-            self.fall_sum_ns.append(util_nb.fall_time(t_ax[start:end], a_sum[start:end], spe_thr))
-            self.fall_bot_ns.append(util_nb.fall_time(t_ax[start:end], a_bot[start:end], spe_thr))
-            self.fall_side_ns.append(util_nb.fall_time(t_ax[start:end], a_side[start:end], spe_thr))
+            self.rise_sum_ns.append(self.nb.rise_time(t_ax[start:end], a_sum[start:end], spe_thr))
+            self.rise_bot_ns.append(self.nb.rise_time(t_ax[start:end], a_bot[start:end], spe_thr))
+            self.rise_side_ns.append(self.nb.rise_time(t_ax[start:end], a_side[start:end], spe_thr))
+            self.fall_sum_ns.append(self.nb.fall_time(t_ax[start:end], a_sum[start:end], spe_thr))
+            self.fall_bot_ns.append(self.nb.fall_time(t_ax[start:end], a_bot[start:end], spe_thr))
+            self.fall_side_ns.append(self.nb.fall_time(t_ax[start:end], a_side[start:end], spe_thr))
             end_fp40 = min(start+20, end);
             end_fp30 = min(start+15, end);
             end_fp20 = min(start+10, end);
@@ -344,9 +350,9 @@ class PulseFinder():
             # self.height_sum_pe.append(np.max(a_sum[start:end]))
             # self.height_bot_pe.append(np.max(a_bot[start:end]))
             # self.height_side_pe.append(np.max(a_side[start:end]))
-            self.height_sum_pe.append(util_nb.max(a_sum[start:end]))
-            self.height_bot_pe.append(util_nb.max(a_bot[start:end]))
-            self.height_side_pe.append(util_nb.max(a_side[start:end]))
+            self.height_sum_pe.append(self.nb.max(a_sum[start:end]))
+            self.height_bot_pe.append(self.nb.max(a_bot[start:end]))
+            self.height_side_pe.append(self.nb.max(a_side[start:end]))
             self.ptime_ns.append( (argmax(a_sum[start:end])+start)*SAMPLE_TO_NS )
             sba = (self.area_side_pe[-1]-self.area_bot_pe[-1])/self.area_sum_pe[-1]
             self.sba.append( sba ) # side-to-bottom asymmetry
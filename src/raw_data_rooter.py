@@ -19,15 +19,22 @@ Notes:
 
 import argparse
 import sys
+import queue
+import threading
+import time
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from numpy import array, isscalar, zeros, uint32, uint16, uint64
 import numpy as np
 from os import path
-from enum import Enum
-import re
 import awkward as ak
 from os.path import splitext
 import uproot
 from caen_reader import RawDataFile
+from event_builder import EventBuilder, IntervalIdSet, ch_name_to_id
+from utilities import get_compression
+from raw_h5 import RawH5Writer
 
 #-----------------------------------
 # Global Parameters are Captialized
@@ -37,9 +44,18 @@ DAQ_SOFTWARE = "ToolDaq" # the other option is LabVIEW, but we don't use LabView
 MAX_N_TRIGGERS = 999999 # Arbitary large. Larger than n_triggers in raw binary file.
 DUMP_SIZE = 3000 # number of triggers to accumulate in queue before dump
 INITIAL_BASKET_CAPACITY=1000 # number of basket per file
-MAX_EVENT_QUEUE = 10000 # throw warning if event queue is getting too big. No action yet.
+COMPRESSION='ZLIB' # ZLIB, LZ4, ZSTD, LZMA or None. uproot's default is ZLIB level 1. Measure with tools/compression_benchmark.py
+COMPRESSION_LEVEL=1
+BASKET_BYTES=0 # target (uncompressed) bytes per basket of each adc branch. 0: DUMP_SIZE triggers per basket
+EVENT_QUEUE_MARGIN = 1000 # events kept in the queue on top of one chunk, for triggers arriving out of order. Incomplete events older than that are dropped with a warning.
 ETTT_FLAG=True # False: use the default 32-bit time counter; True: use extended trigger time tag (ETTT) which is is a 48-bit time counter. 
 VERBOSITY=0 # Integer. 0 is quiet mode (less print out). Higher is more. 
+ZERO_COPY=True # True: traces are views into the memory-mapped binary file (less allocation, lower RSS)
+PIPELINE_QUEUE_SIZE=4 # --pipeline only: max number of chunks/baskets waiting between two stages
+OUTPUT_FORMAT='root' # 'root' or 'h5' (HDF5, needs h5py; see raw_h5.py)
+ADC_CODEC=None # None, or 'delta': lossless delta/zigzag/bit-packing of the traces into a jagged uint8 branch adc_packed (see waveform_codec.py; needs the numba library)
+BRANCH_LAYOUT='channel' # 'channel': one adc_bX_chY branch per channel; 'matrix': a single 2-D branch adc[n_ch][n_samples], channels ordered as active_ch_id
+CHECKPOINT_EVERY=10 # save a checkpoint (<output>.ckpt.npz) every N dumps, to continue with --resume after a crash. 0: no checkpoint
 
 if DUMP_SIZE<=10:
     print("Info: write small baskets is not recommended by Jim \
@@ -47,11 +63,6 @@ if DUMP_SIZE<=10:
     100 kb/basket/branch. See: \
     https://github.com/scikit-hep/uproot4/pull/428")
 
-class RunStatus(Enum):
-    NORMAL = 0 # all good, keep going
-    STOP = 1 # stop the run
-    SKIP = 2 # bad, better skip to next
-
 class RawDataRooter():
     """
     Convert BNL raw data collected by V1730 from binary to root
@@ -66,30 +77,66 @@ class RawDataRooter():
         self.args = args # save a copy
         self.start_id = int(args.start_id)
         self.end_id = int(args.end_id)
-        self.raw_data_file = RawDataFile(args.if_path, n_boards=N_BOARDS, ETTT_flag=ETTT_FLAG, DAQ_Software=DAQ_SOFTWARE)
+        self.raw_data_file = RawDataFile(args.if_path, n_boards=N_BOARDS, ETTT_flag=ETTT_FLAG, DAQ_Software=DAQ_SOFTWARE, zero_copy=ZERO_COPY)
         self.raw_data_file.verbosity=VERBOSITY
+        self.output_format = getattr(args, 'format', OUTPUT_FORMAT)
+        of_ext = '.h5' if self.output_format=='h5' else '.root'
         if args.output_dir=="":
             if args.if_path[-4:]=='.bin':
-                self.of_path = args.if_path[:-4] +'.root'
+                self.of_path = args.if_path[:-4] + of_ext
             else:
-                self.of_path = args.if_path +'.root'
+                self.of_path = args.if_path + of_ext
         else:
             fname = path.basename( args.if_path)
             if fname[-4:]=='.bin':
-                self.of_path = args.output_dir + '/' + fname[:-4] + '.root'
+                self.of_path = args.output_dir + '/' + fname[:-4] + of_ext
             else:
-                self.of_path = args.output_dir + '/' + fname + '.root'
+                self.of_path = args.output_dir + '/' + fname + of_ext
 
         # useful variables
-        self.n_trg_read = 0 # number of trigger read from binary (updated in next())
-        self.read_event_id = set() # keep a record of event id read in (updated in next())
-        self.dumped_event_id = set() # keep a record of event id dumpped
+        self.n_trg_read = 0 # number of trigger read from binary (updated in fill_chunk())
+        self.read_event_id = IntervalIdSet() # keep a record of event id read in (updated in fill_chunk())
+        self.dumped_event_id = IntervalIdSet() # keep a record of event id dumpped
+        self.n_trg_shown = 0 # n_trg_read at the last show_progress()
         self.tot_n_evt_proc = 0 # number of good events saved (updated after dump)
         self.dump_counter = 0 # number of dumps
+        self.n_entries = 0 # number of entries written to daq tree
+        self.n_baskets = 0 # number of baskets made (written, or queued for writing)
+        self.reader_state = None # binary file position after the last chunk filled, see get_reader_state()
+        self.ckpt_path = self.of_path + '.ckpt.npz'
+        self.layout = getattr(args, 'layout', BRANCH_LAYOUT)
+        self.basket_buffers = [] # preallocated baskets, reused in turn by the dumps
+        self.n_basket_buffers = 1 # >1 when baskets are still queued for writing while the next one is filled
+        self.i_basket_buffer = 0
+        self.big_endian_basket = True # uproot writes big-endian; set False to get native arrays (ex. for awkward)
+        self.adc_codec = getattr(args, 'codec', ADC_CODEC)
+        if self.adc_codec in ['none', 'None']:
+            self.adc_codec = None
+        if self.output_format=='h5':
+            # one (event, ch, sample) dataset, native byte order
+            self.layout = 'matrix'
+            self.big_endian_basket = False
+            if self.adc_codec is not None:
+                print("WARNING: adc codec is not supported by the h5 output. Ignore it.")
+                self.adc_codec = None
+        if self.adc_codec=='delta':
+            import waveform_codec # needs the numba library (build.sh)
+            self.codec = waveform_codec
+            # packed from the (event, ch, sample) traces, native byte order
+            self.layout = 'matrix'
+            self.big_endian_basket = False
+        elif self.adc_codec is not None:
+            sys.exit('Sorry, unknown adc codec: %s' % self.adc_codec)
+        self.compression = getattr(args, 'compression', COMPRESSION)
+        self.compression_level = getattr(args, 'compression_level', COMPRESSION_LEVEL)
+        self.basket_bytes = getattr(args, 'basket_bytes', BASKET_BYTES)
 
         # self.sanity_check()
         self.preview_file()
+        self.dump_size = self.get_dump_size()
         self.reset_event_queue()
+        if self.start_id>0:
+            self.seek_start_id()
 
     def sanity_check(self):
         '''
@@ -140,6 +187,7 @@ class RawDataRooter():
             sys.exit("Something wrong. All channels of any triggers must have the same n_samples.")
         else:
             self.n_samples = n_samples.pop()
+        self.ch_names = sorted(self.ch_names, key=ch_name_to_id)
 
         print("Info: current active channels are:")
         print(self.ch_names)
@@ -150,158 +198,531 @@ class RawDataRooter():
         raw_data_file.close()
         return None
 
-    def next(self):
+    def seek_start_id(self):
+        """
+        Jump to the first trigger with event_id >= start_id using the header-only
+        trigger index, instead of decoding and skipping every trigger before it.
+        """
+        index = self.raw_data_file.load_index()
+        msk = index['eventCounter']>=self.start_id
+        if np.any(msk):
+            self.raw_data_file.seek_trigger(int(np.argmax(msk)))
+        return None
+
+    def iter_chunks(self, n=DUMP_SIZE, n_workers=1):
+        '''
+        Iterate over the binary file, n triggers at a time (see
+        RawDataFile.read_triggers). With n_workers>1, the file is split at
+        trigger boundaries found by the header index, and the chunks are decoded
+        in a process pool. Chunks are yielded in file order either way, and the
+        TTT rollover is corrected here, in file order.
+
+        Yields:
+            TriggerBatch
         '''
-        Iterate one trigger at a time. Careful check condition.
-        If all good, fill event_queue.
+        if n_workers<=1:
+            while True:
+                batch = self.raw_data_file.read_triggers(n)
+                if batch is None:
+                    break
+                batch.reader_state = self.get_reader_state(self.raw_data_file.file.tell())
+                yield batch
+        else:
+            start_pos = self.raw_data_file.file.tell()
+            index = self.raw_data_file.load_index()
+            index = index[index['offset'] >= start_pos]
+            tasks = [(int(index['offset'][i]), n, int(index['eventCounter'][i])) for i in range(0, len(index), n)]
+            # byte offset following each chunk
+            next_pos = [task[0] for task in tasks[1:]] + [path.getsize(self.args.if_path)]
+            # the workers count their resyncs in their own process: count the
+            # bytes between consecutive triggers of the index instead
+            offset = index['offset'].astype(np.int64)
+            ends = np.r_[start_pos, offset[:-1] + index['size'][:-1].astype(np.int64)]
+            n_skipped = self.raw_data_file.n_bytes_skipped + np.cumsum(offset - ends)
+            # bytes skipped up to the last trigger of each chunk
+            chunk_skipped = [int(n_skipped[min(i+n, len(index))-1]) for i in range(0, len(index), n)]
+            with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(self.args.if_path,)) as pool:
+                # keep a bounded number of chunks in flight
+                pending = deque()
+                for k, task in enumerate(tasks):
+                    pending.append((k, pool.submit(_decode_chunk, task)))
+                    if len(pending) >= 2*n_workers:
+                        k, future = pending.popleft()
+                        yield self._correct_rollover(future.result(), next_pos[k], chunk_skipped[k])
+                while pending:
+                    k, future = pending.popleft()
+                    yield self._correct_rollover(future.result(), next_pos[k], chunk_skipped[k])
+        print("Info: End of file. Close!")
+        self.raw_data_file.close()
+        return None
+
+    def _correct_rollover(self, batch, next_pos, n_bytes_skipped):
+        """
+        Correct the TTT rollover of a chunk decoded by a worker, and update the
+        count of bytes skipped by resync. Must be called on chunks in file
+        order.
+
+        Args:
+            batch (TriggerBatch): from _decode_chunk
+            next_pos (int): byte offset following the chunk
+            n_bytes_skipped (int): bytes skipped from the start of the file to
+                the end of the chunk
+        """
+        for boardId in np.unique(batch.boardId):
+            sel = np.flatnonzero(batch.boardId==boardId)
+            batch.triggerTimeTag[sel] = self.raw_data_file.correct_ttt_rollover(int(boardId), batch.ttt[sel])
+        self.raw_data_file.n_bytes_skipped = n_bytes_skipped
+        batch.reader_state = self.get_reader_state(next_pos)
+        return batch
+
+    def get_reader_state(self, pos):
+        """
+        State of the binary reader to restart from byte offset pos: event
+        counter and TTT rollover correction. Taken when a chunk is read, since
+        the reader may run ahead of the event builder (--pipeline).
 
         Returns:
-            RunStatus: NORMAL, SKIP, STOP
+            dict of arrays
+        """
+        rdf = self.raw_data_file
+        boards = sorted(rdf.oldTimeTag)
+        return {
+            'reader_pos': np.array(pos, dtype=np.int64),
+            'reader_event_counter': np.array(rdf.event_counter, dtype=np.int64),
+            'reader_n_bytes_skipped': np.array(rdf.n_bytes_skipped, dtype=np.int64),
+            'reader_boards': np.array(boards, dtype=np.int64),
+            'reader_old_ttt': np.array([rdf.oldTimeTag[b] for b in boards], dtype=uint64),
+            'reader_ttt_rollover': np.array([rdf.timeTagRollover[b] for b in boards], dtype=np.int64),
+        }
+
+    def fill_chunk(self, batch):
         '''
-        trg = self.raw_data_file.getNextTrigger()
-        if trg is None: # end of file?
-            print("Info: End of file. Close!")
-            self.raw_data_file.close()
-            return RunStatus.STOP
+        Fill event_queue with a chunk of triggers. Only triggers within
+        [start_id, end_id) and not yet dumped are kept. The block of each board
+        goes into the queue at once (EventBuilder.add_block), where triggers
+        from different boards are merged by event counter.
 
+        Args:
+            batch (TriggerBatch): from RawDataFile.read_triggers
+        '''
         # only process within [start_id, end_id)
-        trg_id = trg.eventCounter
-        if trg_id<self.start_id or trg_id>=self.end_id:
-            self.skipped_event_id = trg_id
-            return RunStatus.SKIP
-        self.n_trg_read +=1
-        self.read_event_id.add(trg_id)
-
+        trg_id = batch.eventCounter
+        in_range = (trg_id>=self.start_id) & (trg_id<self.end_id)
+        n_skip = len(batch) - int(np.sum(in_range))
+        if n_skip>0:
+            self.skipped_event_id = int(trg_id[~in_range][-1])
+        self.read_event_id.update(trg_id[in_range])
+        self.reader_state = batch.reader_state
+        self.n_trg_read += int(np.sum(in_range))
         # duplicated trigger appearing after event dumped to file
-        if trg_id in self.dumped_event_id:
-            self.skipped_event_id = trg_id
-            return RunStatus.SKIP
-
-        # add to event queue
-        status =  self.fill_event_queue(trg)
-        return status
+        dumped = in_range & self.dumped_event_id.isin(trg_id)
+        if np.any(dumped):
+            self.skipped_event_id = int(trg_id[dumped][-1])
+            n_skip += int(np.sum(dumped))
+        keep = in_range & ~dumped
+        for boardId in np.unique(batch.boardId[keep]).tolist():
+            sel = np.flatnonzero(keep & (batch.boardId==boardId))
+            added = self.event_queue.add_block(boardId, trg_id[sel], batch.traces[boardId][batch.row[sel]],
+                batch.triggerTimeTag[sel], batch.sanity[sel], batch.channels[boardId])
+            if not np.all(added):
+                self.skipped_event_id = int(trg_id[sel][~added][-1])
+                n_skip += int(np.sum(~added))
+        if n_skip>0:
+            print('SKIP: %d triggers in this chunk, last skipped event_id %d' % (n_skip, self.skipped_event_id))
+        return None
 
-    def create_output_file(self):
+    def get_dump_size(self):
+        """
+        Number of triggers read per chunk (dumped as one basket). DUMP_SIZE,
+        or, if basket_bytes is set, the number of triggers giving baskets of
+        about basket_bytes per adc branch.
+        """
+        if not self.basket_bytes:
+            return DUMP_SIZE
+        bytes_per_event = self.n_samples*2 # uint16
+        if self.layout=='matrix':
+            bytes_per_event *= len(self.ch_names)
+        n_evts = max(int(self.basket_bytes)//bytes_per_event, 1)
+        return n_evts*N_BOARDS
+
+    def create_output_file(self, resume_entries=None):
         """
         Create output file
+
+        Args:
+            resume_entries: h5 only. Reopen the existing file and keep its
+                first resume_entries events (see resume)
         """
         _, f_ext = splitext(self.of_path)
         if f_ext=='.root':
 
-            self.file = uproot.recreate(self.of_path)
+            self.file = uproot.recreate(self.of_path, compression=get_compression(self.compression, self.compression_level))
 
             # dummy channels traces
             ch_names = list(self.ch_names)
-            ch_var = zeros([DUMP_SIZE//N_BOARDS, self.n_samples], dtype=uint16) # dummy var, data structure
             vars_type = {}
-            for ch in ch_names:
-                b_name = 'adc_' + ch # branch name
-                vars_type[b_name] = ak.Array(ch_var).type
+            if self.adc_codec is not None:
+                vars_type[self.codec.PACKED_BRANCH] = self.codec.to_awkward(zeros(4, dtype=np.uint8), array([0, 4])).type
+            elif self.layout=='matrix':
+                ch_var = zeros([1, len(ch_names), self.n_samples], dtype=uint16) # dummy var, data structure
+                vars_type['adc'] = ak.Array(ch_var).type
+            elif self.layout=='channel':
+                ch_var = zeros([1, self.n_samples], dtype=uint16) # dummy var, data structure
+                for ch in ch_names:
+                    b_name = 'adc_' + ch # branch name
+                    vars_type[b_name] = ak.Array(ch_var).type
+            else:
+                sys.exit('Sorry, unknown branch layout: %s' % self.layout)
             vars_type['event_id'] = uint32
             vars_type['event_ttt'] = uint64
             vars_type['event_sanity'] = uint16
+            self.daq_branches = list(vars_type)
 
             # make tree
             self.file.mktree("daq", vars_type,
             initial_basket_capacity=INITIAL_BASKET_CAPACITY)
+            # event_id -> entry in daq, for random access (see event_index.py)
+            self.file.mktree("event_index", {'event_id': uint32, 'entry': uint64, 'event_ttt': uint64},
+            initial_basket_capacity=INITIAL_BASKET_CAPACITY)
             # self.file['daq'].show()
+        elif f_ext=='.h5':
+            ch_id = [ch_name_to_id(ch) for ch in self.ch_names]
+            self.file = RawH5Writer(self.of_path, ch_id, self.n_samples, self.compression, self.compression_level, resume_entries)
         else:
             sys.exit('Sorry, requested output file format is not yet implmented.')
         return None
 
     def reset_event_queue(self):
         """
-        Reset the event queue.
+        Reset the event queue. Its buffer holds one chunk of events plus
+        EVENT_QUEUE_MARGIN, since complete events are dumped after each chunk.
         """
-        self.event_queue = {}
+        capacity = self.dump_size//N_BOARDS + EVENT_QUEUE_MARGIN
+        self.event_queue = EventBuilder(self.ch_names, self.boardId, self.n_samples, capacity=capacity)
         return None
 
-    def fill_event_queue(self, trg):
+    def get_basket_buffer(self, n_evts):
         """
-        Fill event queue, one trigger at a time.
-        Add TTT to the queue as well. If N_BOARDS>1, use board 1 as event ttt.
-        event_sanity is added to flag bad events saved to binary file.
-        event_sanity = 10^(boardId-1) + trigger_sanity.
-
-        Examples:
-            event_sanity = 0 means all good.
-            event_sanity = 100 means boardId=3 has sanity=1. other boards are 0.
-
-        Args:
-            trg (RawTrigger): RawTrigger class object from caen_reader module
+        Preallocated basket arrays with room for at least n_evts events. Grown
+        only when needed, and reused otherwise. The n_basket_buffers buffers
+        are handed out in turn.
+
+        The arrays are big-endian (if big_endian_basket), which is what uproot
+        writes, so they are passed through without conversion. In the channel layout, adc is a
+        (event, ch, sample) view of a channel-major array, so that each
+        channel's branch is a contiguous block.
         """
-        boardId = trg.boardId
-        trg_id = trg.eventCounter
-        if trg_id in self.event_queue:
-            for ch, val in trg.traces.items():
-                if ch in self.event_queue[trg_id]:
-                    # duplicated, send warning
-                    print("WARNING: duplicated trigger ???")
-                    self.skipped_event_id = trg_id
-                    return RunStatus.SKIP
-                else:
-                    self.event_queue[trg_id][ch] = val
-            self.event_queue[trg_id]['sanity'] += 10**(boardId-1) * trg.sanity
+        i = self.i_basket_buffer % self.n_basket_buffers
+        self.i_basket_buffer += 1
+        if i >= len(self.basket_buffers):
+            self.basket_buffers.append(None)
+        buf = self.basket_buffers[i]
+        if buf is not None and len(buf['event_id'])>=n_evts:
+            return buf
+        n_evts = max(n_evts, self.dump_size//N_BOARDS)
+        n_ch = len(self.ch_names)
+        bo = '>' if self.big_endian_basket else '='
+        if self.layout=='matrix':
+            adc = np.empty([n_evts, n_ch, self.n_samples], dtype=bo+'u2')
         else:
-            self.event_queue[trg_id] = trg.traces
-            self.event_queue[trg_id]['sanity'] = 10**(boardId-1) * trg.sanity
+            adc = np.empty([n_ch, n_evts, self.n_samples], dtype=bo+'u2').transpose(1, 0, 2)
+        self.basket_buffers[i] = {
+            'adc': adc,
+            'event_id': np.empty(n_evts, dtype=bo+'u4'),
+            'event_ttt': np.empty(n_evts, dtype=bo+'u8'),
+            'event_sanity': np.empty(n_evts, dtype=bo+'u2'),
+        }
+        return self.basket_buffers[i]
+
+    def make_basket(self):
+        """
+        Take fully filled events out of the queue and put them in a basket.
 
-        # add ttt to the queue
-        ttt = trg.triggerTimeTag
-        if boardId == min(self.boardId):
-            self.event_queue[trg_id]['ttt']=ttt
-        return RunStatus.NORMAL
+        Returns:
+            dict: branch name -> array, ready for write_basket. None if no
+            event is complete.
+        """
+        # get complete events from queue
+        n_ready = self.event_queue.n_ready()
+        if n_ready==0:
+            return None
+        events = self.event_queue.pop_ready(out=self.get_basket_buffer(n_ready))
+        if events is None:
+            return None
+
+        # create a basket
+        basket = {}
+        if self.layout=='matrix':
+            basket['adc'] = events['adc']
+        else:
+            for i, ch in enumerate(self.event_queue.ch_names):
+                b_name = 'adc_' + ch
+                basket[b_name] = events['adc'][:, i, :]
+        basket['event_id'] = events['event_id']
+        basket['event_ttt'] = events['event_ttt']
+        basket['event_sanity'] = events['event_sanity']
 
+        # keep a record of dumped event_id
+        self.dumped_event_id.update(events['event_id'])
+        self.tot_n_evt_proc = len(self.dumped_event_id)
+        self.n_baskets += 1
+        return basket
 
-    def get_full_queue_id(self):
+    def write_basket(self, basket):
         """
-        Return a set of event_id in queue that have all info filled
+        Write a basket to tree, and its event_id -> entry to event_index tree
         """
-        all_keys = self.ch_names.copy()
-        all_keys.add('ttt')
-        all_keys.add('sanity')
-        full_event_id = set()
-        for i, ev in self.event_queue.items():
-            if set(ev.keys()) == all_keys:
-                full_event_id.add(i)
-        return full_event_id
+        if self.output_format=='h5':
+            # event_id dataset is in entry order already, no index needed
+            self.file.extend(basket)
+            self.n_entries += len(basket['event_id'])
+            self.dump_counter += 1
+            return None
+        if self.adc_codec is not None:
+            basket = dict(basket)
+            content, offsets = self.codec.pack_events(basket.pop('adc'))
+            basket[self.codec.PACKED_BRANCH] = self.codec.to_awkward(content, offsets)
+        self.file["daq"].extend(basket)
+        n_evts = len(basket['event_id'])
+        self.file["event_index"].extend({
+            'event_id': basket['event_id'],
+            'entry': np.arange(self.n_entries, self.n_entries+n_evts, dtype=uint64),
+            'event_ttt': basket['event_ttt'],
+        })
+        self.n_entries += n_evts
+        # keep track of num. of dumps
+        self.dump_counter += 1
+        return None
 
     def dump_events(self):
         """
         Dump fully filled events from queue to tree
         """
-        # get rows from queue
-        id_set = self.get_full_queue_id()
-        n_evts = len(id_set)
+        basket = self.make_basket()
+        if basket is not None:
+            ckpt = self.get_checkpoint()
+            self.write_basket(basket)
+            self.save_checkpoint(ckpt)
+        return None
+
+    def get_checkpoint(self):
+        """
+        Snapshot of the conversion right after make_basket, every
+        CHECKPOINT_EVERY baskets: reader position of the last chunk filled,
+        counters, event id records and the incomplete events of the queue. It
+        is saved by save_checkpoint once its basket is written, so that the
+        output holds exactly the events dumped before the snapshot.
 
-        if n_evts==0:
+        Returns:
+            dict of arrays, or None if no checkpoint is due
+        """
+        if CHECKPOINT_EVERY<=0 or self.reader_state is None or self.n_baskets % CHECKPOINT_EVERY != 0:
             return None
-        # create a basket
-        basket = {}
-        for ch in self.ch_names:
-            b_name = 'adc_' + ch
-            basket[b_name] = zeros([n_evts, self.n_samples])
-        basket['event_id'] = zeros(n_evts, dtype=uint32)
-        basket['event_ttt'] = zeros(n_evts, dtype=uint64)
-        basket['event_sanity'] = zeros(n_evts, dtype=uint16)
-
-        # fill basket
-        for i, ID in enumerate(id_set):
-            ev = self.event_queue[ID]
-            basket['event_id'][i]=ID
-            basket['event_ttt'][i]=ev['ttt']
-            basket['event_sanity'][i]=ev['sanity']
-            for ch in self.ch_names:
-                b_name = 'adc_' + ch
-                basket[b_name][i] = ev[ch]
-        self.file["daq"].extend(basket)
-        # remove events from queue
-        for ID in id_set:
-            del self.event_queue[ID]
-            self.dumped_event_id.add(ID) # keep a record of deleted event_id
+        state = dict(self.reader_state)
+        state.update({
+            'if_path': np.array(path.abspath(self.args.if_path)),
+            'layout': np.array(self.layout),
+            'codec': np.array(str(self.adc_codec)),
+            'ch_id': np.array([ch_name_to_id(ch) for ch in self.ch_names]),
+            'n_samples': np.array(self.n_samples),
+            'n_entries': np.array(self.tot_n_evt_proc), # every dumped event is one entry
+            'n_baskets': np.array(self.n_baskets),
+            'n_trg_read': np.array(self.n_trg_read),
+            'read_event_id': self.read_event_id.get_state(),
+            'dumped_event_id': self.dumped_event_id.get_state(),
+        })
+        for key, val in self.event_queue.get_state().items():
+            state['queue_' + key] = val
+        return state
+
+    def save_checkpoint(self, state):
+        """
+        Flush the output file, then save a checkpoint from get_checkpoint. The
+        checkpoint file is replaced atomically, so the last one is always
+        consistent.
+        """
+        if state is None:
+            return None
+        if self.output_format=='h5':
+            self.file.file.flush()
+        else:
+            self.file.file.sink.flush()
+        tmp_path = self.ckpt_path[:-4] + '.tmp.npz'
+        np.savez(tmp_path, **state)
+        os.replace(tmp_path, self.ckpt_path)
+        return None
+
+    def remove_checkpoint(self):
+        """
+        Remove the checkpoint, and the old output left by a failed resume
+        """
+        for p in [self.ckpt_path, self.of_path + '.part']:
+            if path.exists(p):
+                os.remove(p)
+        return None
+
+    def resume(self):
+        """
+        Continue an interrupted conversion from its last checkpoint. The
+        events written before the checkpoint are kept (the root trees are
+        copied into a new file, since uproot cannot append to an existing
+        tree; h5 datasets are truncated), the event queue and counters are
+        restored, and the binary file is read from the checkpoint offset.
+
+        Returns:
+            bool: False if there is no checkpoint (start from the beginning)
+        """
+        if not path.exists(self.ckpt_path):
+            print("Info: no checkpoint %s, start from the beginning." % self.ckpt_path)
+            self.create_output_file()
+            return False
+        state = dict(np.load(self.ckpt_path))
+        ch_id = [ch_name_to_id(ch) for ch in self.ch_names]
+        if str(state['if_path'])!=path.abspath(self.args.if_path) or str(state['layout'])!=self.layout \
+            or str(state['codec'])!=str(self.adc_codec) or state['ch_id'].tolist()!=ch_id \
+            or int(state['n_samples'])!=self.n_samples:
+            sys.exit('Sorry, checkpoint %s was made with another input file or settings. Remove it to start over.' % self.ckpt_path)
+        n_entries = int(state['n_entries'])
+
+        if self.output_format=='h5':
+            self.create_output_file(resume_entries=n_entries)
+        else:
+            # a .part file left by a failed resume is the original output
+            old_path = self.of_path + '.part'
+            if not path.exists(old_path):
+                os.replace(self.of_path, old_path)
+            self.create_output_file()
+            step = max(self.dump_size//N_BOARDS, 1)
+            library = 'np' if self.adc_codec is None else 'ak' # adc_packed is jagged
+            with uproot.open(old_path) as old:
+                for tree, b_names in [('daq', self.daq_branches), ('event_index', ['event_id', 'entry', 'event_ttt'])]:
+                    for start in range(0, n_entries, step):
+                        data = old[tree].arrays(b_names, entry_start=start, entry_stop=min(start+step, n_entries), library=library)
+                        self.file[tree].extend({b: data[b] for b in b_names})
+            os.remove(old_path)
+
+        # reader
+        rdf = self.raw_data_file
+        rdf.file.seek(int(state['reader_pos']))
+        rdf.event_counter = int(state['reader_event_counter'])
+        rdf.n_bytes_skipped = int(state['reader_n_bytes_skipped'])
+        for b, old_ttt, n_rollover in zip(state['reader_boards'].tolist(), state['reader_old_ttt'], state['reader_ttt_rollover'].tolist()):
+            rdf.oldTimeTag[b] = uint64(old_ttt)
+            rdf.timeTagRollover[b] = n_rollover
+        # rooter and event queue
+        self.n_entries = n_entries
+        self.n_baskets = int(state['n_baskets'])
+        self.dump_counter = self.n_baskets
+        self.n_trg_read = int(state['n_trg_read'])
+        self.n_trg_shown = self.n_trg_read
+        self.read_event_id.set_state(state['read_event_id'])
+        self.dumped_event_id.set_state(state['dumped_event_id'])
         self.tot_n_evt_proc = len(self.dumped_event_id)
-        # keep track of num. of dumps
-        self.dump_counter += 1
+        self.event_queue.set_state({key[6:]: val for key, val in state.items() if key.startswith('queue_')})
+        print("Info: resume from checkpoint: %d events written, %d in queue, binary file at byte %d" % (n_entries, self.event_queue.n_queued, int(state['reader_pos'])))
+        return True
+
+    def run_pipeline(self, n_workers=1):
+        """
+        Convert the whole file with the three stages running concurrently:
+        reader (iter_chunks) -> event builder (fill_chunk, make_basket) ->
+        writer (write_basket). Stages hand over through queues of at most
+        PIPELINE_QUEUE_SIZE items, so throughput is set by the slowest stage.
+        The reader and the writer run in threads; uproot compression and numpy
+        copies release the GIL. With VERBOSITY>=1, prints the utilisation of each
+        stage at the end.
+
+        Args:
+            n_workers: number of processes decoding the binary file (see iter_chunks)
+        """
+        chunk_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+        basket_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+        # a basket can wait in basket_queue while the next ones are filled
+        self.n_basket_buffers = PIPELINE_QUEUE_SIZE + 2
+        stop = threading.Event()
+        busy = {'reader': 0., 'builder': 0., 'writer': 0.}
+        errors = []
+
+        def put(q, item):
+            # give up if another stage failed, instead of blocking forever
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def reader():
+            try:
+                chunks = self.iter_chunks(self.dump_size, n_workers)
+                while True:
+                    t0 = time.perf_counter()
+                    batch = next(chunks, None)
+                    busy['reader'] += time.perf_counter() - t0
+                    if batch is None or not put(chunk_queue, batch):
+                        break
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            put(chunk_queue, None)
+
+        def writer():
+            while True:
+                item = basket_queue.get()
+                if item is None:
+                    break
+                if stop.is_set():
+                    continue # drain
+                try:
+                    t0 = time.perf_counter()
+                    basket, ckpt = item
+                    self.write_basket(basket)
+                    self.save_checkpoint(ckpt)
+                    busy['writer'] += time.perf_counter() - t0
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+
+        t_start = time.perf_counter()
+        threads = [threading.Thread(target=reader, name='reader'), threading.Thread(target=writer, name='writer')]
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                batch = chunk_queue.get()
+                if batch is None:
+                    break
+                t0 = time.perf_counter()
+                self.fill_chunk(batch)
+                basket = self.make_basket()
+                # the checkpoint is saved by the writer, after its basket
+                ckpt = self.get_checkpoint() if basket is not None else None
+                busy['builder'] += time.perf_counter() - t0
+                if basket is not None and not put(basket_queue, (basket, ckpt)):
+                    break
+                self.show_progress()
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            # unblock the reader if it is waiting on a full queue, then stop the writer
+            while threads[0].is_alive():
+                try:
+                    chunk_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            basket_queue.put(None)
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0]
+
+        if VERBOSITY>=1:
+            wall = time.perf_counter() - t_start
+            print("Info: pipeline stage utilisation (busy time / wall time %.2f s):" % wall)
+            for name, t in busy.items():
+                print("    %-8s %6.2f s  %5.1f%%" % (name, t, 100*t/wall if wall>0 else 0))
         return None
 
     def dump_run_info(self):
@@ -310,16 +731,13 @@ class RawDataRooter():
         """
         # list of string cannot be saved to tree
         # ch_id = boardId * 100 + chID is int
-        ch_id = []
-        for ch in self.ch_names:
-            ch_str = re.findall(r'\d+', ch)
-            ch_id.append( int(ch_str[0])*100+int(ch_str[1]) )
+        ch_id = [ch_name_to_id(ch) for ch in self.ch_names]
         # uproot does not like [[1]] when saving, but [1] or [[1,2]] is okay
         if len(ch_id)==1:
             ch_id=ch_id[0]
 
-        if self.event_queue:
-            leftover_event_id = self.event_queue.keys()
+        if self.event_queue.n_queued>0:
+            leftover_event_id = self.event_queue.queued_event_id().tolist()
         else:
             leftover_event_id = -1
         data = {
@@ -330,7 +748,10 @@ class RawDataRooter():
             'leftover_event_id': [leftover_event_id]
 	}
         #print(data)
-        self.file['run_info'] = data
+        if self.output_format=='h5':
+            self.file.write_run_info(data)
+        else:
+            self.file['run_info'] = data
         return None
 
     def close_file(self):
@@ -347,14 +768,37 @@ class RawDataRooter():
         print("Num. of events processed:", self.tot_n_evt_proc)
         print("Num. of triggers read:", self.n_trg_read)
         print("Pass rate:", (self.tot_n_evt_proc*N_BOARDS)/self.n_trg_read)
+        print("Num. of bytes skipped (resync):", self.raw_data_file.n_bytes_skipped)
+        print("Num. of incomplete events dropped from queue:", self.event_queue.n_evicted)
         return None
 
     def show_progress(self):
-        if self.n_trg_read % DUMP_SIZE ==0:
+        # print once every DUMP_SIZE triggers, not once per chunk
+        if self.n_trg_read//DUMP_SIZE > self.n_trg_shown//DUMP_SIZE:
             tot_n_evt_proc = len(self.dumped_event_id)
             print('read %d th trggers,' % self.n_trg_read, " dumped %d events" % tot_n_evt_proc)
+        self.n_trg_shown = self.n_trg_read
         return None
 
+_worker_file = None # RawDataFile opened once per worker process
+
+def _init_worker(if_path):
+    global _worker_file
+    _worker_file = RawDataFile(if_path, n_boards=N_BOARDS, ETTT_flag=ETTT_FLAG, DAQ_Software=DAQ_SOFTWARE)
+    _worker_file.verbosity=VERBOSITY
+
+def _decode_chunk(task):
+    """
+    Decode one chunk of the binary file in a worker process.
+
+    Args:
+        task: (byte offset of the first trigger, n triggers, its event counter)
+    """
+    offset, n, event_counter = task
+    _worker_file.file.seek(offset)
+    _worker_file.event_counter = event_counter
+    return _worker_file.read_triggers(n, rollover=False)
+
 def main(argv):
     """
     Main function. Usage:
@@ -365,36 +809,39 @@ def main(argv):
     parser.add_argument('--start_id', type=int, default=0, help='Optional. start process from start_id (default: 0)')
     parser.add_argument('--end_id', type=int, default=MAX_N_TRIGGERS, help='Optional. stop process at end_id (defalt: Arbiarty large)')
     parser.add_argument('--output_dir', type=str, default="", help='Optional. output directory. Default: not specified. If not specified, use input binary file directory.' )
+    parser.add_argument('--workers', type=int, default=1, help='Optional. number of processes decoding the binary file in parallel (default: 1)')
+    parser.add_argument('--pipeline', action='store_true', help='Optional. run reader, event builder and writer concurrently')
+    parser.add_argument('--compression', type=str, default=COMPRESSION, help='Optional. compression codec: ZLIB, LZ4, ZSTD, LZMA, or None (default: %s)' % COMPRESSION)
+    parser.add_argument('--compression_level', type=int, default=COMPRESSION_LEVEL, help='Optional. compression level (default: %d)' % COMPRESSION_LEVEL)
+    parser.add_argument('--basket_bytes', type=int, default=BASKET_BYTES, help='Optional. target uncompressed bytes per basket of each adc branch. 0 means DUMP_SIZE triggers per basket (default: %d)' % BASKET_BYTES)
+    parser.add_argument('--format', type=str, default=OUTPUT_FORMAT, choices=['root', 'h5'], help='Optional. output file format. h5 writes a chunked (event, channel, sample) dataset, see raw_h5.py (default: %s)' % OUTPUT_FORMAT)
+    parser.add_argument('--codec', type=str, default=str(ADC_CODEC), choices=['None', 'delta'], help='Optional. delta: lossless delta/bit-packing of the traces, in the jagged uint8 branch adc_packed (default: %s)' % ADC_CODEC)
+    parser.add_argument('--resume', action='store_true', help='Optional. continue an interrupted conversion from its last checkpoint (<output>.ckpt.npz, every CHECKPOINT_EVERY dumps)')
+    parser.add_argument('--layout', type=str, default=BRANCH_LAYOUT, choices=['channel', 'matrix'], help='Optional. channel: one branch per channel; matrix: a single 2-D adc branch (default: %s)' % BRANCH_LAYOUT)
     required = parser.add_argument_group('Required Arguments')
     required.add_argument('-i', '--if_path', type=str, help='Required. full path to the raw data file', required=True)
     args = parser.parse_args()
 
     rooter = RawDataRooter(args)
-    rooter.create_output_file()
-    for i in range(MAX_N_TRIGGERS):
-        status = rooter.next()
-        if status==RunStatus.STOP:
-            if len(rooter.event_queue)>0:
-                rooter.dump_events()
-                if VERBOSITY>=1:
-                    print("Leftover in queue (event_id, keys):")
-                    for i, ev in rooter.event_queue.items():
-                        print(i, ev.keys())
-            break
-        elif status==RunStatus.SKIP:
-            tot_n_evt_proc = len(rooter.dumped_event_id)
-            print('SKIP:', i, rooter.skipped_event_id, tot_n_evt_proc)
-            continue
-        else:
-            if rooter.n_trg_read % DUMP_SIZE == 0:
-                rooter.dump_events()
-                n_queue = len(rooter.event_queue)
-                if n_queue>MAX_EVENT_QUEUE:
-                    print("WARNING: your event queue is getting too big.")
-        rooter.show_progress()
+    if args.resume:
+        rooter.resume()
+    else:
+        rooter.remove_checkpoint()
+        rooter.create_output_file()
+    if args.pipeline:
+        rooter.run_pipeline(args.workers)
+    else:
+        for batch in rooter.iter_chunks(rooter.dump_size, args.workers):
+            rooter.fill_chunk(batch)
+            rooter.dump_events()
+            rooter.show_progress()
+    if VERBOSITY>=1 and rooter.event_queue.n_queued>0:
+        print("Leftover in queue (event_id):")
+        print(rooter.event_queue.queued_event_id())
     rooter.dump_run_info()
     rooter.print_summary()
     rooter.close_file()
+    rooter.remove_checkpoint()
 
 if __name__ == "__main__":
    main(sys.argv[1:])
@@ -28,6 +28,7 @@ import awkward as ak
 from os.path import splitext
 import uproot
 from caen_reader_test import RawDataFile
+from event_builder import IntervalIdSet
 
 #-----------------------------------
 # Global Parameters are Captialized
@@ -82,8 +83,8 @@ class RawDataRooter():
 
         # useful variables
         self.n_trg_read = 0 # number of trigger read from binary (updated in next())
-        self.read_event_id = set() # keep a record of event id read in (updated in next())
-        self.dumped_event_id = set() # keep a record of event id dumpped
+        self.read_event_id = IntervalIdSet() # keep a record of event id read in (updated in next())
+        self.dumped_event_id = IntervalIdSet() # keep a record of event id dumpped
         self.tot_n_evt_proc = 0 # number of good events saved (updated after dump)
         self.dump_counter = 0 # number of dumps
 
@@ -376,6 +377,7 @@ class RawDataRooter():
         print("Num. of events processed:", self.tot_n_evt_proc)
         print("Num. of triggers read:", self.n_trg_read)
         print("Pass rate:", (self.tot_n_evt_proc*N_BOARDS)/self.n_trg_read)
+        print("Num. of bytes skipped (resync):", self.raw_data_file.n_bytes_skipped)
         return None
 
     def show_progress(self):
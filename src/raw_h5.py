@@ -0,0 +1,179 @@
+'''
+HDF5 backend of the raw data: write and read the daq data of the rooter as
+an alternative to the raw root file.
+
+Layout of the file:
+    daq/adc          (event, channel, sample) uint16, chunked by
+                     (CHUNK_EVENTS, 1, n_samples) and compressed
+    daq/event_id     (event,) uint32
+    daq/event_ttt    (event,) uint64
+    daq/event_sanity (event,) uint16
+    daq/ch_id        (channel,) 100*boardId + chID, the channel axis of adc
+    run_info/...     one dataset per run_info variable
+
+Each chunk holds one channel of CHUNK_EVENTS events, so reading a few
+channels over many events only decompresses those channels.
+
+h5py is in requirements.txt, but only imported for .h5 files.
+ZSTD and LZ4 compression need hdf5plugin; without it, gzip is used.
+'''
+
+import sys
+import numpy as np
+from event_builder import ch_name_to_id
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+CHUNK_EVENTS = 64 # events per chunk of daq/adc
+CHUNK_ROWS = 65536 # entries per chunk of the 1-D event-level datasets
+
+
+def get_h5_compression(codec, level=1):
+    """
+    h5py create_dataset compression arguments from a codec name, as used for
+    the root output (ZLIB, LZ4, ZSTD, LZMA, or None).
+
+    Returns:
+        dict of keyword arguments for create_dataset
+    """
+    if codec is None or str(codec).upper() in ['NONE', '']:
+        return {}
+    codec = str(codec).upper()
+    if codec=='ZSTD' and hdf5plugin is not None:
+        return dict(hdf5plugin.Zstd(clevel=int(level)))
+    if codec=='LZ4' and hdf5plugin is not None:
+        return dict(hdf5plugin.LZ4())
+    if codec in ['ZSTD', 'LZ4']:
+        print("WARNING: %s needs hdf5plugin for HDF5 output, use gzip instead." % codec)
+    elif codec=='LZMA':
+        print("WARNING: LZMA is not available for HDF5 output, use gzip instead.")
+    elif codec!='ZLIB':
+        raise ValueError("unknown compression codec %s, use one of %s" % (codec, ['ZLIB', 'LZ4', 'ZSTD', 'LZMA']))
+    return {'compression': 'gzip', 'compression_opts': min(max(int(level), 0), 9), 'shuffle': True}
+
+
+def _check_h5py():
+    if h5py is None:
+        sys.exit('Sorry, h5py is needed for HDF5 files. Try: pip install h5py')
+
+
+class RawH5Writer():
+    """
+    Write the daq data of the rooter to a HDF5 file, one basket at a time.
+    """
+    def __init__(self, of_path, ch_id, n_samples, compression='ZLIB', compression_level=1, resume_entries=None):
+        """Constructor
+
+        Args:
+            of_path (str): output file path
+            ch_id: list of int, 100*boardId + chID, the channel axis of adc
+            n_samples (int): number of samples per channel
+            compression (str): ZLIB, LZ4, ZSTD, LZMA, or None
+            compression_level (int): compression level
+            resume_entries (int): optional. Reopen an existing file and keep
+                its first resume_entries events (resume from a checkpoint)
+        """
+        _check_h5py()
+        self.of_path = of_path
+        if resume_entries is not None:
+            self.file = h5py.File(of_path, 'r+')
+            for name in ['adc', 'event_id', 'event_ttt', 'event_sanity']:
+                self.file['daq'][name].resize(resume_entries, axis=0)
+            if 'run_info' in self.file:
+                del self.file['run_info']
+            self.n_entries = resume_entries
+            return None
+        self.file = h5py.File(of_path, 'w')
+        n_ch = len(ch_id)
+        comp = get_h5_compression(compression, compression_level)
+        daq = self.file.create_group('daq')
+        daq.create_dataset('ch_id', data=np.asarray(ch_id, dtype=np.uint16))
+        daq.create_dataset('adc', shape=(0, n_ch, n_samples), maxshape=(None, n_ch, n_samples),
+            dtype=np.uint16, chunks=(CHUNK_EVENTS, 1, n_samples), **comp)
+        for name, dtype in [('event_id', np.uint32), ('event_ttt', np.uint64), ('event_sanity', np.uint16)]:
+            daq.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(CHUNK_ROWS,), **comp)
+        self.n_entries = 0
+
+    def extend(self, events):
+        """
+        Append events.
+
+        Args:
+            events: dict of arrays, adc (n_evts, n_ch, n_samples), event_id,
+                event_ttt, event_sanity
+        """
+        n_evts = len(events['event_id'])
+        start, stop = self.n_entries, self.n_entries+n_evts
+        daq = self.file['daq']
+        for name in ['adc', 'event_id', 'event_ttt', 'event_sanity']:
+            daq[name].resize(stop, axis=0)
+            daq[name][start:stop] = events[name]
+        self.n_entries = stop
+        return None
+
+    def write_run_info(self, run_info):
+        """
+        Args:
+            run_info (dict): variable name -> one-entry list, as the run_info
+                tree of the raw root file
+        """
+        grp = self.file.create_group('run_info')
+        for name, val in run_info.items():
+            grp.create_dataset(name, data=np.asarray(val[0]))
+        return None
+
+    def close(self):
+        self.file.close()
+        return None
+
+
+def read_h5_daq(if_path, channels=None, entry_start=None, entry_stop=None):
+    """
+    Read daq data from a HDF5 raw data file. Only the requested channels and
+    event range are read.
+
+    Args:
+        if_path (str): path to the .h5 file
+        channels: optional list of channel names (ex. adc_b1_ch0 or b1_ch0) or
+            ch_id (ex. 100). Default: all channels.
+        entry_start, entry_stop: optional event range
+
+    Returns:
+        dict of arrays, as `uproot tree.arrays(library='np')` on the raw root
+        file: adc_bX_chY (n_evts, n_samples) per channel, event_id,
+        event_ttt, event_sanity
+    """
+    _check_h5py()
+    with h5py.File(if_path, 'r') as f:
+        daq = f['daq']
+        ch_id = daq['ch_id'][:].tolist()
+        if channels is None:
+            wanted = ch_id
+        else:
+            wanted = [ch_name_to_id(ch) if isinstance(ch, str) else int(ch) for ch in channels]
+        sel = slice(entry_start, entry_stop)
+        data = {}
+        for i in wanted:
+            data['adc_b%d_ch%d' % (i//100, i%100)] = daq['adc'][sel, ch_id.index(i), :]
+        for name in ['event_id', 'event_ttt', 'event_sanity']:
+            data[name] = daq[name][sel]
+    return data
+
+
+def read_h5_run_info(if_path):
+    """
+    Returns:
+        dict: run_info variable name -> value
+    """
+    _check_h5py()
+    with h5py.File(if_path, 'r') as f:
+        return {name: f['run_info'][name][()] for name in f['run_info']}
+
@@ -1,19 +1,23 @@
+import os
+import sys
 from numpy import int16, int32, uint16, uint32, float32, array, zeros
 import numpy as np
 import uproot
 import awkward as ak
-from os.path import splitext, basename, dirname
+from os.path import splitext, basename, dirname, exists, abspath
+from itertools import chain
 #import h5py
 
 from pulse_finder import PulseFinder
 from waveform import Waveform
 from pandas import DataFrame
+from utilities import get_compression
 
 class RQWriter:
     """
     Write to file
     """
-    def __init__(self, args, n_pmt_ch, n_aux_ch, basket_size=1000):
+    def __init__(self, args, n_pmt_ch, n_aux_ch, n_roi, basket_size=1000, compression='ZLIB', compression_level=1, basket_bytes=0):
         """
         Constructor: create root tree structure, fill, and write. The n_ch and
         n_aux_ch variables are needed to define branch structure (static array).
@@ -24,14 +28,29 @@ class RQWriter:
             args: input arguments passed to main, it includes output Directory
             n_ch: number of channels used for PMTs (n_active_ch - n_aux_ch)
             n_aux_ch: number of auxiliary (not-signal) channels
+            n_roi: number of ROIs (roi_start_ns of the yaml config)
             batch_size: number of entries per batch
+            compression: codec, ZLIB, LZ4, ZSTD, LZMA, or None
+            compression_level: int, compression level
+            basket_bytes: target (uncompressed) bytes per basket of the
+                channel branches. Batches are held and written together until
+                reached. 0 means one basket per batch.
         """
 
         self.args = args
         self.n_pmt_ch = n_pmt_ch
         self.n_aux_ch = n_aux_ch
+        self.n_roi = n_roi
         self.basket_size = basket_size
         self.init_basket_cap = 100
+        self.compression = compression
+        self.compression_level = compression_level
+        self.basket_bytes = basket_bytes
+        self.pending = [] # (data_event, data_pulse) of batches not yet written
+        self.n_pending = 0
+        self.n_batches = 0 # batches given to dump_event_rq
+        self.n_batches_written = 0 # batches whose events are all in the file (for checkpoints)
+        self.n_entries = 0 # entries written to the event tree
         if self.basket_size<=10:
             print("Info: write small baskets is not recommended by Jim \
             Pivarski. Code may be slow this way. Rule of thumb: at least \
@@ -52,19 +71,11 @@ class RQWriter:
         # pmt channel level variables
         self.ch_id = [] # boardId*100 + chID
         self.ch_saturated = []
-        self.ch_roi0_height_pe = []
-        self.ch_roi1_height_pe = []
-        self.ch_roi2_height_pe = []
-        self.ch_roi0_area_pe = []
-        self.ch_roi1_area_pe = []
-        self.ch_roi2_area_pe = []
-        self.ch_roi0_low_pe = []
-        self.ch_roi1_low_pe = []
-        self.ch_roi2_low_pe = []
-        self.ch_roi0_std_pe = []
-        self.ch_roi1_std_pe = []
-        self.ch_roi2_std_pe = []
-        self.ch_roi0_std_mV = []
+        self.ch_roi_height_pe = [] # (channel, roi) per event
+        self.ch_roi_area_pe = []
+        self.ch_roi_low_pe = []
+        self.ch_roi_std_pe = []
+        self.ch_roi_std_mV = []
 
         # non-signal channel info (auxiliary channels)
         self.aux_ch_id = []
@@ -153,10 +164,9 @@ class RQWriter:
         self.pulse_ch_height_pe = []
         return None
 
-    def create_output(self):
+    def set_output_path(self):
         """
-        First create output file name based on input file names
-        Then create empty tree via mktree
+        Output file name based on input file names, and its checkpoint file
         """
         self.output_dir = str(self.args.output_dir)
         if self.output_dir=="":
@@ -164,12 +174,24 @@ class RQWriter:
         fname = basename(self.args.if_path)
         name, f_ext = splitext(fname)
         self.of_path = self.output_dir + '/' + name +'_rq.root'
-        self.file = uproot.recreate(self.of_path)
+        self.ckpt_path = self.of_path + '.ckpt.npz'
+        return None
+
+    def create_output(self):
+        """
+        First create output file name based on input file names
+        Then create empty tree via mktree
+        """
+        self.set_output_path()
+        self.file = uproot.recreate(self.of_path, compression=get_compression(self.compression, self.compression_level))
+        # the biggest fixed-size branches are channel x roi x float32
+        self.events_per_basket = self.basket_bytes//(4*max(self.n_pmt_ch*self.n_roi, 1))
 
         bs = self.basket_size
         type_ch_uint16 = ak.Array(zeros([bs, self.n_pmt_ch], dtype=uint16)).type
         type_ch_float = ak.Array(zeros([bs, self.n_pmt_ch], dtype=float32)).type
         type_ch_bool = ak.Array(zeros([bs, self.n_pmt_ch], dtype=bool)).type
+        type_ch_roi_float = ak.Array(zeros([bs, self.n_pmt_ch, self.n_roi], dtype=float32)).type
         type_aux_ch_uint16 = ak.Array(zeros([bs, self.n_aux_ch], dtype=uint16)).type
         type_aux_ch_float = ak.Array(zeros([bs, self.n_aux_ch], dtype=float32)).type
 
@@ -181,19 +203,11 @@ class RQWriter:
 
             'ch_id': type_ch_uint16,
             'ch_saturated': type_ch_bool,
-            'ch_roi0_height_pe': type_ch_float,
-            'ch_roi1_height_pe': type_ch_float,
-            'ch_roi2_height_pe': type_ch_float,
-            'ch_roi0_area_pe': type_ch_float,
-            'ch_roi1_area_pe': type_ch_float,
-            'ch_roi2_area_pe': type_ch_float,
-            'ch_roi0_low_pe': type_ch_float,
-            'ch_roi1_low_pe': type_ch_float,
-            'ch_roi2_low_pe': type_ch_float,
-            'ch_roi0_std_pe': type_ch_float,
-            'ch_roi1_std_pe': type_ch_float,
-            'ch_roi2_std_pe': type_ch_float,
-            'ch_roi0_std_mV': type_ch_float,
+            'ch_roi_height_pe': type_ch_roi_float,
+            'ch_roi_area_pe': type_ch_roi_float,
+            'ch_roi_low_pe': type_ch_roi_float,
+            'ch_roi_std_pe': type_ch_roi_float,
+            'ch_roi_std_mV': type_ch_roi_float,
 
             'aux_ch_id': type_aux_ch_uint16,
             'aux_ch_area_mV': type_aux_ch_float,
@@ -279,6 +293,8 @@ class RQWriter:
             'area_bot_max_ch_id': type_uint,
             'saturated': type_bool,
         }
+        self.event_branches = list(type_event)
+        self.pulse_fields = list(type_pulse)
         type_event['pulse']=ak.zip(type_pulse).type
 
         #a=ak.values_astype(a, np.uint16)
@@ -323,54 +339,21 @@ class RQWriter:
             sys.exit(msg)
         ch_id = zeros(n_ch)
         ch_saturated = np.full(n_ch, False)
-        roi0_h = zeros(n_ch)
-        roi1_h = zeros(n_ch)
-        roi2_h = zeros(n_ch)
-        roi0_a = zeros(n_ch)
-        roi1_a = zeros(n_ch)
-        roi2_a = zeros(n_ch)
-        roi0_l = zeros(n_ch)
-        roi1_l = zeros(n_ch)
-        roi2_l = zeros(n_ch)
-        roi0_s = zeros(n_ch)
-        roi1_s = zeros(n_ch)
-        roi2_s = zeros(n_ch)
-        roi0_s_mV = zeros(n_ch)
         i=0
         for ch in wfm.ch_names:
             if ch in wfm.cfg.non_signal_channels:
                 continue
             ch_id[i] = wfm.ch_name_to_id_dict[ch]
             ch_saturated[i] = wfm.ch_saturated[ch]
-            roi0_h[i] = wfm.roi_height_pe[0][ch]
-            roi1_h[i] = wfm.roi_height_pe[1][ch]
-            roi2_h[i] = wfm.roi_height_pe[2][ch]
-            roi0_a[i] = wfm.roi_area_pe[0][ch]
-            roi1_a[i] = wfm.roi_area_pe[1][ch]
-            roi2_a[i] = wfm.roi_area_pe[2][ch]
-            roi0_l[i] = wfm.roi_low_pe[0][ch]
-            roi1_l[i] = wfm.roi_low_pe[1][ch]
-            roi2_l[i] = wfm.roi_low_pe[2][ch]
-            roi0_s[i] = wfm.roi_std_pe[0][ch]
-            roi1_s[i] = wfm.roi_std_pe[1][ch]
-            roi2_s[i] = wfm.roi_std_pe[2][ch]
-            roi0_s_mV[i] = wfm.roi_std_mV[0][ch]
             i+=1
         self.ch_id.append( ch_id )
         self.ch_saturated.append( ch_saturated )
-        self.ch_roi0_height_pe.append(roi0_h)
-        self.ch_roi1_height_pe.append(roi1_h)
-        self.ch_roi2_height_pe.append(roi2_h)
-        self.ch_roi0_area_pe.append(roi0_a)
-        self.ch_roi1_area_pe.append(roi1_a)
-        self.ch_roi2_area_pe.append(roi2_a)
-        self.ch_roi0_low_pe.append(roi0_l)
-        self.ch_roi1_low_pe.append(roi1_l)
-        self.ch_roi2_low_pe.append(roi2_l)
-        self.ch_roi0_std_pe.append(roi0_s)
-        self.ch_roi1_std_pe.append(roi1_s)
-        self.ch_roi2_std_pe.append(roi2_s)
-        self.ch_roi0_std_mV.append(roi0_s_mV)
+        # ROI variables are (channel, roi) arrays of the signal channels, in the same order
+        self.ch_roi_height_pe.append(wfm.roi_height_pe)
+        self.ch_roi_area_pe.append(wfm.roi_area_pe)
+        self.ch_roi_low_pe.append(wfm.roi_low_pe)
+        self.ch_roi_std_pe.append(wfm.roi_std_pe)
+        self.ch_roi_std_mV.append(wfm.roi_std_mV)
 
         # auxiliary channel
         n_aux_ch = len(wfm.cfg.non_signal_channels)
@@ -470,8 +453,10 @@ class RQWriter:
         """
         remember to close file after done
         """
+        self.flush()
         print("Info: closing file", self.of_path)
         self.file.close()
+        self.remove_checkpoint()
 
     def dump_run_rq(self, rq: dict):
         """
@@ -515,6 +500,7 @@ class RQWriter:
         """
         Write one basket at a time
         """
+        self.n_batches += 1
         if not self.n_pulses:
             print("WARNING: Empty list. Nothing to dump")
             return None
@@ -527,19 +513,11 @@ class RQWriter:
 
             'ch_id': self.ch_id,
             'ch_saturated': self.ch_saturated,
-            'ch_roi0_height_pe': self.ch_roi0_height_pe,
-            'ch_roi1_height_pe': self.ch_roi1_height_pe,
-            'ch_roi2_height_pe': self.ch_roi2_height_pe,
-            'ch_roi0_area_pe': self.ch_roi0_area_pe,
-            'ch_roi1_area_pe': self.ch_roi1_area_pe,
-            'ch_roi2_area_pe': self.ch_roi2_area_pe,
-            'ch_roi0_low_pe': self.ch_roi0_low_pe,
-            'ch_roi1_low_pe': self.ch_roi1_low_pe,
-            'ch_roi2_low_pe': self.ch_roi2_low_pe,
-            'ch_roi0_std_pe': self.ch_roi0_std_pe,
-            'ch_roi1_std_pe': self.ch_roi1_std_pe,
-            'ch_roi2_std_pe': self.ch_roi2_std_pe,
-            'ch_roi0_std_mV': self.ch_roi0_std_mV,
+            'ch_roi_height_pe': self.ch_roi_height_pe,
+            'ch_roi_area_pe': self.ch_roi_area_pe,
+            'ch_roi_low_pe': self.ch_roi_low_pe,
+            'ch_roi_std_pe': self.ch_roi_std_pe,
+            'ch_roi_std_mV': self.ch_roi_std_mV,
             'aux_ch_id': self.aux_ch_id,
             'aux_ch_area_mV': self.aux_ch_area_mV
         }
@@ -621,7 +599,90 @@ class RQWriter:
             'area_bot_max_ch_id': self.pulse_area_bot_max_ch_id,
             'saturated': self.pulse_saturated,
         }
+        # write batches together until the basket is big enough
+        self.pending.append((data_event, data_pulse))
+        self.n_pending += len(self.event_id)
+        if self.n_pending>=self.events_per_basket:
+            self.flush()
+        return None
+
+    def flush(self):
+        """
+        Write the pending batches as one basket
+        """
+        if not self.pending:
+            return None
+        if len(self.pending)==1:
+            data_event, data_pulse = self.pending[0]
+        else:
+            data_event = {key: list(chain.from_iterable(ev[key] for ev, _ in self.pending)) for key in self.pending[0][0]}
+            data_pulse = {key: list(chain.from_iterable(p[key] for _, p in self.pending)) for key in self.pending[0][1]}
         data_event['pulse']=ak.zip(data_pulse)
 
         self.file['event'].extend(data_event)
+        self.n_entries += len(data_event['event_id'])
+        self.pending = []
+        self.n_pending = 0
+        # batches with no event are done too
+        self.n_batches_written = self.n_batches
+        self.save_checkpoint()
         return None
+
+    def save_checkpoint(self):
+        """
+        Flush the output file and record how many input batches and entries
+        it holds (<output>.ckpt.npz), for resume. Saved after every basket.
+        """
+        self.file.file.sink.flush()
+        tmp_path = self.ckpt_path[:-4] + '.tmp.npz'
+        np.savez(tmp_path, if_path=np.array(abspath(self.args.if_path)),
+            n_batches=np.array(self.n_batches_written), n_entries=np.array(self.n_entries))
+        os.replace(tmp_path, self.ckpt_path)
+        return None
+
+    def remove_checkpoint(self):
+        """
+        Remove the checkpoint, and the old output left by a failed resume
+        """
+        self.set_output_path()
+        for p in [self.ckpt_path, self.of_path + '.part']:
+            if exists(p):
+                os.remove(p)
+        return None
+
+    def resume(self):
+        """
+        Create the output file for an interrupted run: the entries written
+        before the last checkpoint are copied from the old file (uproot cannot
+        append to an existing tree). Without checkpoint, same as create_output.
+
+        Returns:
+            int: number of input batches already processed
+        """
+        self.set_output_path()
+        if not exists(self.ckpt_path):
+            print("Info: no checkpoint %s, start from the beginning." % self.ckpt_path)
+            self.create_output()
+            return 0
+        with np.load(self.ckpt_path) as state:
+            if str(state['if_path'])!=abspath(self.args.if_path):
+                sys.exit('Sorry, checkpoint %s was made with another input file. Remove it to start over.' % self.ckpt_path)
+            n_entries = int(state['n_entries'])
+            n_batches = int(state['n_batches'])
+        # a .part file left by a failed resume is the original output
+        old_path = self.of_path + '.part'
+        if not exists(old_path):
+            os.replace(self.of_path, old_path)
+        self.create_output()
+        with uproot.open(old_path) as old:
+            tree = old['event']
+            for start in range(0, n_entries, self.basket_size):
+                a = tree.arrays(entry_start=start, entry_stop=min(start+self.basket_size, n_entries))
+                data_event = {key: a[key] for key in self.event_branches}
+                data_event['pulse'] = ak.zip({key: a['pulse_'+key] for key in self.pulse_fields})
+                self.file['event'].extend(data_event)
+        os.remove(old_path)
+        self.n_entries = n_entries
+        self.n_batches = self.n_batches_written = n_batches
+        print("Info: resume from checkpoint: %d batches done, %d entries written" % (self.n_batches, n_entries))
+        return self.n_batches
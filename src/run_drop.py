@@ -10,6 +10,7 @@ from numpy import array, isscalar, uint16, uint32
 import numpy as np
 from enum import Enum
 import uproot
+import awkward as ak
 import pandas as pd
 import os
 import re
@@ -18,8 +19,11 @@ from datetime import datetime
 
 from yaml_reader import YamlReader
 from waveform import Waveform
+from batch_waveform import BatchWaveform, BLOCK_EVENTS
 from pulse_finder import PulseFinder
 from rq_writer import RQWriter
+from event_index import load_event_index, event_id_range_to_entries
+from waveform_codec import PACKED_BRANCH, unpack_awkward
 
 MAX_N_EVENT = 999999999 # Arbiarty large
 YAML_DIR = os.environ['YAML_DIR']
@@ -29,11 +33,13 @@ class RunDROP():
     """
     Main Class. Once per run. Manage all operations.
     """
-    def __init__(self, args):
+    def __init__(self, args, run_info=None):
         """
         Args:
             args: return of parser.parse_args(). This is the input arguments
                 when you run the program
+            run_info (dict): optional. If given, used instead of the run_info
+                tree of the input raw root file (see set_run_info)
         """
         # args
         self.args = args # save a copy
@@ -45,7 +51,11 @@ class RunDROP():
         # variable
         self.batch_id = 0
         self.batch = None
-        self.load_run_info()
+        self.bwfm = None # BatchWaveform, see get_batch_waveform
+        if run_info is None:
+            self.load_run_info()
+        else:
+            self.set_run_info(run_info)
         self.load_pmt_info()
         self.sanity_check()
 
@@ -84,19 +94,30 @@ class RunDROP():
             `adc_b2_ch11`.
         """
         f = uproot.open(self.if_path)
+        b_names = ['n_boards', 'n_event_proc', 'n_trg_read', 'leftover_event_id', 'active_ch_id']
+        a = f['run_info'].arrays(b_names, library='np')
+        self.set_run_info({name: a[name][0] for name in b_names})
+        return None
+
+    def set_run_info(self, run_info):
+        """
+        Set run info, and the start datetime from the input file name.
+
+        Args:
+            run_info (dict): n_boards, n_event_proc, n_trg_read,
+                leftover_event_id, and active_ch_id (100*boardId + chID)
+        """
         dt = self.extract_datetime_from_str(self.if_path)
         self.start_year = uint16(dt.year)
         self.start_month = uint16(dt.month)
         self.start_day= uint16(dt.day)
         self.start_hour= uint16(dt.hour)
         self.start_minute= uint16(dt.minute)
-        b_names = ['n_boards', 'n_event_proc', 'n_trg_read', 'leftover_event_id', 'active_ch_id']
-        a = f['run_info'].arrays(b_names, library='np')
-        self.n_boards = uint16(a['n_boards'][0])
-        self.n_trg_read= uint32(a['n_trg_read'][0])
-        self.n_event_proc = uint32(a['n_event_proc'][0])
-        self.leftover_event_id = uint32(a['leftover_event_id'][0])
-        tmp = a['active_ch_id'][0]
+        self.n_boards = uint16(run_info['n_boards'])
+        self.n_trg_read= uint32(run_info['n_trg_read'])
+        self.n_event_proc = uint32(run_info['n_event_proc'])
+        self.leftover_event_id = uint32(run_info['leftover_event_id'])
+        tmp = run_info['active_ch_id']
         if isscalar(tmp): # if only 1 active channels, tmp is a scalar and sort will fail
             tmp = [tmp]
         self.ch_id = sorted(uint16(tmp))
@@ -189,26 +210,26 @@ class RunDROP():
         # create PulseFinder
         pf = PulseFinder(self.cfg, wfm)
 
+        # packed traces (see waveform_codec.py) are unpacked for the whole batch at once
+        packed_adc = None
+        if PACKED_BRANCH in batch.fields:
+            packed_adc = unpack_awkward(batch[PACKED_BRANCH])
+
         # loop over events in this batch
+        event_ids = ak.to_numpy(batch['event_id'])
         for i in range(len(batch)):
-            event_id = batch[i].event_id
-            event_ttt = batch[i].event_ttt
+            event_id = event_ids[i]
+            if self.cfg.batch_waveform and i % BLOCK_EVENTS==0:
+                # waveforms of the next block of events, as whole arrays
+                bwfm = self.get_batch_waveform(batch[i:i+BLOCK_EVENTS],
+                    None if packed_adc is None else packed_adc[i:i+BLOCK_EVENTS])
             if event_id<self.start_id or event_id>=self.end_id:
                 continue
             # waveform
-            wfm.reset()
-            wfm.set_raw_data(batch[i])
-            wfm.find_saturation()
-            wfm.subtract_flat_baseline()
-            #wfm.find_ma_baseline()
-            wfm.do_spe_normalization()
-            wfm.define_trigger_position()
-            wfm.correct_daisy_chain_trg_delay()
-            wfm.sum_channels()
-            wfm.define_time_axis()
-            wfm.integrate_waveform()
-            wfm.calc_roi_info()
-            wfm.calc_aux_ch_info()
+            if self.cfg.batch_waveform:
+                bwfm.to_waveform(i % BLOCK_EVENTS, wfm)
+            else:
+                self.process_waveform(wfm, batch[i], None if packed_adc is None else packed_adc[i])
 
             # pulses finding
             pf.reset()
@@ -227,6 +248,52 @@ class RunDROP():
         self.batch_id += 1
         return None
 
+    def process_waveform(self, wfm, val, adc=None):
+        """
+        Per-event waveform steps (see Waveform).
+
+        Args:
+            wfm (Waveform): with channel info and spe_mean set
+            val: one event (record) of the raw daq tree
+            adc: optional unpacked (channel, sample) traces of this event
+        """
+        wfm.reset()
+        wfm.set_raw_data(val, adc)
+        wfm.find_saturation()
+        wfm.subtract_flat_baseline()
+        if wfm.cfg.baseline_method=='rolling':
+            wfm.subtract_rolling_baseline()
+        wfm.do_spe_normalization()
+        wfm.define_trigger_position()
+        wfm.correct_daisy_chain_trg_delay()
+        wfm.sum_channels()
+        wfm.define_time_axis()
+        wfm.integrate_waveform()
+        wfm.calc_roi_info()
+        wfm.calc_aux_ch_info()
+        return wfm
+
+    def get_batch_waveform(self, batch, adc=None):
+        """
+        Run the waveform steps on a block of events at once (see BatchWaveform).
+
+        Args:
+            batch: awkward array of events from the raw daq tree
+            adc: optional unpacked (event, channel, sample) traces
+
+        Returns:
+            BatchWaveform
+        """
+        if self.bwfm is None:
+            self.bwfm = BatchWaveform(self.cfg)
+            self.bwfm.ch_names = self.ch_names
+            self.bwfm.ch_id = self.ch_id
+            self.bwfm.ch_name_to_id_dict = self.ch_name_to_id_dict
+            self.bwfm.n_boards = self.n_boards
+            self.bwfm.spe_mean = self.spe_mean
+        self.bwfm.process(batch, adc)
+        return self.bwfm
+
     def show_progress(self):
         """
         print progress on screen
@@ -238,6 +305,73 @@ class RunDROP():
         print("%dth batch, %.1f percent completed" % (self.batch_id, pct))
         return None
 
+    def get_run_rq(self):
+        """
+        Run rq, written once per file: run info from the raw data, and the
+        yaml config. (uproot cannot save string; so ASCII->int->ASCII for
+        spe_fit_results_file)
+
+        Returns:
+            dict: branch name -> one-entry list
+        """
+        info = {
+            'start_year': [self.start_year],
+            'start_month': [self.start_month],
+            'start_day': [self.start_day],
+            'start_hour': [self.start_hour],
+            'start_minute': [self.start_minute],
+            'n_boards': [self.n_boards],
+            'n_trg_read': [self.n_trg_read],
+            'n_event_proc': [self.n_event_proc],
+            'leftover_event_id': [self.leftover_event_id],
+            'ch_id': [self.ch_id],
+            'cfg_batch_size': [self.cfg.batch_size],
+            'cfg_post_trigger': [self.cfg.post_trigger],
+            'cfg_dgtz_dynamic_range_mV': [self.cfg.dgtz_dynamic_range_mV],
+            'cfg_non_signal_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.non_signal_channels]],
+            'cfg_bottom_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.bottom_pmt_channels]],
+            'cfg_side_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.side_pmt_channels]],
+            'cfg_row1_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.row1_pmt_channels]],
+            'cfg_row2_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.row2_pmt_channels]],
+            'cfg_row3_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.row3_pmt_channels]],
+            'cfg_row4_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.row4_pmt_channels]],
+            'cfg_row5_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.row5_pmt_channels]],
+            'cfg_row6_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.row6_pmt_channels]],
+            'cfg_row7_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.row7_pmt_channels]],
+            'cfg_col1_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.col1_pmt_channels]],
+            'cfg_col2_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.col2_pmt_channels]],
+            'cfg_col3_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.col3_pmt_channels]],
+            'cfg_col4_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.col4_pmt_channels]],
+            'cfg_col5_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.col5_pmt_channels]],
+            'cfg_col6_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.col6_pmt_channels]],
+            'cfg_col7_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.col7_pmt_channels]],
+            'cfg_col8_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.col8_pmt_channels]],
+            'cfg_user_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.user_pmt_channels]],
+            'cfg_skip_pmt_channels': [[self.ch_name_to_id_dict[ch] for ch in self.cfg.skip_pmt_channels]],
+            'cfg_spe_fit_results_file': [[ord(i) for i in self.cfg.spe_fit_results_file]],
+            'cfg_interpolate_spe': [self.cfg.interpolate_spe],
+            'cfg_daisy_chainr': [self.cfg.daisy_chain],
+            'cfg_apply_high_pass_filter': [self.cfg.apply_high_pass_filter],
+            'cfg_high_pass_cutoff_Hz': [self.cfg.high_pass_cutoff_Hz],
+            'cfg_moving_avg_length': [self.cfg.moving_avg_length],
+            'cfg_sigma_above_baseline': [self.cfg.sigma_above_baseline],
+            'cfg_pre_pulse': [self.cfg.pre_pulse],
+            'cfg_post_pulse': [self.cfg.post_pulse],
+            'cfg_baseline_method': [[ord(i) for i in self.cfg.baseline_method]],
+            'cfg_baseline_window_ns': [self.cfg.baseline_window_ns],
+            'cfg_roi_start_ns': [self.cfg.roi_start_ns],
+            'cfg_roi_end_ns': [self.cfg.roi_end_ns],
+            'cfg_pulse_finder_algo': [self.cfg.pulse_finder_algo],
+            'cfg_scipy_pf_pars_distance': [self.cfg.scipy_pf_pars.distance],
+            'cfg_scipy_pf_pars_threshold': [self.cfg.scipy_pf_pars.threshold],
+            'cfg_scipy_pf_pars_height': [self.cfg.scipy_pf_pars.height],
+            'cfg_scipy_pf_pars_prominence': [self.cfg.scipy_pf_pars.prominence],
+            'cfg_spe_height_threshold': [self.cfg.spe_height_threshold],
+        }
+        for name, chs in self.cfg.channel_groups.items():
+            info['cfg_%s_channels' % name] = [[self.ch_name_to_id_dict[ch] for ch in chs]]
+        return info
+
 def main(argv):
     """
     Main function
@@ -246,6 +380,7 @@ def main(argv):
     parser.add_argument('--start_id', type=int, default=0, help='Optional. start process from start_id (default: 0)')
     parser.add_argument('--end_id', type=int, default=MAX_N_EVENT, help='Optional. stop process at end_id (defalt: Arbiarty large)')
     parser.add_argument('--output_dir', type=str, default="", help='Optional. Directory where output file goes. If not specified, same directory as the input file.' )
+    parser.add_argument('--resume', action='store_true', help='Optional. continue an interrupted run from its last checkpoint (<output>.ckpt.npz, saved after every basket)')
     required = parser.add_argument_group('Required Arguments')
     required.add_argument('-i', '--if_path', type=str, help='Required. full path to the raw data file', required=True)
     required.add_argument('-c', '--yaml', type=str, help='Required. path to the yaml config file', required=True)
@@ -260,11 +395,26 @@ def main(argv):
     # RQWriter creates output file, fill, and dump
     n_aux_ch = len(run.cfg.non_signal_channels)
     n_ch = len(run.ch_id)-n_aux_ch
-    writer = RQWriter(args, n_ch, n_aux_ch, basket_size=run.cfg.batch_size)
+    writer = RQWriter(args, n_ch, n_aux_ch, n_roi=len(run.cfg.roi_start_ns), basket_size=run.cfg.batch_size,
+        compression=run.cfg.compression, compression_level=run.cfg.compression_level, basket_bytes=run.cfg.basket_bytes)
     writer.init_basket_cap = int(run.n_event_proc/run.cfg.batch_size)+2
-    writer.create_output()
+    n_batches_done = 0
+    if args.resume:
+        n_batches_done = writer.resume()
+    else:
+        writer.remove_checkpoint()
+        writer.create_output()
+    run.batch_id = n_batches_done
 
-    batch_list = uproot.iterate('%s:daq' % args.if_path, step_size=run.cfg.batch_size)
+    f = uproot.open(args.if_path)
+    if args.start_id>0 or args.end_id<MAX_N_EVENT:
+        # only read the entries of [start_id, end_id)
+        entry_start, entry_stop = event_id_range_to_entries(load_event_index(f), args.start_id, args.end_id)
+    else:
+        entry_start, entry_stop = 0, None
+    # skip the batches done before the checkpoint
+    entry_start += n_batches_done*run.cfg.batch_size
+    batch_list = f['daq'].iterate(step_size=run.cfg.batch_size, entry_start=entry_start, entry_stop=entry_stop)
     for batch in batch_list:
         run.process_batch(batch, writer)
         run.show_progress()
@@ -272,58 +422,7 @@ def main(argv):
     # write run tree once per file
     # run rq includes from raw root data, and yaml config
     # (uproot cannot save string; so ASCII->int->ASCII for spe_fit_results_file)
-    writer.dump_run_rq({
-        'start_year': [run.start_year],
-        'start_month': [run.start_month],
-        'start_day': [run.start_day],
-        'start_hour': [run.start_hour],
-        'start_minute': [run.start_minute],
-        'n_boards': [run.n_boards],
-        'n_trg_read': [run.n_trg_read],
-        'n_event_proc': [run.n_event_proc],
-        'leftover_event_id': [run.leftover_event_id],
-        'ch_id': [run.ch_id],
-        'cfg_batch_size': [run.cfg.batch_size],
-        'cfg_post_trigger': [run.cfg.post_trigger],
-        'cfg_dgtz_dynamic_range_mV': [run.cfg.dgtz_dynamic_range_mV],
-        'cfg_non_signal_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.non_signal_channels]],
-        'cfg_bottom_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.bottom_pmt_channels]],
-        'cfg_side_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.side_pmt_channels]],
-        'cfg_row1_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.row1_pmt_channels]],
-        'cfg_row2_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.row2_pmt_channels]],
-        'cfg_row3_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.row3_pmt_channels]],
-        'cfg_row4_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.row4_pmt_channels]],
-        'cfg_row5_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.row5_pmt_channels]],
-        'cfg_row6_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.row6_pmt_channels]],
-        'cfg_row7_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.row7_pmt_channels]],
-        'cfg_col1_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.col1_pmt_channels]],
-        'cfg_col2_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.col2_pmt_channels]],
-        'cfg_col3_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.col3_pmt_channels]],
-        'cfg_col4_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.col4_pmt_channels]],
-        'cfg_col5_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.col5_pmt_channels]],
-        'cfg_col6_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.col6_pmt_channels]],
-        'cfg_col7_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.col7_pmt_channels]],
-        'cfg_col8_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.col8_pmt_channels]],
-        'cfg_user_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.user_pmt_channels]],
-        'cfg_skip_pmt_channels': [[run.ch_name_to_id_dict[ch] for ch in run.cfg.skip_pmt_channels]],
-        'cfg_spe_fit_results_file': [[ord(i) for i in run.cfg.spe_fit_results_file]],
-        'cfg_interpolate_spe': [run.cfg.interpolate_spe],
-        'cfg_daisy_chainr': [run.cfg.daisy_chain],
-        'cfg_apply_high_pass_filter': [run.cfg.apply_high_pass_filter],
-        'cfg_high_pass_cutoff_Hz': [run.cfg.high_pass_cutoff_Hz],
-        'cfg_moving_avg_length': [run.cfg.moving_avg_length],
-        'cfg_sigma_above_baseline': [run.cfg.sigma_above_baseline],
-        'cfg_pre_pulse': [run.cfg.pre_pulse],
-        'cfg_post_pulse': [run.cfg.post_pulse],
-        'cfg_roi_start_ns': [run.cfg.roi_start_ns],
-        'cfg_roi_end_ns': [run.cfg.roi_end_ns],
-        'cfg_pulse_finder_algo': [run.cfg.pulse_finder_algo],
-        'cfg_scipy_pf_pars_distance': [run.cfg.scipy_pf_pars.distance],
-        'cfg_scipy_pf_pars_threshold': [run.cfg.scipy_pf_pars.threshold],
-        'cfg_scipy_pf_pars_height': [run.cfg.scipy_pf_pars.height],
-        'cfg_scipy_pf_pars_prominence': [run.cfg.scipy_pf_pars.prominence],
-        'cfg_spe_height_threshold': [run.cfg.spe_height_threshold],
-    })
+    writer.dump_run_rq(run.get_run_rq())
     writer.dump_pmt_info(run.spe_fit_results)
     # remeber to close file
     writer.close()
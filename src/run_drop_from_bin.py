@@ -0,0 +1,123 @@
+"""
+Single-pass reconstruction: raw binary file -> RQ root file.
+
+Events built by RawDataRooter are fed straight to RunDROP.process_batch, so
+the waveforms are not written to, and read back from, a raw root file. The raw
+root file can still be written on the side with --raw_root.
+
+Usage:
+python src/run_drop_from_bin.py --help
+
+Contact:
+X. Xiang <xxiang@bnl.gov>
+"""
+import argparse
+import sys
+import numpy as np
+import awkward as ak
+
+import raw_data_rooter as rdr
+from raw_data_rooter import RawDataRooter
+from event_builder import ch_name_to_id
+from run_drop import RunDROP, MAX_N_EVENT
+from rq_writer import RQWriter
+
+
+def get_rooter_run_info(rooter, n_event_proc=None):
+    """
+    run_info of the rooter, in the format of RunDROP.set_run_info.
+
+    Args:
+        rooter (RawDataRooter)
+        n_event_proc (int): optional. Use this number of events instead of
+            rooter.tot_n_evt_proc (ex. an estimate before the run)
+    """
+    if n_event_proc is None:
+        n_event_proc = rooter.tot_n_evt_proc
+    leftover = rooter.event_queue.queued_event_id()
+    return {
+        'n_boards': rdr.N_BOARDS,
+        'n_event_proc': n_event_proc,
+        'n_trg_read': rooter.n_trg_read,
+        'leftover_event_id': leftover[0] if len(leftover)>0 else np.int64(-1),
+        'active_ch_id': [ch_name_to_id(ch) for ch in rooter.ch_names],
+    }
+
+
+def iter_event_batches(rooter, batch_size, n_workers=1, write_raw=False):
+    """
+    Build events from the binary file and yield them in batches of about
+    batch_size events, in the same format as uproot.iterate on the raw root
+    file (high-level awkward array).
+
+    Args:
+        rooter (RawDataRooter)
+        batch_size (int): number of events per batch
+        n_workers (int): number of processes decoding the binary file
+        write_raw (bool): also write the events to the raw root file
+    """
+    for chunk in rooter.iter_chunks(batch_size*rdr.N_BOARDS, n_workers):
+        rooter.fill_chunk(chunk)
+        basket = rooter.make_basket()
+        if basket is None:
+            continue
+        if write_raw:
+            rooter.write_basket(basket)
+        yield ak.Array(basket)
+    return None
+
+
+def main(argv):
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description='Data Reconstruction Offline Package, from raw binary file to RQ in one pass')
+    parser.add_argument('--start_id', type=int, default=0, help='Optional. start process from start_id (default: 0)')
+    parser.add_argument('--end_id', type=int, default=MAX_N_EVENT, help='Optional. stop process at end_id (defalt: Arbiarty large)')
+    parser.add_argument('--output_dir', type=str, default="", help='Optional. Directory where output files go. If not specified, same directory as the input file.' )
+    parser.add_argument('--workers', type=int, default=1, help='Optional. number of processes decoding the binary file in parallel (default: 1)')
+    parser.add_argument('--raw_root', action='store_true', help='Optional. also write the raw root file, as raw_data_rooter.py does')
+    parser.add_argument('--layout', type=str, default=rdr.BRANCH_LAYOUT, choices=['channel', 'matrix'], help='Optional. branch layout of the raw root file (default: %s)' % rdr.BRANCH_LAYOUT)
+    required = parser.add_argument_group('Required Arguments')
+    required.add_argument('-i', '--if_path', type=str, help='Required. full path to the raw binary file', required=True)
+    required.add_argument('-c', '--yaml', type=str, help='Required. path to the yaml config file', required=True)
+    args = parser.parse_args()
+
+    rooter = RawDataRooter(args)
+    rooter.big_endian_basket = False # awkward needs native byte order
+    if args.raw_root:
+        rooter.create_output_file()
+
+    # the number of events is not known yet, estimate it from the header index
+    n_trg = len(rooter.raw_data_file.load_index())
+    run = RunDROP(args, run_info=get_rooter_run_info(rooter, n_event_proc=max(n_trg//rdr.N_BOARDS, 1)))
+    print("\nSummary of your config file:")
+    print(run.cfg.data)
+    print("")
+
+    # RQWriter creates output file, fill, and dump
+    n_aux_ch = len(run.cfg.non_signal_channels)
+    n_ch = len(run.ch_id)-n_aux_ch
+    writer = RQWriter(args, n_ch, n_aux_ch, n_roi=len(run.cfg.roi_start_ns), basket_size=run.cfg.batch_size,
+        compression=run.cfg.compression, compression_level=run.cfg.compression_level, basket_bytes=run.cfg.basket_bytes)
+    writer.init_basket_cap = int(run.n_event_proc/run.cfg.batch_size)+2
+    writer.create_output()
+
+    for batch in iter_event_batches(rooter, run.cfg.batch_size, args.workers, args.raw_root):
+        run.process_batch(batch, writer)
+        run.show_progress()
+
+    # now the real numbers are known
+    run.set_run_info(get_rooter_run_info(rooter))
+    if args.raw_root:
+        rooter.dump_run_info()
+        rooter.close_file()
+    rooter.print_summary()
+
+    writer.dump_run_rq(run.get_run_rq())
+    writer.dump_pmt_info(run.spe_fit_results)
+    # remeber to close file
+    writer.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,8 +2,11 @@
 Utility functions that are used by DROP
 """
 import math
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy import signal
+import uproot
 from matplotlib.colors import ListedColormap
 from matplotlib.cm import hsv
 from yaml_reader import SAMPLE_TO_NS
@@ -42,15 +45,70 @@ def generate_colormap(n_colors=32):
     return ListedColormap(initial_cm)
 
 
-def digitial_butter_highpass_filter(data, cutoff_Hz=3e6):
+@lru_cache(maxsize=None)
+def get_butter_highpass_sos(cutoff_Hz=3e6, order=5):
     """
-    data: 1d ndarray
-    cutoff_Hz: cut off digitizer sampling freq in hz
+    Butterworth high pass filter as second-order sections (SOS), designed
+    once per cutoff and order (cached).
+
     Source: https://scipy-cookbook.readthedocs.io/items/ButterworthBandpass.html
     """
-    order=5
     fs_Hz = 1e9/SAMPLE_TO_NS # digitizer sampling rate
     nyq = fs_Hz * 0.5
     Wn = cutoff_Hz/nyq
-    b, a = signal.butter(order, Wn, btype='high', analog=False)
-    return signal.filtfilt(b, a, data)
+    return signal.butter(order, Wn, btype='high', analog=False, output='sos')
+
+
+@lru_cache(maxsize=None)
+def get_thread_pool(n_threads):
+    """
+    Thread pool kept for the whole run, one per size.
+    """
+    return ThreadPoolExecutor(n_threads)
+
+
+def digitial_butter_highpass_filter(data, cutoff_Hz=3e6, n_threads=1):
+    """
+    Zero-phase 5th order Butterworth high pass filter along the sample (last)
+    axis, with the cached SOS of get_butter_highpass_sos.
+
+    Args:
+        data: ndarray. A trace, (channel, sample) or (event, channel, sample)
+        cutoff_Hz: cut off frequency in Hz
+        n_threads: if >1, filter slices of the first axis in a thread pool
+            (scipy releases the GIL)
+
+    Returns:
+        filtered float array of the same shape
+    """
+    sos = get_butter_highpass_sos(float(cutoff_Hz))
+    data = np.asarray(data)
+    if n_threads<=1 or data.ndim<2 or len(data)<2:
+        return signal.sosfiltfilt(sos, data, axis=-1)
+    out = np.empty(data.shape, dtype=np.result_type(data.dtype, np.float64))
+    edges = np.linspace(0, len(data), min(n_threads, len(data))+1).astype(int)
+    def work(k):
+        out[edges[k]:edges[k+1]] = signal.sosfiltfilt(sos, data[edges[k]:edges[k+1]], axis=-1)
+    list(get_thread_pool(n_threads).map(work, range(len(edges)-1)))
+    return out
+
+
+def get_compression(codec, level=1):
+    """
+    uproot compression setting from a codec name and a level.
+
+    Args:
+        codec (str): ZLIB, LZ4, ZSTD, LZMA, or None (no compression).
+            ZSTD needs the zstandard package; LZ4 needs lz4 and xxhash.
+        level (int): compression level (1 is fastest)
+
+    Returns:
+        uproot compression object, or None
+    """
+    if codec is None or str(codec).upper() in ['NONE', '']:
+        return None
+    codecs = {'ZLIB': uproot.ZLIB, 'LZ4': uproot.LZ4, 'ZSTD': uproot.ZSTD, 'LZMA': uproot.LZMA}
+    codec = str(codec).upper()
+    if codec not in codecs:
+        raise ValueError("unknown compression codec %s, use one of %s" % (codec, list(codecs)))
+    return codecs[codec](int(level))
@@ -17,6 +17,86 @@ sys.path.append(os.environ['LIB_DIR'])
 import utilities_numba as util_nb
 from yaml_reader import YamlReader, SAMPLE_TO_NS, MY_QUANTILES
 from utilities import generate_colormap, digitial_butter_highpass_filter
+from types import SimpleNamespace
+
+# float32 versions of the float kernels of util_nb (see make_numba_lib.py)
+F4_KERNELS = {'quantile_f8': 'quantile_f4', 'std': 'std_f4', 'max': 'max_f4', 'min': 'min_f4',
+    'linear_interpolation': 'linear_interpolation_f4', 'aft': 'aft_f4',
+    'rise_time': 'rise_time_f4', 'fall_time': 'fall_time_f4',
+    'rolling_baseline': 'rolling_baseline_f4'}
+_kernels = {}
+
+def get_numba_kernels(precision='float64'):
+    """
+    The numba kernels for float arrays of the given precision, under their
+    float64 names. ex. get_numba_kernels('float32').max is util_nb.max_f4
+
+    Args:
+        precision (str): float64 or float32 (YamlReader.precision)
+    """
+    if precision=='float64':
+        return util_nb
+    if precision not in _kernels:
+        names = [k for k in dir(util_nb) if not k.startswith('_')]
+        _kernels[precision] = SimpleNamespace(**{k: getattr(util_nb, F4_KERNELS.get(k, k)) for k in names})
+    return _kernels[precision]
+
+def get_baseline_window(cfg, n_samp):
+    """
+    Sample bounds of the pre-trigger baseline window (yaml key
+    baseline_window_ns, from the start of the waveform), clipped to the
+    samples before the trigger.
+
+    Args:
+        cfg (YamlReader)
+        n_samp (int): waveform length
+
+    Returns:
+        start, end: int, the window is [start, end)
+    """
+    n_pre = max(int(n_samp*(1.0-cfg.post_trigger)), 1)
+    start = int(np.clip(cfg.baseline_window_ns[0]//int(SAMPLE_TO_NS), 0, n_pre-1))
+    end = int(np.clip(cfg.baseline_window_ns[1]//int(SAMPLE_TO_NS), start+1, n_pre))
+    return start, end
+
+def get_roi_bounds(cfg, trg_pos, n_samp):
+    """
+    Sample bounds of the ROIs of the yaml config (roi_start_ns, roi_end_ns,
+    with respect to the trigger position), clipped to the waveform. An ROI
+    entirely outside of the waveform becomes empty, at its edge.
+
+    Returns:
+        start, end: int arrays of n_roi
+    """
+    start = trg_pos + cfg.roi_start_ns//int(SAMPLE_TO_NS)
+    end = trg_pos + cfg.roi_end_ns//int(SAMPLE_TO_NS)
+    return np.clip(start, 0, n_samp-1), np.clip(end, 0, n_samp-1)
+
+def calc_roi_stats(amp, amp_int, start, end):
+    """
+    Height (max), low (min), std and area in all ROIs at once, along the
+    sample (last) axis. The area is a difference of the accumulated integral;
+    the others are window reductions (reduceat) over [start, end).
+
+    Args:
+        amp: (..., sample) array, ex. (channel, sample)
+        amp_int: accumulated integral of amp (see integrate_waveform)
+        start, end: int arrays of n_roi (see get_roi_bounds)
+
+    Returns:
+        height, low, std, area: (..., n_roi) arrays. An empty ROI gives the
+        sample at start, std 0 and area 0.
+    """
+    # start0, end0, start1, end1, ...: the even reductions are the ROIs
+    idx = np.stack([start, end], axis=1).ravel()
+    height = np.maximum.reduceat(amp, idx, axis=-1)[..., ::2]
+    low = np.minimum.reduceat(amp, idx, axis=-1)[..., ::2]
+    n = np.maximum(end-start, 1)
+    mean = np.add.reduceat(amp, idx, axis=-1, dtype=np.float64)[..., ::2]/n
+    mean_sq = np.add.reduceat(np.square(amp), idx, axis=-1, dtype=np.float64)[..., ::2]/n
+    std = np.sqrt(np.maximum(mean_sq-mean*mean, 0))
+    area = amp_int[..., end]-amp_int[..., start]
+    return height, low, std, area
 
 class Waveform():
     """
@@ -30,6 +110,8 @@ class Waveform():
         """
         if cfg is not None:
             self.cfg = cfg
+            self.dtype = cfg.float_dtype # float64, or float32 (yaml key precision)
+            self.nb = get_numba_kernels(cfg.precision)
         self.ch_names = None
         self.ch_id = None
         self.ch_name_to_id_dict= None
@@ -55,16 +137,31 @@ class Waveform():
         self.flat_base_std_mV = {}
         self.flat_base_pe = {}
         self.flat_base_std_pe = {}
-        self.ma_base_pe = {} # moving average mean
-        self.ma_base_std_pe = {} # moving average std
+        self.ma_base_mV = {} # rolling baseline, on top of the flat one
+        self.ma_base_std_mV = {} # std after rolling baseline subtraction
+        self.ma_base_pe = {}
+        self.ma_base_std_pe = {}
 
-    def set_raw_data(self, val):
+    def set_raw_data(self, val, adc=None):
         """
-        Set raw data.
+        Set raw data. Supports both raw tree layouts: one adc_bX_chY branch
+        per channel, or a single 2-D adc branch with rows ordered as ch_names.
+
+        Args:
+            val: one event (record) of the raw daq tree
+            adc: optional (channel, sample) traces of this event, already
+                unpacked (adc_packed branch, see waveform_codec.py). Rows
+                ordered as ch_names.
         """
         self.raw_data = {}
-        for ch in self.ch_names:
-            self.raw_data[ch] = val[ch].to_numpy() # numpy is faster
+        if adc is None and 'adc' in val.fields:
+            adc = val['adc'].to_numpy()
+        if adc is not None:
+            for i, ch in enumerate(self.ch_names):
+                self.raw_data[ch] = adc[i]
+        else:
+            for ch in self.ch_names:
+                self.raw_data[ch] = val[ch].to_numpy() # numpy is faster
         self.event_id = val.event_id
         self.event_ttt = val.event_ttt
         self.event_sanity=val.event_sanity
@@ -109,7 +206,9 @@ class Waveform():
 
     def get_flat_baseline(self, val, summed_channel=False):
         """
-        Define a flat baseline. Find the median and std, and return them
+        Define a flat baseline. Find the median and std, and return them.
+        Over the whole waveform, or only the pre-trigger window with
+        baseline_method: pretrigger (see get_baseline_window).
 
         Args:
             val: array of float
@@ -117,11 +216,15 @@ class Waveform():
         Return:
             float, float
         """
+        if self.cfg.baseline_method=='pretrigger':
+            start, end = get_baseline_window(self.cfg, len(val))
+            val = val[start:end]
         # qx = np.quantile(val, MY_QUANTILES)
         if summed_channel:
-            qx = util_nb.quantile_f8(val, MY_QUANTILES)
+            qx = self.nb.quantile_f8(val, MY_QUANTILES)
         else:
-            qx = util_nb.quantile_u2(val, MY_QUANTILES)
+            # counting quantiles of the integer adc, same result as np.quantile
+            qx = util_nb.quantile_hist_u2(val, MY_QUANTILES)
         return qx[1], abs(qx[2]-qx[0])/2
 
     def subtract_flat_baseline(self):
@@ -139,11 +242,14 @@ class Waveform():
             med, std = self.get_flat_baseline(val)
             self.flat_base_mV[ch] = med # save a copy
             self.flat_base_std_mV[ch] = std # save a copy
-            amp = -(val-med)
-            if self.cfg.apply_high_pass_filter:
-                cutoff_Hz = self.cfg.high_pass_cutoff_Hz
-                amp = digitial_butter_highpass_filter(amp, cutoff_Hz)
-            self.amp_mV[ch] = amp*adc_to_mV
+            self.amp_mV[ch] = -(val-self.dtype(med))
+        if self.cfg.apply_high_pass_filter:
+            # all channels in one call, along the sample axis
+            amp = np.stack([self.amp_mV[ch] for ch in self.ch_names])
+            amp = digitial_butter_highpass_filter(amp, self.cfg.high_pass_cutoff_Hz, self.cfg.high_pass_threads)
+            self.amp_mV.update(zip(self.ch_names, amp.astype(self.dtype, copy=False)))
+        for ch in self.ch_names:
+            self.amp_mV[ch] = self.amp_mV[ch]*adc_to_mV
         return None
 
     def do_spe_normalization(self):
@@ -158,9 +264,12 @@ class Waveform():
             if ch in self.cfg.non_signal_channels:
                 continue
             spe_mean = self.spe_mean[ch]
-            self.amp_pe[ch] = val/50/spe_mean
+            self.amp_pe[ch] = val/50/self.dtype(spe_mean)
             self.flat_base_pe[ch] = self.flat_base_mV[ch]/50/spe_mean
             self.flat_base_std_pe[ch] = self.flat_base_std_mV[ch]/50/spe_mean
+            if ch in self.ma_base_mV:
+                self.ma_base_pe[ch] = self.ma_base_mV[ch]/50/self.dtype(spe_mean)
+                self.ma_base_std_pe[ch] = self.ma_base_std_mV[ch]/50/spe_mean
         return None
 
     def correct_daisy_chain_trg_delay(self):
@@ -197,83 +306,33 @@ class Waveform():
 
     def sum_channels(self):
         """
-        Sum up channels.
+        Sum up channels, with the membership matrix of YamlReader.get_group_matrix.
             - "sum" means the sum of all PMTs
             - "bot" means the sum of all bottom PMTs
             - "side" means the sum of all side PMTs
             - 'user' means a user-defined list.
+            - channel_groups of the yaml file give sum_<name>.
             - all in skip are skipped.
+        Baseline of 'sum'. With baseline_method: pretrigger, the baseline of
+        all sums instead (read by PulseFinder then), from the channels: the
+        pedestal left in the window (mean) and the std of each channel,
+        through the same matrix.
         """
-        tot_pe = 0
-        bt_pe = 0
-        ir_pe = 0
-        side_pe=0
-        r1_pe, r2_pe, r3_pe, r4_pe, r5_pe, r6_pe, r7_pe = 0, 0, 0, 0, 0, 0, 0
-        c1_pe, c2_pe, c3_pe, c4_pe, c5_pe, c6_pe, c7_pe, c8_pe = 0, 0, 0, 0, 0, 0, 0, 0
-        user_pe = 0
-        for ch, val in self.amp_pe.items():
-            if 'adc_' in ch:
-                if ch in self.cfg.skip_pmt_channels:
-                    continue
-                tot_pe += val
-                if ch in self.cfg.bottom_pmt_channels:
-                    bt_pe += val
-                if ch in self.cfg.side_pmt_channels:
-                    side_pe += val
-                if ch in self.cfg.row1_pmt_channels:
-                    r1_pe += val
-                if ch in self.cfg.row2_pmt_channels:
-                    r2_pe += val
-                if ch in self.cfg.row3_pmt_channels:
-                    r3_pe += val
-                if ch in self.cfg.row4_pmt_channels:
-                    r4_pe += val
-                if ch in self.cfg.row5_pmt_channels:
-                    r5_pe += val
-                if ch in self.cfg.row6_pmt_channels:
-                    r6_pe += val
-                if ch in self.cfg.row7_pmt_channels:
-                    r7_pe += val
-                if ch in self.cfg.col1_pmt_channels:
-                    c1_pe += val
-                if ch in self.cfg.col2_pmt_channels:
-                    c2_pe += val
-                if ch in self.cfg.col3_pmt_channels:
-                    c3_pe += val
-                if ch in self.cfg.col4_pmt_channels:
-                    c4_pe += val
-                if ch in self.cfg.col5_pmt_channels:
-                    c5_pe += val
-                if ch in self.cfg.col6_pmt_channels:
-                    c6_pe += val
-                if ch in self.cfg.col7_pmt_channels:
-                    c7_pe += val
-                if ch in self.cfg.col8_pmt_channels:
-                    c8_pe += val
-                if ch in self.cfg.user_pmt_channels:
-                    user_pe += val
-        self.amp_pe['sum'] = tot_pe
-        med, std = self.get_flat_baseline(tot_pe, summed_channel=True)
-        self.flat_base_pe['sum'] = med
-        self.flat_base_std_pe['sum'] = std
-        self.amp_pe['sum_bot'] = bt_pe
-        self.amp_pe['sum_side'] = side_pe
-        self.amp_pe['sum_row1'] = r1_pe
-        self.amp_pe['sum_row2'] = r2_pe
-        self.amp_pe['sum_row3'] = r3_pe
-        self.amp_pe['sum_row4'] = r4_pe
-        self.amp_pe['sum_row5'] = r5_pe
-        self.amp_pe['sum_row6'] = r6_pe
-        self.amp_pe['sum_row7'] = r7_pe
-        self.amp_pe['sum_col1'] = c1_pe
-        self.amp_pe['sum_col2'] = c2_pe
-        self.amp_pe['sum_col3'] = c3_pe
-        self.amp_pe['sum_col4'] = c4_pe
-        self.amp_pe['sum_col5'] = c5_pe
-        self.amp_pe['sum_col6'] = c6_pe
-        self.amp_pe['sum_col7'] = c7_pe
-        self.amp_pe['sum_col8'] = c8_pe
-        self.amp_pe['sum_user'] = user_pe
+        chs = [ch for ch in self.amp_pe if 'adc_' in ch]
+        names, mat = self.cfg.get_group_matrix(chs)
+        stack = np.stack([self.amp_pe[ch] for ch in chs])
+        sums = mat.astype(stack.dtype, copy=False) @ stack
+        self.amp_pe.update(zip(names, sums))
+        if self.cfg.baseline_method=='pretrigger':
+            start, end = get_baseline_window(self.cfg, stack.shape[1])
+            ped = stack[:, start:end].mean(axis=1, dtype=np.float64)
+            var = np.square([self.flat_base_std_pe[ch] for ch in chs])
+            self.flat_base_pe.update(zip(names, (mat @ ped).tolist()))
+            self.flat_base_std_pe.update(zip(names, np.sqrt(mat @ var).tolist()))
+        else:
+            med, std = self.get_flat_baseline(self.amp_pe['sum'], summed_channel=True)
+            self.flat_base_pe['sum'] = med
+            self.flat_base_std_pe['sum'] = std
         return None
 
     def define_time_axis(self):
@@ -282,7 +341,7 @@ class Waveform():
         Not often use
         """
         n_samp = len(self.amp_pe['sum'])
-        t=np.linspace(0, (n_samp-1)*SAMPLE_TO_NS, n_samp)
+        t=np.linspace(0, (n_samp-1)*SAMPLE_TO_NS, n_samp, dtype=self.dtype)
         self.time_axis_ns = t
         self.n_samp = n_samp
 
@@ -294,58 +353,45 @@ class Waveform():
         for ch, val in self.amp_pe.items():
             self.amp_pe_int[ch] = cumsum(val)*(SAMPLE_TO_NS) # adc*ns
 
-    def find_ma_baseline(self):
-        n = self.cfg.moving_avg_length
-        win = np.ones(n)
-        for ch in self.ch_names:
-            a = self.amp_mV
-            ma =  np.convolve(a, win/n, mode='valid')
-            base = np.concatenate(([val[k] for k in range(n-1)],ma))
-            std = np.std(a - base) # std after subtraction
-            self.ma_base_pe[ch]=base.copy()
-            self.ma_base_std_pe[ch] = std # bs stands for baseline subtracted
+    def subtract_rolling_baseline(self):
+        """
+        Subtract a rolling baseline on top of the flat one, for slow baseline
+        drift (yaml key baseline_method: rolling). Pulses are masked (see
+        rolling_baseline in make_numba_lib.py). New variables: ma_base_mV
+        (baseline arrays) and ma_base_std_mV (std after subtraction).
+        Call after subtract_flat_baseline.
+        """
+        adc_to_mV = self.cfg.dgtz_dynamic_range_mV/(2**14-1)
+        amp = np.stack([self.amp_mV[ch] for ch in self.ch_names])
+        base = np.empty_like(amp)
+        std = self.nb.rolling_baseline(amp, base, self.cfg.moving_avg_length,
+            self.cfg.sigma_above_baseline, self.cfg.pre_pulse, self.cfg.post_pulse, adc_to_mV)
+        amp -= base
+        self.amp_mV.update(zip(self.ch_names, amp))
+        self.ma_base_mV.update(zip(self.ch_names, base))
+        self.ma_base_std_mV.update(zip(self.ch_names, std.tolist()))
         return None
 
     def calc_roi_info(self):
         """
-        Calculate variables within a region of interest (ROI) -- ROI an interval
-        whose start_ns and end_ns are defined in yaml config file
+        Calculate variables within regions of interest (ROI) -- intervals
+        whose start_ns and end_ns are defined in yaml config file. Any number
+        of ROIs, all in one pass (see calc_roi_stats).
 
-        The following info are calculated:
+        The following info are calculated, as (channel, roi) arrays of the
+        signal channels (roi_ch_names):
         - area, in unit of PE
         - height, in unit of PE/ns
         - low, in uint of PE/ns
         - std, in unit of PE/ns and mV
         """
-        self.roi_area_pe=[]
-        self.roi_height_pe=[]
-        self.roi_low_pe=[]
-        self.roi_std_pe=[]
-        self.roi_std_mV=[]
-        for i in range(len(self.cfg.roi_start_ns)):
-            start= self.trg_pos + (self.cfg.roi_start_ns[i]//int(SAMPLE_TO_NS))
-            end= self.trg_pos + (self.cfg.roi_end_ns[i]//int(SAMPLE_TO_NS))
-            start=max(0, start)
-            end = min(self.n_samp-1, end)
-            height_pe={}
-            area_pe = {}
-            low_pe = {}
-            std_pe = {}
-            std_mV = {}
-            for ch, a in self.amp_pe.items():
-                if ch[0:4]!='adc_':
-                    continue
-                height_pe[ch] = util_nb.max(a[start:end])
-                low_pe[ch] = util_nb.min(a[start:end])
-                std_pe[ch] = util_nb.std(a[start:end])
-                std_mV[ch] = std_pe[ch]*50*self.spe_mean[ch]
-                a_int =  self.amp_pe_int[ch]
-                area_pe[ch] = a_int[end]-a_int[start]
-            self.roi_height_pe.append(height_pe)
-            self.roi_area_pe.append(area_pe)
-            self.roi_low_pe.append(low_pe)
-            self.roi_std_pe.append(std_pe)
-            self.roi_std_mV.append(std_mV)
+        self.roi_ch_names = [ch for ch in self.amp_pe if ch[0:4]=='adc_']
+        amp = np.stack([self.amp_pe[ch] for ch in self.roi_ch_names])
+        amp_int = np.stack([self.amp_pe_int[ch] for ch in self.roi_ch_names])
+        start, end = get_roi_bounds(self.cfg, self.trg_pos, self.n_samp)
+        self.roi_height_pe, self.roi_low_pe, self.roi_std_pe, self.roi_area_pe = calc_roi_stats(amp, amp_int, start, end)
+        spe_mean = np.array([self.spe_mean[ch] for ch in self.roi_ch_names])
+        self.roi_std_mV = self.roi_std_pe*50*spe_mean[:, None]
         return None
 
     def calc_aux_ch_info(self):
@@ -0,0 +1,100 @@
+'''
+Lossless codec for 14-bit ADC traces: delta + zigzag + bit-packing.
+
+Consecutive samples of a quiet baseline differ by a few adc counts, so the
+deltas fit in a few bits. Each event is packed into one uint8 array:
+
+    n_ch (2 bytes), n_samples (2 bytes), then for each channel:
+        first sample (2 bytes)
+        for each block of 64 deltas: bit width w (1 byte), then the
+        zigzag-encoded deltas, w bits each (little-endian bit order)
+
+All numbers are little-endian. A block costs 1+ceil(64*w/8) bytes, so a
+baseline with deltas within [-4, 3] (w=3) takes ~0.4 byte/sample instead of
+2. The kernels are in make_numba_lib.py (utilities_numba library).
+
+In the raw root file, the packed events are the jagged uint8 branch
+`adc_packed`, with channels in the order of active_ch_id of run_info.
+'''
+
+import os
+import sys
+import numpy as np
+import awkward as ak
+sys.path.append(os.environ['LIB_DIR'])
+import utilities_numba as util_nb
+
+PACKED_BRANCH = 'adc_packed'
+CODEC_BLOCK = 64 # must match make_numba_lib.py
+
+
+def max_packed_size(n_evts, n_ch, n_samples):
+    """
+    Upper bound of the packed size in bytes (17 bits per delta)
+    """
+    n_blocks = -(-(n_samples-1)//CODEC_BLOCK)
+    per_ch = 2 + n_blocks + (17*(n_samples-1)+7)//8 + n_blocks
+    return n_evts*(4 + n_ch*per_ch)
+
+
+def pack_events(adc):
+    """
+    Pack traces.
+
+    Args:
+        adc: (event, channel, sample) array of uint16
+
+    Returns:
+        content (uint8 array), offsets (int64 array of n_events+1). Event i
+        is content[offsets[i]:offsets[i+1]].
+    """
+    adc = np.ascontiguousarray(adc, dtype=np.uint16)
+    n_evts, n_ch, n_samples = adc.shape
+    out = np.empty(max_packed_size(n_evts, n_ch, n_samples), dtype=np.uint8)
+    offsets = np.zeros(n_evts+1, dtype=np.int64)
+    n_bytes = util_nb.pack_events_u2(adc, out, offsets)
+    return out[:n_bytes], offsets
+
+
+def unpack_events(content, offsets):
+    """
+    Inverse of pack_events.
+
+    Returns:
+        (event, channel, sample) array of uint16
+    """
+    content = np.ascontiguousarray(content, dtype=np.uint8)
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    n_evts = len(offsets)-1
+    if n_evts<=0:
+        return np.zeros([0, 0, 0], dtype=np.uint16)
+    head = content[offsets[0]:offsets[0]+4].astype(np.int64)
+    n_ch = int(head[0] | (head[1] << 8))
+    n_samples = int(head[2] | (head[3] << 8))
+    adc = np.empty([n_evts, n_ch, n_samples], dtype=np.uint16)
+    util_nb.unpack_events_u2(content, offsets, adc)
+    return adc
+
+
+def to_awkward(content, offsets):
+    """
+    Packed events as a jagged awkward array (one uint8 list per event), for
+    uproot to write as a branch.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    return ak.unflatten(content[offsets[0]:offsets[-1]], np.diff(offsets))
+
+
+def unpack_awkward(packed):
+    """
+    Unpack a jagged awkward array of packed events (ex. the adc_packed branch
+    of an uproot batch).
+
+    Returns:
+        (event, channel, sample) array of uint16
+    """
+    counts = ak.to_numpy(ak.num(packed))
+    offsets = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    content = ak.to_numpy(ak.flatten(packed))
+    return unpack_events(content, offsets)
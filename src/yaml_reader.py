@@ -1,11 +1,16 @@
 import yaml
-from numpy import array
+from numpy import array, zeros, float32, float64
 
 """
 The following parameters do not change often. So hard coded here
 """
 SAMPLE_TO_NS=2
 MY_QUANTILES= array([0.15865, 0.5, 0.84135])
+# built-in summed channels: name -> attribute holding its channel list (None: all PMTs)
+SUM_GROUPS = [('sum', None), ('sum_bot', 'bottom_pmt_channels'), ('sum_side', 'side_pmt_channels')] \
+    + [('sum_row%d' % k, 'row%d_pmt_channels' % k) for k in range(1, 8)] \
+    + [('sum_col%d' % k, 'col%d_pmt_channels' % k) for k in range(1, 9)] \
+    + [('sum_user', 'user_pmt_channels')]
 
 class ScipyPeakFindingParam():
     """
@@ -66,6 +71,32 @@ class YamlReader():
         else:
             print("ERROR: not a list")
 
+    def get_group_matrix(self, ch_names):
+        """
+        Membership matrix of the summed channels (SUM_GROUPS, then the
+        channel_groups of the yaml file), compiled once per channel list.
+        Channels in skip_pmt_channels, or not starting with 'adc_', belong to
+        no group.
+
+        Args:
+            ch_names (list): channel names, in the row order of the waveforms to sum
+
+        Returns:
+            list of group names, (group, channel) float array of 0 and 1
+        """
+        key = tuple(ch_names)
+        if key not in self.group_matrix_cache:
+            groups = {name: (None if attr is None else getattr(self, attr)) for name, attr in SUM_GROUPS}
+            groups.update(self.channel_groups)
+            used = [ch[0:4]=='adc_' and ch not in self.skip_pmt_channels for ch in ch_names]
+            mat = zeros((len(groups), len(ch_names)))
+            for k, members in enumerate(groups.values()):
+                for i, ch in enumerate(ch_names):
+                    if used[i] and (members is None or ch in members):
+                        mat[k, i] = 1
+            self.group_matrix_cache[key] = (list(groups), mat)
+        return self.group_matrix_cache[key]
+
     def type_casting(self):
         """
         The right variable type
@@ -93,6 +124,9 @@ class YamlReader():
         self.col8_pmt_channels= self.get_ch_names( self.data['col8_pmt_channels'] )
         self.user_pmt_channels=self.get_ch_names( self.data['user_pmt_channels'] )
         self.skip_pmt_channels=self.get_ch_names( self.data['skip_pmt_channels'] )
+        # user-defined summed channels. Optional key: {name: channel list}, summed into sum_<name>
+        self.channel_groups = {'sum_'+str(k): self.get_ch_names(v) for k, v in (self.data.get('channel_groups') or {}).items()}
+        self.group_matrix_cache = {}
         self.ch_saturated_threshold = int(self.data['ch_saturated_threshold'])
 
         self.spe_fit_results_file = self.data['spe_fit_results_file']
@@ -101,10 +135,19 @@ class YamlReader():
         self.daisy_chain = bool(self.data['daisy_chain'])
         self.apply_high_pass_filter = bool(self.data['apply_high_pass_filter'])
         self.high_pass_cutoff_Hz = float(self.data['high_pass_cutoff_Hz'])
+        self.high_pass_threads = int(self.data.get('high_pass_threads', 1)) # optional. threads for the filter
         self.moving_avg_length = int(self.data['moving_avg_length'])
         self.sigma_above_baseline = float(self.data['sigma_above_baseline'])
         self.pre_pulse = int(self.data['pre_pulse'])
         self.post_pulse = int(self.data['post_pulse'])
+        # baseline subtraction. Optional key: flat (default), or rolling (flat, then the rolling baseline with the 4 keys above)
+        self.baseline_method = str(self.data.get('baseline_method', 'flat'))
+        if self.baseline_method not in ['flat', 'pretrigger', 'rolling']:
+            raise ValueError("unknown baseline_method %s, use flat, pretrigger or rolling" % self.baseline_method)
+        # pre-trigger baseline window [start, end) in ns from the start of the waveform. Optional key
+        self.baseline_window_ns = array(self.data.get('baseline_window_ns', [0, 300]), dtype=int)
+        if self.baseline_window_ns.shape!=(2,) or self.baseline_window_ns[0]>=self.baseline_window_ns[1]:
+            raise ValueError("baseline_window_ns must be [start, end] with start < end")
 
 
         self.roi_start_ns = array(self.data['roi_start_ns'], dtype=int)
@@ -118,4 +161,18 @@ class YamlReader():
         self.scipy_pf_pars.prominence = int(self.data['scipy_peak_finder_parameters']['prominence'])
         self.spe_height_threshold = float(self.data['spe_height_threshold'])
 
+        # float precision of the waveform arrays and kernels. Optional key: float64 (default) or float32
+        self.precision = str(self.data.get('precision', 'float64'))
+        if self.precision not in ['float64', 'float32']:
+            raise ValueError("unknown precision %s, use float64 or float32" % self.precision)
+        self.float_dtype = float32 if self.precision=='float32' else float64
+
+        # waveform engine. Optional key: True runs the waveform steps on whole blocks of events (batch_waveform.py), False event by event
+        self.batch_waveform = bool(self.data.get('batch_waveform', False))
+
+        # RQ output file. Optional keys, default to uproot's default (ZLIB level 1, one basket per batch)
+        self.compression = self.data.get('compression', 'ZLIB')
+        self.compression_level = int(self.data.get('compression_level', 1))
+        self.basket_bytes = int(self.data.get('basket_bytes', 0))
+
         return None
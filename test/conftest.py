@@ -0,0 +1,14 @@
+'''
+Make the modules in src/ and the numba library (LIB_DIR, see build.sh)
+importable. Tests of compiled kernels are skipped if the library is not built.
+'''
+
+import os
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+DROP_DIR = os.path.dirname(TEST_DIR)
+
+os.environ.setdefault('LIB_DIR', os.path.join(DROP_DIR, 'lib'))
+sys.path.insert(0, os.path.join(DROP_DIR, 'src'))
+sys.path.append(os.environ['LIB_DIR'])
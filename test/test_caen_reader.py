@@ -0,0 +1,195 @@
+import numpy as np
+import pytest
+from caen_reader import RawDataFile, decode_V1740_group, decode_zle_channel, find_next_header
+
+
+def test_decode_V1740_group_matches_word_by_word():
+    rng = np.random.default_rng(0)
+    words = rng.integers(0, 2**32, size=9*5, dtype=np.uint64).astype(np.uint32)
+    out = decode_V1740_group(words)
+    assert out.shape == (8, 15)
+    assert out.dtype == np.uint16
+    # decode_V1740_data gives 3 samples of each channel per 9 words
+    blocks = [RawDataFile.decode_V1740_data(None, words[i:i+9].tolist()) for i in range(0, len(words), 9)]
+    expected = np.concatenate([np.reshape(b, (8, 3)) for b in blocks], axis=1)
+    np.testing.assert_array_equal(out, expected)
+    assert out.max() < 2**12
+
+
+def header_bytes(event_counter, boardId=1, size=4, dtype='<u4'):
+    return np.array([0xA0000000 | size, boardId << 27, event_counter, 0], dtype=dtype).view(np.uint8)
+
+
+@pytest.mark.parametrize('big_endian', [False, True])
+def test_find_next_header(big_endian):
+    dtype = '>u4' if big_endian else '<u4'
+    junk = np.full(7, 0xA5, dtype=np.uint8) # top nibble 0xA at every alignment
+    buf = np.concatenate([junk, header_bytes(100, dtype=dtype), header_bytes(41, dtype=dtype)])
+    # event counter too far off: the first header is rejected
+    assert find_next_header(buf, 40, big_endian=big_endian) == 7 + 16
+    assert find_next_header(buf, 99, big_endian=big_endian) == 7
+    assert find_next_header(buf, 70, big_endian=big_endian) == -1
+    assert find_next_header(buf, 95, max_delta=10, big_endian=big_endian) == 7
+
+
+def test_find_next_header_board_id():
+    buf = np.concatenate([header_bytes(5, boardId=7), header_bytes(5, boardId=2)])
+    assert find_next_header(buf, 5) == 16
+    assert find_next_header(buf, 5, max_board_id=None) == 0
+    assert find_next_header(buf[:15], 5) == -1 # shorter than a header
+
+
+def zle_payload():
+    """
+    skip 3 words (6 samples), 2 data words, skip 1 word, 1 data word
+    """
+    good = 0x80000000
+    data = [0x00020001, 0x00040003, 0x00060005]
+    words = [3, good | 2, data[0], data[1], 1, good | 1, data[2]]
+    return np.array(words, dtype=np.uint32)
+
+
+def test_decode_zle_channel_dense():
+    pytest.importorskip('utilities_numba')
+    out = decode_zle_channel(zle_payload(), 14)
+    expected = np.full(14, np.nan)
+    expected[6:10] = [1, 2, 3, 4]
+    expected[12:14] = [5, 6]
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_decode_zle_channel_sparse():
+    pytest.importorskip('utilities_numba')
+    offsets, counts, samples = decode_zle_channel(zle_payload(), 14, sparse=True)
+    np.testing.assert_array_equal(offsets, [6, 12])
+    np.testing.assert_array_equal(counts, [4, 2])
+    np.testing.assert_array_equal(samples, [1, 2, 3, 4, 5, 6])
+    assert samples.dtype == np.uint16
+
+
+def test_decode_zle_channel_truncated():
+    # samples past n_samples are dropped
+    pytest.importorskip('utilities_numba')
+    out = decode_zle_channel(zle_payload(), 8)
+    expected = np.full(8, np.nan)
+    expected[6:8] = [1, 2]
+    np.testing.assert_array_equal(out, expected)
+
+
+def write_binary(path, n_events=30, boards=(1, 2, 3, 4), chans=(0, 2), n_samples=8, zle=False, junk_at=None):
+    """
+    Write a small V1730 binary file, one trigger per board and event. With
+    zle, each channel is encoded as 2 skipped samples then the rest of the
+    trace. With junk_at, 37 bytes of garbage follow the first trigger of that
+    event.
+    """
+    rng = np.random.default_rng(6)
+    mask = sum(1 << c for c in chans)
+    out = bytearray()
+    for ev in range(1, n_events+1):
+        for b in boards:
+            data = rng.integers(0, 2**14, size=(len(chans), n_samples)).astype('<u2')
+            if zle:
+                n_words = n_samples//2
+                payload = b''.join(
+                    np.r_[np.array([3+n_words-1, 1, 0x80000000 | (n_words-1)], dtype='<u4'), trace.view('<u4')[1:]].tobytes()
+                    for trace in data)
+            else:
+                payload = data.tobytes()
+            i0 = 0xA0000000 | (4 + len(payload)//4)
+            i1 = (b << 27) | (int(zle) << 24) | (mask & 0xff)
+            i2 = ((mask >> 8) << 24) | ev
+            i3 = (1000*ev + b) & 0x7FFFFFFF
+            out += np.array([i0, i1, i2, i3], dtype='<u4').tobytes() + payload
+            if ev == junk_at and b == boards[0]:
+                out += bytes(rng.integers(0, 256, 37, dtype=np.uint8))
+    with open(path, 'wb') as f:
+        f.write(out)
+    return path
+
+
+def read_all(path, n=None):
+    """
+    All triggers of a file, with getNextTrigger (n=None) or read_triggers(n)
+    """
+    rdf = RawDataFile(str(path), n_boards=4)
+    trgs = []
+    if n is None:
+        while True:
+            trg = rdf.getNextTrigger()
+            if trg is None:
+                break
+            trgs.append(trg)
+    else:
+        while True:
+            batch = rdf.read_triggers(n)
+            if batch is None:
+                break
+            trgs += [batch.get_trigger(i) for i in range(len(batch))]
+    return rdf, trgs
+
+
+def assert_same_triggers(trgs, ref):
+    assert len(trgs) == len(ref)
+    for trg, r in zip(trgs, ref):
+        assert (trg.boardId, trg.eventCounter, trg.sanity) == (r.boardId, r.eventCounter, r.sanity)
+        assert int(trg.triggerTimeTag) == int(r.triggerTimeTag)
+        assert list(trg.traces) == list(r.traces)
+        for name in r.traces:
+            np.testing.assert_array_equal(trg.traces[name], r.traces[name])
+
+
+@pytest.mark.parametrize('zle', [False, True])
+@pytest.mark.parametrize('n', [4, 40, 1000])
+def test_read_triggers_matches_getNextTrigger(tmp_path, zle, n):
+    if zle:
+        # ZLE boards go through getNextTrigger, board by board
+        pytest.importorskip('utilities_numba')
+    path = write_binary(tmp_path/'run.bin', zle=zle)
+    _, ref = read_all(path)
+    assert len(ref) == 120
+    rdf, trgs = read_all(path, n)
+    assert_same_triggers(trgs, ref)
+    assert rdf.trigger_counter == len(ref)
+
+
+def test_read_triggers_resync(tmp_path):
+    path = write_binary(tmp_path/'bad.bin', junk_at=11)
+    ref_file, ref = read_all(path)
+    rdf, trgs = read_all(path, 40)
+    assert_same_triggers(trgs, ref)
+    assert rdf.n_bytes_skipped == ref_file.n_bytes_skipped == 37
+
+
+def test_build_index_and_seek_trigger(tmp_path):
+    path = write_binary(tmp_path/'run.bin', junk_at=11)
+    _, ref = read_all(path)
+    rdf = RawDataFile(str(path), n_boards=4)
+    index = rdf.build_index()
+    assert path.with_name('run.bin.idx.npy').exists()
+    np.testing.assert_array_equal(index['offset'], [trg.filePos for trg in ref])
+    np.testing.assert_array_equal(index['eventCounter'], [trg.eventCounter for trg in ref])
+    np.testing.assert_array_equal(index['boardId'], [trg.boardId for trg in ref])
+    rdf.seek_trigger(57)
+    trg = rdf.getNextTrigger()
+    assert (trg.boardId, trg.eventCounter) == (ref[57].boardId, ref[57].eventCounter)
+
+
+def test_read_triggers_raises_on_empty_channel_mask(tmp_path):
+    # not a silent end of file in the middle of the run
+    path = write_binary(tmp_path/'empty.bin', chans=())
+    rdf = RawDataFile(str(path), n_boards=4)
+    with pytest.raises(IOError):
+        rdf.read_triggers(40)
+
+
+def test_resync_quiet(tmp_path, capsys):
+    path = write_binary(tmp_path/'bad.bin', junk_at=11)
+    rdf = RawDataFile(str(path), n_boards=4)
+    rdf.verbosity = 0
+    n = 0
+    while rdf.getNextTrigger() is not None:
+        n += 1
+    assert n == 120 and rdf.n_bytes_skipped == 37
+    assert len(rdf.resync_log) == 1
+    assert 'resync' not in capsys.readouterr().out
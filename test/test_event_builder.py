@@ -0,0 +1,176 @@
+import numpy as np
+import pytest
+from caen_reader import RawTrigger
+from event_builder import EventBuilder, IntervalIdSet, ch_name_to_id
+
+CH_NAMES = ['b2_ch1', 'b1_ch0', 'b1_ch1', 'b2_ch0']
+N_SAMPLES = 4
+
+
+def make_trigger(boardId, eventCounter, sanity=1):
+    trg = RawTrigger()
+    trg.boardId = boardId
+    trg.eventCounter = eventCounter
+    trg.sanity = sanity
+    trg.triggerTimeTag = np.uint64(1000*eventCounter + boardId)
+    for ch in range(2):
+        trg.traces['b%d_ch%d' % (boardId, ch)] = np.full(N_SAMPLES, 100*eventCounter + 10*boardId + ch, dtype=np.uint16)
+    return trg
+
+
+def test_ch_name_to_id():
+    assert ch_name_to_id('b2_ch11') == 211
+
+
+def test_event_complete_when_all_boards_filled():
+    eb = EventBuilder(CH_NAMES, [1, 2], N_SAMPLES, capacity=8)
+    assert eb.ch_names == ['b1_ch0', 'b1_ch1', 'b2_ch0', 'b2_ch1']
+    assert eb.add_trigger(make_trigger(2, 5))
+    assert eb.add_trigger(make_trigger(1, 6))
+    assert eb.n_ready() == 0
+    assert eb.add_trigger(make_trigger(1, 5))
+    assert not eb.add_trigger(make_trigger(1, 5)) # duplicated
+    assert eb.n_ready() == 1
+
+    events = eb.pop_ready()
+    np.testing.assert_array_equal(events['event_id'], [5])
+    np.testing.assert_array_equal(events['event_ttt'], [5001]) # from the first board
+    np.testing.assert_array_equal(events['event_sanity'], [11])
+    np.testing.assert_array_equal(events['adc'][0, :, 0], [510, 511, 520, 521])
+    assert eb.pop_ready() is None
+    np.testing.assert_array_equal(eb.queued_event_id(), [6])
+
+
+def test_full_queue_evicts_incomplete_event():
+    eb = EventBuilder(CH_NAMES, [1, 2], N_SAMPLES, capacity=4)
+    eb.add_trigger(make_trigger(1, 1))
+    eb.add_trigger(make_trigger(1, 5)) # same slot as event 1
+    assert eb.n_evicted == 1
+    np.testing.assert_array_equal(eb.queued_event_id(), [5])
+
+
+
+def test_pop_ready_into_preallocated_buffers():
+    eb = EventBuilder(CH_NAMES, [1, 2], N_SAMPLES, capacity=8)
+    for ID in [3, 4]:
+        for board in [1, 2]:
+            eb.add_trigger(make_trigger(board, ID))
+    out = {
+        'adc': np.zeros([5, 4, N_SAMPLES], dtype='>u2'),
+        'event_id': np.zeros(5, dtype=np.uint32),
+        'event_ttt': np.zeros(5, dtype=np.uint64),
+        'event_sanity': np.zeros(5, dtype=np.uint16),
+    }
+    events = eb.pop_ready(out=out)
+    np.testing.assert_array_equal(events['event_id'], [3, 4])
+    np.testing.assert_array_equal(out['adc'][:2, :, 0], [[310, 311, 320, 321], [410, 411, 420, 421]])
+    assert eb.n_queued == 0
+
+
+def test_interval_id_set_matches_set():
+    rng = np.random.default_rng(1)
+    ids = np.concatenate([np.arange(100, 200), rng.integers(0, 400, size=300)])
+    s = IntervalIdSet()
+    ref = set()
+    for ID in ids[:150].tolist():
+        s.add(ID)
+        ref.add(ID)
+    s.update(ids[150:])
+    ref.update(ids[150:].tolist())
+    assert len(s) == len(ref)
+    assert all((ID in s) == (ID in ref) for ID in range(-5, 410))
+    # intervals are sorted, disjoint and not touching
+    assert all(b < a for a, b in zip(s.starts[1:], s.stops[:-1]))
+
+
+def test_interval_id_set_merges_ranges():
+    s = IntervalIdSet()
+    s.add_range(10, 20)
+    s.add_range(30, 40)
+    s.add_range(0, 5)
+    assert s.n_intervals() == 3
+    s.add_range(15, 30) # bridges the first two
+    assert (s.starts, s.stops) == ([0, 10], [5, 40])
+    assert len(s) == 35
+    s.add(5)
+    assert (s.starts, s.stops) == ([0, 10], [6, 40])
+    assert len(s) == 36
+
+
+def test_event_builder_state_round_trip():
+    eb = EventBuilder(CH_NAMES, [1, 2], N_SAMPLES, capacity=8)
+    eb.add_trigger(make_trigger(1, 7)) # incomplete
+    eb.add_trigger(make_trigger(1, 9))
+    eb.add_trigger(make_trigger(2, 9)) # complete, not popped yet
+    state = eb.get_state()
+
+    eb2 = EventBuilder(CH_NAMES, [1, 2], N_SAMPLES, capacity=8)
+    eb2.set_state(state)
+    assert eb2.n_queued == 2 and eb2.n_ready() == 1
+    events = eb2.pop_ready()
+    np.testing.assert_array_equal(events['event_id'], [9])
+    np.testing.assert_array_equal(events['adc'][0, :, 0], [910, 911, 920, 921])
+    # the incomplete event is completed after the restart
+    eb2.add_trigger(make_trigger(2, 7))
+    events = eb2.pop_ready()
+    np.testing.assert_array_equal(events['event_id'], [7])
+    np.testing.assert_array_equal(events['event_sanity'], [11])
+
+
+def test_interval_id_set_state_round_trip():
+    s = IntervalIdSet()
+    s.update([1, 2, 3, 10, 11, 50])
+    s2 = IntervalIdSet()
+    s2.set_state(s.get_state())
+    assert (s2.starts, s2.stops, len(s2)) == (s.starts, s.stops, len(s))
+    empty = IntervalIdSet()
+    empty.set_state(IntervalIdSet().get_state())
+    assert len(empty) == 0 and 1 not in empty
+
+
+def pop_all(eb):
+    events = eb.pop_ready()
+    return None if events is None else {key: val.tolist() for key, val in events.items()}
+
+
+@pytest.mark.parametrize('capacity', [4, 64])
+@pytest.mark.parametrize('chunk_size', [3, 10])
+def test_add_block_matches_add_trigger(capacity, chunk_size):
+    # boards out of order, a duplicate, an event missing board 1, and chunks
+    # spanning more than the capacity
+    rng = np.random.default_rng(7)
+    trgs = [make_trigger(b, ID, sanity=int(rng.integers(0, 2))) for ID in range(1, 30) for b in [1, 2] if (b, ID)!=(1, 5)]
+    trgs.append(make_trigger(2, 12))
+    ref = EventBuilder(CH_NAMES, [1, 2], N_SAMPLES, capacity=capacity)
+    eb = EventBuilder(CH_NAMES, [1, 2], N_SAMPLES, capacity=capacity)
+    n_dup = 0
+    for start in range(1, 30, chunk_size):
+        chunk = [trg for trg in trgs if start <= trg.eventCounter < start+chunk_size]
+        for b in [2, 1]:
+            board = sorted([trg for trg in chunk if trg.boardId==b], key=lambda trg: trg.eventCounter)
+            for trg in board:
+                ref.add_trigger(trg)
+            added = eb.add_block(b, [trg.eventCounter for trg in board], np.stack([np.stack(list(trg.traces.values())) for trg in board]),
+                np.array([trg.triggerTimeTag for trg in board]), np.array([trg.sanity for trg in board]))
+            n_dup += int(np.sum(~added))
+        assert pop_all(eb) == pop_all(ref)
+        assert (eb.n_queued, eb.n_evicted) == (ref.n_queued, ref.n_evicted)
+    assert n_dup == 1
+    np.testing.assert_array_equal(eb.queued_event_id(), ref.queued_event_id())
+
+
+def test_add_block_channel_order():
+    eb = EventBuilder(CH_NAMES, [1, 2], N_SAMPLES, capacity=8)
+    block = np.arange(2*N_SAMPLES, dtype=np.uint16).reshape(1, 2, N_SAMPLES)
+    eb.add_block(2, [3], block, np.zeros(1, dtype=np.uint64), np.zeros(1), channels=[1, 0])
+    eb.add_block(1, [3], block, np.zeros(1, dtype=np.uint64), np.zeros(1))
+    events = eb.pop_ready()
+    np.testing.assert_array_equal(events['adc'][0], block[0, [0, 1, 1, 0]])
+
+
+def test_interval_id_set_isin():
+    s = IntervalIdSet()
+    s.update([1, 2, 3, 10, 11, 50])
+    ids = np.arange(-2, 60)
+    np.testing.assert_array_equal(s.isin(ids), [ID in s for ID in ids.tolist()])
+    assert not np.any(IntervalIdSet().isin(ids))
@@ -0,0 +1,39 @@
+import types
+import numpy as np
+import pytest
+import raw_data_rooter
+from caen_reader import RawDataFile
+from raw_data_rooter import RawDataRooter
+from test_caen_reader import write_binary
+
+
+@pytest.fixture(autouse=True)
+def ettt_off(monkeypatch):
+    # write_binary writes the default 32-bit trigger time tag
+    monkeypatch.setattr(raw_data_rooter, 'ETTT_FLAG', False)
+
+
+def make_rooter(path, start_id=0):
+    args = types.SimpleNamespace(if_path=str(path), output_dir=str(path.parent), start_id=start_id, end_id=10**9)
+    return RawDataRooter(args)
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+@pytest.mark.parametrize('start_id', [0, 15])
+@pytest.mark.parametrize('cached_index', [False, True])
+def test_iter_chunks(tmp_path, n_workers, start_id, cached_index):
+    path = write_binary(tmp_path/'bad_20240101T0000.bin', junk_at=11)
+    if cached_index:
+        RawDataFile(str(path), n_boards=4).build_index()
+    rooter = make_rooter(path, start_id)
+    if start_id>0:
+        rooter.seek_start_id()
+    batches = list(rooter.iter_chunks(25, n_workers))
+    assert all(len(batch)<=25 for batch in batches)
+    trg_id = np.concatenate([batch.eventCounter for batch in batches])
+    np.testing.assert_array_equal(trg_id, np.repeat(np.arange(start_id, 31), 4)[4*(start_id==0):])
+    ttt = np.concatenate([batch.triggerTimeTag for batch in batches])
+    np.testing.assert_array_equal(ttt, 1000*trg_id + np.tile([1, 2, 3, 4], len(trg_id)//4))
+    # the junk after event 11 is counted once, by whichever process read it
+    assert rooter.raw_data_file.n_bytes_skipped == (37 if start_id<=11 else 0)
+    assert int(batches[-1].reader_state['reader_n_bytes_skipped']) == rooter.raw_data_file.n_bytes_skipped
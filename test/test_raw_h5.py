@@ -0,0 +1,18 @@
+import pytest
+import raw_h5
+from raw_h5 import get_h5_compression
+
+
+def test_get_h5_compression(monkeypatch, capsys):
+    monkeypatch.setattr(raw_h5, 'hdf5plugin', None)
+    assert get_h5_compression(None) == {}
+    assert get_h5_compression('none') == {}
+    gzip = {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+    assert get_h5_compression('zlib', 4) == gzip
+    assert capsys.readouterr().out == ''
+    # no silent fallback
+    for codec in ['LZMA', 'ZSTD', 'LZ4']:
+        assert get_h5_compression(codec, 4) == gzip
+        assert 'WARNING' in capsys.readouterr().out
+    with pytest.raises(ValueError):
+        get_h5_compression('BZIP2')
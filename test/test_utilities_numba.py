@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+util_nb = pytest.importorskip('utilities_numba')
+
+Q = np.array([0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0])
+
+
+@pytest.mark.parametrize('n_samples', [1, 2, 7, 1000])
+def test_quantile_hist_u2(n_samples):
+    rng = np.random.default_rng(3)
+    a = rng.integers(7000, 7100, size=n_samples).astype(np.uint16)
+    np.testing.assert_allclose(util_nb.quantile_hist_u2(a, Q), np.quantile(a, Q))
+
+
+def test_quantile_hist_u2_full_range():
+    a = np.array([0, 2**14-1, 5, 5, 9000], dtype=np.uint16)
+    np.testing.assert_allclose(util_nb.quantile_hist_u2(a, Q), np.quantile(a, Q))
+
+
+def test_quantile_hist_batch_u2():
+    rng = np.random.default_rng(4)
+    adc = rng.integers(0, 2**14, size=(3, 4, 50)).astype(np.uint16)
+    out = util_nb.quantile_hist_batch_u2(adc, Q)
+    assert out.shape == (3, 4, len(Q))
+    np.testing.assert_allclose(out, np.moveaxis(np.quantile(adc, Q, axis=2), 0, -1))
+
+
+def test_rolling_baseline_holds_across_pulses():
+    rng = np.random.default_rng(5)
+    n_samp = 2000
+    a = np.stack([np.full(n_samp, 3.0), 3.0 + rng.normal(0, 0.5, n_samp)])
+    a[:, 1000:1050] += 200 # pulse
+    base = np.empty_like(a)
+    std = util_nb.rolling_baseline(a, base, 100, 5.0, 5, 20, 0.1)
+    # flat trace: the pulse never enters the window
+    np.testing.assert_array_equal(base[0], 3.0)
+    assert std[0] == 0
+    # noisy trace: baseline and noise are not pulled by the pulse
+    np.testing.assert_allclose(base[1, 1000:1100], 3.0, atol=0.3)
+    assert 0.4 < std[1] < 0.6
+
+    base_f4 = np.empty(a.shape, dtype=np.float32)
+    std_f4 = util_nb.rolling_baseline_f4(a.astype(np.float32), base_f4, 100, 5.0, 5, 20, 0.1)
+    np.testing.assert_allclose(std_f4, std, atol=1e-3)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('utilities_numba')
+from waveform_codec import pack_events, unpack_events, to_awkward, unpack_awkward, max_packed_size
+
+
+def make_traces(n_evts=5, n_ch=3, n_samples=200):
+    rng = np.random.default_rng(2)
+    # quiet baseline, plus a pulse and full-range jumps
+    adc = 8000 + np.cumsum(rng.integers(-3, 4, size=(n_evts, n_ch, n_samples)), axis=2)
+    adc[:, :, 90:95] -= 5000
+    adc[0, 0, 10] = 0
+    adc[0, 0, 11] = 2**14-1
+    return adc.astype(np.uint16)
+
+
+@pytest.mark.parametrize('n_samples', [1, 2, 64, 65, 200])
+def test_round_trip(n_samples):
+    adc = make_traces()[:, :, :n_samples]
+    content, offsets = pack_events(adc)
+    assert len(content) == offsets[-1] <= max_packed_size(*adc.shape)
+    np.testing.assert_array_equal(unpack_events(content, offsets), adc)
+
+
+def test_baseline_compresses():
+    adc = make_traces()
+    content, offsets = pack_events(adc)
+    assert len(content) < 0.5*adc.nbytes
+
+
+def test_awkward_round_trip():
+    adc = make_traces()
+    content, offsets = pack_events(adc)
+    packed = to_awkward(content, offsets)
+    assert len(packed) == len(adc)
+    np.testing.assert_array_equal(unpack_awkward(packed), adc)
+    # a slice of events, as read back by entry range
+    np.testing.assert_array_equal(unpack_awkward(packed[2:4]), adc[2:4])
@@ -0,0 +1,69 @@
+"""
+Check that the whole-batch waveform engine (src/batch_waveform.py) gives the
+same waveform variables as the per-event Waveform path, and compare their
+speed, on the first events of a raw root file.
+
+Usage:
+    python batch_waveform_check.py /path/to/raw_root_file [yaml_config] [n_events]
+"""
+import os
+import sys
+import time
+import uproot
+
+# Note: run setup.sh to get environemtal variables
+src_path = os.environ['SOURCE_DIR']
+YAML_DIR = os.environ['YAML_DIR']
+sys.path.append(src_path)
+from run_drop import RunDROP
+from waveform import Waveform
+from batch_waveform import compare_waveform
+from waveform_codec import PACKED_BRANCH, unpack_awkward
+
+class Args:
+    start_id = 0
+    end_id = 99999999
+    output_dir = ""
+    if_path = ""
+    yaml = ""
+
+args = Args()
+args.if_path = str(sys.argv[1])
+args.yaml = str(sys.argv[2]) if len(sys.argv)>2 else YAML_DIR + '/config.yaml'
+n_events = int(sys.argv[3]) if len(sys.argv)>3 else 500
+
+run = RunDROP(args)
+batch = uproot.open(args.if_path)['daq'].arrays(entry_stop=n_events)
+adc = unpack_awkward(batch[PACKED_BRANCH]) if PACKED_BRANCH in batch.fields else None
+
+def new_waveform():
+    wfm = Waveform(run.cfg)
+    wfm.ch_names = run.ch_names
+    wfm.ch_id = run.ch_id
+    wfm.ch_name_to_id_dict = run.ch_name_to_id_dict
+    wfm.n_boards = run.n_boards
+    wfm.spe_mean = run.spe_mean
+    return wfm
+
+# per-event path
+t0 = time.perf_counter()
+ref = [run.process_waveform(new_waveform(), batch[i], None if adc is None else adc[i]) for i in range(len(batch))]
+t_event = time.perf_counter() - t0
+
+# batch path
+t0 = time.perf_counter()
+bwfm = run.get_batch_waveform(batch, adc)
+wfm = [bwfm.to_waveform(i, new_waveform()) for i in range(len(batch))]
+t_batch = time.perf_counter() - t0
+
+# float32 sums and std differ in rounding between the two paths
+tol = 1e-9 if run.cfg.precision=='float64' else 1e-4
+n_bad = 0
+for i in range(len(batch)):
+    bad = compare_waveform(wfm[i], ref[i], rtol=tol, atol=tol)
+    if bad:
+        n_bad += 1
+        if n_bad<=10:
+            print("event_id %d differs: %s" % (ref[i].event_id, ', '.join(bad[:10])))
+print("Info: %d events, %d differ" % (len(batch), n_bad))
+print("Info: per-event %.3f s, batch %.3f s (x%.1f)" % (t_event, t_batch, t_event/t_batch if t_batch>0 else 0))
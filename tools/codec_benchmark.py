@@ -0,0 +1,72 @@
+"""
+Round-trip benchmark of the lossless waveform codec (delta + zigzag +
+bit-packing, see src/waveform_codec.py) against general-purpose compressors,
+on real traces from a raw root file.
+
+For each method, print the compression ratio and the encode/decode speed
+(MB/s of uncompressed uint16 data), and check that the round trip is exact.
+
+Usage:
+    python codec_benchmark.py /path/to/raw_root_file [n_events]
+"""
+import os
+import sys
+import time
+import numpy as np
+import uproot
+
+# Note: run setup.sh to get environemtal variables
+src_path = os.environ['SOURCE_DIR']
+sys.path.append(src_path)
+import waveform_codec as wc
+
+# general-purpose compressors to compare with, on the raw uint16 bytes
+COMPRESSORS = [('ZSTD', 1), ('ZSTD', 5), ('ZSTD', 9), ('ZLIB', 1), ('LZ4', 1)]
+
+if_path = str(sys.argv[1])
+n_events = int(sys.argv[2]) if len(sys.argv)>2 else 1000
+
+# sample of waveforms, as (event, channel, sample)
+tree = uproot.open(if_path)['daq']
+if wc.PACKED_BRANCH in tree.keys():
+    adc = wc.unpack_awkward(tree[wc.PACKED_BRANCH].array(entry_stop=n_events))
+elif 'adc' in tree.keys():
+    adc = tree['adc'].array(entry_stop=n_events, library='np')
+else:
+    b_names = [b for b in tree.keys() if b[0:4]=='adc_']
+    data = tree.arrays(b_names, entry_stop=n_events, library='np')
+    adc = np.stack([data[b] for b in b_names], axis=1)
+adc = np.ascontiguousarray(adc, dtype=np.uint16)
+raw = adc.tobytes()
+mb = len(raw)/1e6
+print("Info: %d events x %d channels x %d samples, %.1f MB" % (adc.shape + (mb,)))
+
+print("%-16s %8s %12s %12s %6s" % ('method', 'ratio', 'enc MB/s', 'dec MB/s', 'exact'))
+t0 = time.perf_counter()
+content, offsets = wc.pack_events(adc)
+t_enc = time.perf_counter() - t0
+t0 = time.perf_counter()
+out = wc.unpack_events(content, offsets)
+t_dec = time.perf_counter() - t0
+print("%-16s %8.2f %12.1f %12.1f %6s" % ('delta-bitpack', len(raw)/len(content), mb/t_enc, mb/t_dec, np.array_equal(out, adc)))
+
+for name, level in COMPRESSORS:
+    comp = getattr(uproot, name)(level)
+    for label, data in [(name+'-%d' % level, raw), ('delta+'+name+'-%d' % level, content.tobytes())]:
+        try:
+            t0 = time.perf_counter()
+            c = comp.compress(data)
+            t_enc = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            d = comp.decompress(c, len(data))
+            t_dec = time.perf_counter() - t0
+        except (ImportError, ModuleNotFoundError) as e:
+            print("%-16s skipped: %s" % (label, e))
+            break
+        # delta+ rows: the compressor on top of the packed bytes (speeds exclude the codec)
+        if label.startswith('delta+'):
+            d = wc.unpack_events(np.frombuffer(d, dtype=np.uint8), offsets)
+            exact = np.array_equal(d, adc)
+        else:
+            exact = bytes(d)==raw
+        print("%-16s %8.2f %12.1f %12.1f %6s" % (label, len(raw)/len(c), mb/t_enc, mb/t_dec, exact))
@@ -0,0 +1,66 @@
+"""
+Benchmark compression codecs and basket sizes on real waveforms.
+
+A sample of events is read from the daq tree of a raw root file, then written
+to a temporary file once per setting (codec, level, basket size). For each
+setting, print the write and read speed (MB/s of uncompressed data) and the
+compression ratio. Use it to pick COMPRESSION/BASKET_BYTES of the rooter, or
+the compression keys of the yaml config.
+
+Codecs whose python library is not installed are skipped (ZSTD needs
+zstandard; LZ4 needs lz4 and xxhash).
+
+Usage:
+    python compression_benchmark.py /path/to/raw_root_file [n_events]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import uproot
+
+# Note: run setup.sh to get environemtal variables
+src_path = os.environ['SOURCE_DIR']
+sys.path.append(src_path)
+from utilities import get_compression
+
+# settings to compare
+CODECS = [('ZLIB', 1), ('ZLIB', 4), ('LZ4', 1), ('LZ4', 4), ('ZSTD', 1), ('ZSTD', 5), ('LZMA', 1), (None, 0)]
+BASKET_BYTES = [256*1024, 1024*1024, 4*1024*1024] # per branch, uncompressed
+
+if_path = str(sys.argv[1])
+n_events = int(sys.argv[2]) if len(sys.argv)>2 else 2000
+
+# sample of waveforms
+tree = uproot.open(if_path)['daq']
+b_names = [b for b in tree.keys() if b[0:4]=='adc_' or b=='adc']
+data = tree.arrays(b_names, entry_stop=n_events, library='np')
+data = {b: np.ascontiguousarray(data[b]) for b in b_names}
+n_events = len(data[b_names[0]])
+bytes_per_event = sum(data[b][0].nbytes for b in b_names)
+max_branch_bytes = max(data[b][0].nbytes for b in b_names)
+tot_mb = n_events*bytes_per_event/1e6
+print("Info: %d events, %d branches, %.1f MB uncompressed" % (n_events, len(b_names), tot_mb))
+
+print("%-6s %5s %12s %10s %10s %8s" % ('codec', 'level', 'basket[kB]', 'write MB/s', 'read MB/s', 'ratio'))
+with tempfile.TemporaryDirectory() as tmp_dir:
+    for codec, level in CODECS:
+        for basket_bytes in BASKET_BYTES:
+            n_per_basket = max(basket_bytes//max_branch_bytes, 1)
+            of_path = os.path.join(tmp_dir, 'bench.root')
+            try:
+                t0 = time.perf_counter()
+                with uproot.recreate(of_path, compression=get_compression(codec, level)) as f:
+                    f.mktree('daq', {b: np.dtype((data[b].dtype, data[b].shape[1:])) for b in b_names})
+                    for start in range(0, n_events, n_per_basket):
+                        f['daq'].extend({b: data[b][start:start+n_per_basket] for b in b_names})
+                t_write = time.perf_counter() - t0
+            except (ImportError, ModuleNotFoundError) as e:
+                print("%-6s %5d  skipped: %s" % (codec, level, e))
+                break
+            t0 = time.perf_counter()
+            uproot.open(of_path)['daq'].arrays(b_names, library='np')
+            t_read = time.perf_counter() - t0
+            ratio = n_events*bytes_per_event/os.path.getsize(of_path)
+            print("%-6s %5d %12d %10.1f %10.1f %8.2f" % (codec, level, basket_bytes//1024, tot_mb/t_write, tot_mb/t_read, ratio))
@@ -47,7 +47,10 @@ def plot_channel_npe(file_path, output_dir):
         nbinx = int((tmax-tmin)/5+0.5) # every 5 minutes a bin
         for r, ch in enumerate(ch_id):
             ch_mask=(rq['ch_id']==ch)
-            ch_roi1_area_pe=rq['ch_roi1_area_pe'][ch_mask].flatten()
+            if 'ch_roi_area_pe' in rq: # (channel, roi) per event
+                ch_roi1_area_pe=rq['ch_roi_area_pe'][ch_mask][:, 1]
+            else: # RQ files before the 2-D ROI branches
+                ch_roi1_area_pe=rq['ch_roi1_area_pe'][ch_mask].flatten()
             h0 = ax[r].hist2d(t_minute, ch_roi1_area_pe, bins=[nbinx, 50], range=((tmin,tmax),(0, 50)), norm=colors.LogNorm(), cmap='jet');
             ax[r].set_xlabel('Time elapsed since run start [min]', fontsize=12)
             ax[r].set_ylabel('Channel Npe', fontsize=12)
@@ -74,7 +77,10 @@ def plot_channel_noise(file_path, output_dir):
         nbinx = int((tmax-tmin)/5+0.5) # every 5 minutes a bin
         for r, ch in enumerate(ch_id):
             ch_mask=(rq['ch_id']==ch)
-            ch_roi0_std_pe=rq['ch_roi0_std_mV'][ch_mask].flatten()
+            if 'ch_roi_std_mV' in rq:
+                ch_roi0_std_pe=rq['ch_roi_std_mV'][ch_mask][:, 0]
+            else:
+                ch_roi0_std_pe=rq['ch_roi0_std_mV'][ch_mask].flatten()
             h0 = ax[r].hist2d(t_minute, ch_roi0_std_pe, bins=[nbinx, 50], range=((tmin,tmax),(0, 10)),
                               norm=colors.LogNorm(), cmap='jet');
             ax[r].set_xlabel('Time elapsed since run start [min]', fontsize=12)
@@ -22,6 +22,7 @@ from utilities import generate_colormap
 from run_drop import RunDROP
 from pulse_finder import PulseFinder
 from yaml_reader import SAMPLE_TO_NS
+from event_index import load_event_index, event_id_to_entry_ranges
 
 class Args:
     start_id = 0
@@ -126,18 +127,20 @@ class EventDisplay():
 
         self.wfm_list = []
         self.pf_list = []
-        batch_list = uproot.iterate('%s:daq' % self.args.if_path, step_size=100)
-        for batch in batch_list:
-            arr = batch.event_id.to_numpy()
-            mask = np.isin(arr, wanted_event_id)
+        # read only the entries of the wanted events
+        f = uproot.open(self.args.if_path)
+        index = load_event_index(f)
+        for start, stop in event_id_to_entry_ranges(index, wanted_event_id):
+            batch = f['daq'].arrays(entry_start=start, entry_stop=stop)
             run = self.run
-            run.process_batch(batch[mask], None)
+            run.process_batch(batch, None)
             self.wfm_list.append(run.wfm_list)
             self.pf_list.append(run.pf_list)
 
-            # record min and max event_id for hints
-            self.min_event_id = np.min([self.min_event_id, np.min(arr)])
-            self.max_event_id = np.max([self.max_event_id, np.max(arr)])
+        # record min and max event_id for hints
+        if len(index['event_id'])>0:
+            self.min_event_id = index['event_id'][0]
+            self.max_event_id = index['event_id'][-1]
 
         self.wfm_list = [item for sublist in self.wfm_list for item in sublist] # flatten list
         self.pf_list = [item for sublist in self.pf_list for item in sublist]
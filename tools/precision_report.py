@@ -0,0 +1,81 @@
+"""
+Validation report of the float32 mode (yaml key precision): run DROP on the
+same raw root file with float64 and float32, and compare the RQ event trees
+branch by branch.
+
+For each branch, print the largest absolute difference, the largest relative
+difference (of values above ABS_TOL), and the fraction of values that differ
+by more than REL_TOL and ABS_TOL (np.isclose). Pulse branches are compared
+only for events with the same number of pulses in both files; the number of
+events where it differs is printed first.
+
+Usage:
+    python precision_report.py /path/to/raw_root_file [yaml_config] [end_id]
+"""
+import os
+import sys
+import subprocess
+import tempfile
+import yaml
+import numpy as np
+import awkward as ak
+import uproot
+
+# Note: run setup.sh to get environemtal variables
+src_path = os.environ['SOURCE_DIR']
+YAML_DIR = os.environ['YAML_DIR']
+
+REL_TOL = 1e-3 # relative difference counted as a mismatch
+ABS_TOL = 1e-3 # ... unless the absolute difference is below this (pe, mV, ns)
+
+if_path = str(sys.argv[1])
+yaml_path = str(sys.argv[2]) if len(sys.argv)>2 else YAML_DIR + '/config.yaml'
+end_id = int(sys.argv[3]) if len(sys.argv)>3 else None
+
+def run_drop(precision, tmp_dir):
+    """
+    Run run_drop.py with the yaml config, precision overridden. Returns the
+    path to the RQ file.
+    """
+    with open(yaml_path, 'r') as f:
+        cfg = yaml.safe_load(f)
+    cfg['precision'] = precision
+    out_dir = tmp_dir + '/' + precision
+    os.makedirs(out_dir)
+    cfg_path = out_dir + '/config.yaml'
+    with open(cfg_path, 'w') as f:
+        yaml.safe_dump(cfg, f)
+    cmd = [sys.executable, src_path+'/run_drop.py', '-i', if_path, '-c', cfg_path, '--output_dir', out_dir]
+    if end_id is not None:
+        cmd += ['--end_id', str(end_id)]
+    print("Info: running DROP in %s" % precision)
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    name = os.path.splitext(os.path.basename(if_path))[0]
+    return out_dir + '/' + name + '_rq.root'
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    ref = uproot.open(run_drop('float64', tmp_dir))['event'].arrays()
+    new = uproot.open(run_drop('float32', tmp_dir))['event'].arrays()
+
+print("Info: %d events" % len(ref))
+# pulse branches (jagged) can only be compared where the pulse counts agree
+pulse_fields = [k for k in ref.fields if k.startswith('pulse_')]
+same = np.ones(len(ref), dtype=bool)
+if pulse_fields:
+    same = ak.to_numpy(ak.num(ref[pulse_fields[0]])==ak.num(new[pulse_fields[0]]))
+    print("Info: %d events with a different number of pulses" % np.count_nonzero(~same))
+
+print("%-28s %12s %12s %10s" % ('branch', 'max abs', 'max rel', 'frac bad'))
+for k in ref.fields:
+    a, b = ref[k], new[k]
+    if k in pulse_fields:
+        a, b = a[same], b[same]
+    a = np.asarray(ak.to_numpy(ak.flatten(a, axis=None)), dtype=np.float64)
+    b = np.asarray(ak.to_numpy(ak.flatten(b, axis=None)), dtype=np.float64)
+    if a.size==0:
+        continue
+    d = np.abs(b-a)
+    big = np.abs(a)>ABS_TOL
+    rel = np.max(d[big]/np.abs(a[big])) if np.any(big) else 0
+    bad = ~np.isclose(b, a, rtol=REL_TOL, atol=ABS_TOL, equal_nan=True)
+    print("%-28s %12.3g %12.3g %10.4f" % (k, np.nanmax(d), rel, np.mean(bad)))
@@ -3,11 +3,16 @@ A script to inspect binary file.
 
 > **__Note__**: Alternatively, you can use xxd to look at binary file. Try: `xxd -h`
 
+Only the trigger headers are read (see RawDataFile.build_index), so it is fast
+even for a multi-GB file. The index is saved next to the binary file as a
+sidecar .idx.npy file and reused by later passes.
+
 Usage:
     python print_binary_info.py /path/to/raw_binary_file
 """
 import os
 import sys
+import numpy as np
 
 # Note: run setup.sh to get environemtal variables
 src_path = os.environ['SOURCE_DIR']
@@ -27,18 +32,34 @@ else:
 print("haha", ETTT_flag)
 
 raw_data_file = RawDataFile(if_path, n_boards, ETTT_flag=ETTT_flag)
+index = raw_data_file.load_index()
+if len(index)==0:
+    sys.exit("No trigger found")
+
+# recordLen from the first trigger, same as getNextTrigger
+size = int(index['size'][0])-16
+n_bits = max(bin(int(index['channelMask'][0])).count('1'), 1)
+if index['boardId'][0]==5:
+    print("recordLen:", size//(12*n_bits)) # V1740: group mask, 8 channels per group, 1.5 bytes per sample
+else:
+    print("recordLen:", size//(2*n_bits)) # V1730: channel mask, 2 bytes per sample
+print("n_triggers:", len(index))
+for b in np.unique(index['boardId']):
+    print("  boardId %d: %d triggers" % (b, np.sum(index['boardId']==b)))
+
+# TTT corrected for rollover, board by board in file order
+index = index[:200]
+ttt = np.zeros(len(index), dtype=np.uint64)
+for b in np.unique(index['boardId']):
+    sel = index['boardId']==b
+    ttt[sel] = raw_data_file.correct_ttt_rollover(int(b), index['ttt'][sel])
+
 width=9
 prev_ttt=0
-for i in range(200):
-    trigger = raw_data_file.getNextTrigger()
-    if trigger is None:
-        print("Done")
-        break
-    if i==0:
-        print("recordLen:", raw_data_file.recordLen) # read one trigger to know recordLen
-        print('%s\t%s\t%s\t%s\t%s' % ('i'.ljust(width), "event_id".ljust(width), "boardId".ljust(width), 'TTT'.ljust(width), 'delta_ttt'.ljust(width) ))
-    delta_ttt = trigger.triggerTimeTag - prev_ttt
-    print('%s\t%s\t%s\t%s\t%s' % (i, trigger.eventCounter, trigger.boardId, trigger.triggerTimeTag, delta_ttt))
-    # for ch, val in trigger.traces.items():
-    #    print(ch, len(val) )
-    prev_ttt = trigger.triggerTimeTag
+print('%s\t%s\t%s\t%s\t%s' % ('i'.ljust(width), "event_id".ljust(width), "boardId".ljust(width), 'TTT'.ljust(width), 'delta_ttt'.ljust(width) ))
+for i, trigger in enumerate(index):
+    delta_ttt = int(ttt[i]) - prev_ttt
+    print('%s\t%s\t%s\t%s\t%s' % (i, trigger['eventCounter'], trigger['boardId'], ttt[i], delta_ttt))
+    prev_ttt = int(ttt[i])
+print("Done")
+raw_data_file.close()